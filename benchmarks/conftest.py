@@ -0,0 +1,86 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import resource
+import sys
+from pathlib import Path
+
+import pytest
+
+from benchmarks.synthetic import SlideSpec, generate_slide
+from pims_plugin_format_dicom.cache import (
+    get_annotation_index_cache, get_associated_cache, get_histogram_cache, get_slide_cache,
+    get_tile_cache
+)
+from pims_plugin_format_dicom.frames import get_frame_index_cache
+from pims_plugin_format_dicom.index import frames_path, index_path, thumbnail_path
+
+# Width of the base level of the benchmark slides.
+SIZE = int(os.getenv("WSIDICOM_BENCH_SIZE", "8192"))
+
+SLIDES = {
+    'jpeg': SlideSpec(width=SIZE, height=SIZE * 3 // 4, annotations=10000),
+    # JPEG 2000 encoding is slow, and so is generating large slides.
+    'jpeg2000': SlideSpec(width=SIZE // 2, height=SIZE * 3 // 8, codec='jpeg2000'),
+    'sparse': SlideSpec(width=SIZE, height=SIZE * 3 // 4, tiled_full=False),
+    'concatenated': SlideSpec(width=SIZE, height=SIZE * 3 // 4, files_per_level=16),
+}
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB elsewhere.
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def reset_caches():
+    """Empty the in-process caches of the plugin. The OS page cache is kept."""
+    for cache in (
+        get_slide_cache(), get_tile_cache(), get_associated_cache(), get_annotation_index_cache(),
+        get_histogram_cache(), get_frame_index_cache()
+    ):
+        if cache is not None:
+            cache.clear()
+
+
+def remove_sidecars(path: Path):
+    for sidecar in (index_path(path), thumbnail_path(path), frames_path(path)):
+        if sidecar.exists():
+            sidecar.unlink()
+
+
+@pytest.fixture(scope='session')
+def slides_dir(tmp_path_factory) -> Path:
+    """Slides are kept in WSIDICOM_BENCH_DIR if set, to be generated only once."""
+    path = os.getenv("WSIDICOM_BENCH_DIR")
+    return Path(path) if path else tmp_path_factory.mktemp("slides")
+
+
+@pytest.fixture(scope='session', params=sorted(SLIDES))
+def slide(request, slides_dir) -> Path:
+    spec = SLIDES[request.param]
+    path = slides_dir / f"{request.param}-{spec.width}"
+    if not path.exists():
+        generate_slide(path.with_suffix('.tmp'), spec)
+        path.with_suffix('.tmp').rename(path)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def report_peak_rss(benchmark):
+    """Report the peak RSS of the process at the end of each benchmark."""
+    yield
+    benchmark.extra_info['peak_rss_mb'] = round(peak_rss_mb(), 1)
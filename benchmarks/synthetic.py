@@ -0,0 +1,351 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Generator of synthetic WSI DICOM slides, for benchmarks.
+
+A slide is a directory holding a pyramid of VL Whole Slide Microscopy
+Image instances (down to a single tile), optionally a label, an overview
+and a Microscopy Bulk Simple Annotations instance. Pixels are a smooth
+stained "tissue" ellipse over a bright background, with some noise so that
+compressed frame sizes are realistic.
+
+    python -m benchmarks.synthetic /tmp/slides/jpeg --width 20000 --height 15000
+"""
+
+import argparse
+from dataclasses import dataclass, fields
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.sequence import Sequence as DicomSequence
+from pydicom.uid import (
+    JPEG2000, JPEG2000Lossless, JPEGBaseline8Bit, UID, generate_uid
+)
+from wsidicom.conceptcode import AnnotationCategoryCode, AnnotationTypeCode
+from wsidicom.graphical_annotations import (
+    Annotation, AnnotationInstance, Point, PointAnnotationGroup, Polygon,
+    PolygonAnnotationGroup, Polyline, PolylineAnnotationGroup
+)
+from wsidicom.uid import WSI_SOP_CLASS_UID, SlideUids
+
+# Codec name: transfer syntax, Pillow format and options, photometric interpretation.
+CODECS = {
+    'jpeg': (JPEGBaseline8Bit, 'JPEG', {'quality': 80}, 'YBR_FULL_422'),
+    'jpeg2000': (JPEG2000, 'JPEG2000', {'quality_layers': [20], 'no_jp2': True}, 'YBR_ICT'),
+    'jpeg2000-lossless': (
+        JPEG2000Lossless, 'JPEG2000', {'irreversible': False, 'no_jp2': True}, 'YBR_RCT'
+    ),
+}
+
+# Pixel spacing of the base level, in mm.
+BASE_PIXEL_SPACING = 0.00025
+BACKGROUND = 240
+
+
+@dataclass
+class SlideSpec:
+    """Description of a synthetic slide."""
+    width: int = 8192
+    height: int = 6144
+    tile_size: int = 256
+    codec: str = 'jpeg'
+    # TILED_FULL, or TILED_SPARSE without the background tiles.
+    tiled_full: bool = True
+    # Number of (concatenated) instance files per level.
+    files_per_level: int = 1
+    label: bool = True
+    overview: bool = True
+    # Number of annotations of each type (points, polylines, polygons).
+    annotations: int = 0
+    seed: int = 0
+
+
+def level_sizes(spec: SlideSpec) -> List[Tuple[int, int]]:
+    """Get the (width, height) of the pyramid levels, halved down to a single tile."""
+    sizes = [(spec.width, spec.height)]
+    while max(sizes[-1]) > spec.tile_size:
+        width, height = sizes[-1]
+        sizes.append((max(1, -(-width // 2)), max(1, -(-height // 2))))
+    return sizes
+
+
+def tissue_mask(
+    spec: SlideSpec, left: int, top: int, width: int, height: int, downsample: float
+) -> np.ndarray:
+    """Get the mask of the tissue ellipse over a region of a level."""
+    ys, xs = np.ogrid[top:top + height, left:left + width]
+    u, v = xs * downsample / spec.width - 0.5, ys * downsample / spec.height - 0.5
+    return (u ** 2 / 0.16 + v ** 2 / 0.09) < 1
+
+
+def synthetic_pixels(
+    spec: SlideSpec, left: int, top: int, width: int, height: int, downsample: float,
+    rng: Optional[np.random.Generator] = None
+) -> np.ndarray:
+    """Get the RGB pixels of a region of a level, given its downsample to the base level."""
+    ys, xs = np.mgrid[top:top + height, left:left + width].astype(np.float32) * downsample
+    tissue = tissue_mask(spec, left, top, width, height, downsample)
+    texture = np.sin(xs / 97) * np.cos(ys / 131) + 0.5 * np.sin((xs + ys) / 23)
+    stain = np.stack((190 + 30 * texture, 110 + 40 * texture, 170 + 25 * texture), axis=-1)
+    pixels = np.where(tissue[..., np.newaxis], stain, BACKGROUND)
+    if rng is not None:
+        pixels += rng.normal(0, 6, pixels.shape)
+    return np.clip(pixels, 0, 255).astype(np.uint8)
+
+
+def encode(pixels: np.ndarray, codec: str) -> bytes:
+    _, image_format, options, _ = CODECS[codec]
+    buf = BytesIO()
+    Image.fromarray(pixels).save(buf, format=image_format, **options)
+    return buf.getvalue()
+
+
+def _code_item(value: str, scheme: str, meaning: str) -> Dataset:
+    item = Dataset()
+    item.CodeValue = value
+    item.CodingSchemeDesignator = scheme
+    item.CodeMeaning = meaning
+    return item
+
+
+def _image_dataset(
+    spec: SlideSpec, uids: SlideUids, image_type: str, size: Tuple[int, int],
+    frame_size: Tuple[int, int], pixel_spacing: float
+) -> Dataset:
+    transfer_syntax, _, _, photometric_interpretation = CODECS[spec.codec]
+    ds = Dataset()
+    ds.SOPClassUID = WSI_SOP_CLASS_UID
+    ds.StudyInstanceUID = uids.study_instance
+    ds.SeriesInstanceUID = uids.series_instance
+    ds.FrameOfReferenceUID = uids.frame_of_reference
+    ds.Modality = 'SM'
+    ds.Manufacturer = 'Synthetic'
+    ds.ManufacturerModelName = 'pims-plugin-format-dicom benchmarks'
+    ds.DeviceSerialNumber = '1'
+    ds.SoftwareVersions = ['1']
+    ds.ContainerIdentifier = f"synthetic-{spec.seed}"
+    ds.SpecimenDescriptionSequence = DicomSequence()
+    now = datetime.now()
+    ds.AcquisitionDateTime = now.strftime('%Y%m%d%H%M%S')
+    ds.ContentDate = now.strftime('%Y%m%d')
+    ds.ContentTime = now.strftime('%H%M%S')
+
+    ds.ImageType = ['ORIGINAL', 'PRIMARY', image_type, 'NONE']
+    ds.Columns, ds.Rows = frame_size
+    ds.TotalPixelMatrixColumns, ds.TotalPixelMatrixRows = size
+    ds.TotalPixelMatrixFocalPlanes = 1
+    ds.SamplesPerPixel = 3
+    ds.PhotometricInterpretation = photometric_interpretation
+    ds.PlanarConfiguration = 0
+    ds.BitsAllocated = 8
+    ds.BitsStored = 8
+    ds.HighBit = 7
+    ds.PixelRepresentation = 0
+    ds.LossyImageCompression = '00' if transfer_syntax == JPEG2000Lossless else '01'
+    ds.VolumetricProperties = 'VOLUME'
+    ds.SpecimenLabelInImage = 'YES' if image_type != 'VOLUME' else 'NO'
+    ds.BurnedInAnnotation = 'YES' if image_type == 'LABEL' else 'NO'
+    ds.FocusMethod = 'AUTO'
+    ds.ExtendedDepthOfField = 'NO'
+    ds.ImageOrientationSlide = [0, -1, 0, -1, 0, 0]
+
+    ds.ImagedVolumeWidth = size[0] * pixel_spacing
+    ds.ImagedVolumeHeight = size[1] * pixel_spacing
+    ds.ImagedVolumeDepth = 0.004
+    origin = Dataset()
+    origin.XOffsetInSlideCoordinateSystem = 20.0
+    origin.YOffsetInSlideCoordinateSystem = 40.0
+    ds.TotalPixelMatrixOriginSequence = DicomSequence([origin])
+
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = [pixel_spacing, pixel_spacing]
+    pixel_measures.SliceThickness = 0.004
+    pixel_measures.SpacingBetweenSlices = 0.0
+    shared = Dataset()
+    shared.PixelMeasuresSequence = DicomSequence([pixel_measures])
+    ds.SharedFunctionalGroupsSequence = DicomSequence([shared])
+
+    optical_path = Dataset()
+    optical_path.OpticalPathIdentifier = '0'
+    optical_path.IlluminationColorCodeSequence = DicomSequence(
+        [_code_item('414298005', 'SCT', 'Full Spectrum')]
+    )
+    optical_path.IlluminationTypeCodeSequence = DicomSequence(
+        [_code_item('111744', 'DCM', 'Brightfield illumination')]
+    )
+    optical_path.ObjectiveLensPower = 40
+    ds.OpticalPathSequence = DicomSequence([optical_path])
+    ds.NumberOfOpticalPaths = 1
+    return ds
+
+
+def _write(path: Path, ds: Dataset, transfer_syntax: UID, frames: Optional[List[bytes]] = None):
+    ds.SOPInstanceUID = ds.get('SOPInstanceUID', generate_uid())
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    meta.TransferSyntaxUID = transfer_syntax
+    file_ds = FileDataset(str(path), ds, file_meta=meta, preamble=b'\0' * 128)
+    file_ds.is_little_endian = True
+    file_ds.is_implicit_VR = transfer_syntax.is_implicit_VR
+    if frames is not None:
+        file_ds.NumberOfFrames = len(frames)
+        file_ds.PixelData = encapsulate(frames, has_bot=True)
+        file_ds['PixelData'].VR = 'OB'
+        file_ds['PixelData'].is_undefined_length = True
+    file_ds.save_as(str(path), write_like_original=False)
+
+
+def _frame_position(x: int, y: int, pixel_spacing: float) -> Dataset:
+    position = Dataset()
+    position.ColumnPositionInTotalImagePixelMatrix = x + 1
+    position.RowPositionInTotalImagePixelMatrix = y + 1
+    position.XOffsetInSlideCoordinateSystem = 20.0 - y * pixel_spacing
+    position.YOffsetInSlideCoordinateSystem = 40.0 - x * pixel_spacing
+    position.ZOffsetInSlideCoordinateSystem = 0.0
+    frame = Dataset()
+    frame.PlanePositionSlideSequence = DicomSequence([position])
+    return frame
+
+
+def write_level(path: Path, spec: SlideSpec, uids: SlideUids, level: int, rng: np.random.Generator):
+    """Write the instance files of a pyramid level."""
+    width, height = level_sizes(spec)[level]
+    downsample = 2 ** level
+    pixel_spacing = BASE_PIXEL_SPACING * downsample
+    tile_size = spec.tile_size
+    transfer_syntax = CODECS[spec.codec][0]
+
+    frames, positions = [], []
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            w, h = min(tile_size, width - x), min(tile_size, height - y)
+            if not spec.tiled_full and not tissue_mask(spec, x, y, w, h, downsample).any():
+                continue
+            # Edge frames are padded up to the tile size.
+            pixels = np.full((tile_size, tile_size, 3), BACKGROUND, dtype=np.uint8)
+            pixels[:h, :w] = synthetic_pixels(spec, x, y, w, h, downsample, rng)
+            frames.append(encode(pixels, spec.codec))
+            positions.append((x, y))
+
+    n_files = max(1, min(spec.files_per_level, len(frames)))
+    bounds = np.linspace(0, len(frames), n_files + 1).round().astype(int)
+    concatenation_uid, source_uid = generate_uid(), generate_uid()
+    for part, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        ds = _image_dataset(spec, uids, 'VOLUME', (width, height), (tile_size, tile_size), pixel_spacing)
+        ds.InstanceNumber = level + 1
+        if spec.tiled_full:
+            ds.DimensionOrganizationType = 'TILED_FULL'
+        else:
+            ds.DimensionOrganizationType = 'TILED_SPARSE'
+            ds.PerFrameFunctionalGroupsSequence = DicomSequence([
+                _frame_position(x, y, pixel_spacing) for x, y in positions[start:end]
+            ])
+        if n_files > 1:
+            ds.ConcatenationUID = concatenation_uid
+            ds.SOPInstanceUIDOfConcatenationSource = source_uid
+            ds.ConcatenationFrameOffsetNumber = int(start)
+            ds.InConcatenationNumber = part + 1
+            ds.InConcatenationTotalNumber = n_files
+        name = f"level-{level}.dcm" if n_files == 1 else f"level-{level}-{part}.dcm"
+        _write(path / name, ds, transfer_syntax, frames[start:end])
+
+
+def write_associated(path: Path, spec: SlideSpec, uids: SlideUids, image_type: str):
+    """Write a single frame label or overview image."""
+    if image_type == 'LABEL':
+        size = (600, 400)
+        pixels = np.full((size[1], size[0], 3), 250, dtype=np.uint8)
+        # Barcode-like stripes.
+        pixels[100:300, 50:550:8] = 0
+    else:
+        ratio = 1024 / max(spec.width, spec.height)
+        size = (max(1, round(spec.width * ratio)), max(1, round(spec.height * ratio)))
+        pixels = synthetic_pixels(spec, 0, 0, size[0], size[1], 1 / ratio)
+
+    ds = _image_dataset(spec, uids, image_type, size, size, BASE_PIXEL_SPACING * spec.width / size[0])
+    ds.DimensionOrganizationType = 'TILED_FULL'
+    ds.InstanceNumber = 1
+    _write(path / f"{image_type.lower()}.dcm", ds, CODECS[spec.codec][0], [encode(pixels, spec.codec)])
+
+
+def write_annotations(path: Path, spec: SlideSpec, uids: SlideUids, rng: np.random.Generator):
+    """Write point, polyline and polygon annotation groups (in mm) over the tissue."""
+    n = spec.annotations
+    centers = (rng.uniform(0.3, 0.7, (n, 2)) * (spec.width, spec.height)) * BASE_PIXEL_SPACING
+    radius = 20 * BASE_PIXEL_SPACING
+    angles = np.linspace(0, 2 * np.pi, 8, endpoint=False)
+    ring = np.stack((np.cos(angles), np.sin(angles)), axis=-1) * radius
+
+    category = AnnotationCategoryCode('Tissue')
+    type_code = AnnotationTypeCode('Nucleus')
+    groups = [
+        PointAnnotationGroup(
+            [Annotation(Point(x, y)) for x, y in centers], 'points', category, type_code
+        ),
+        PolylineAnnotationGroup(
+            [Annotation(Polyline([tuple(c), tuple(c + radius)])) for c in centers],
+            'polylines', category, type_code
+        ),
+        PolygonAnnotationGroup(
+            [Annotation(Polygon([tuple(p) for p in c + ring])) for c in centers],
+            'polygons', category, type_code
+        ),
+    ]
+    AnnotationInstance(groups, 'volume', uids).save(path / "annotations.dcm")
+
+
+def generate_slide(path: Path, spec: SlideSpec = SlideSpec()) -> Path:
+    """Write a synthetic slide in a (new) directory."""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(spec.seed)
+    uids = SlideUids(generate_uid(), generate_uid(), generate_uid())
+
+    for level in range(len(level_sizes(spec))):
+        write_level(path, spec, uids, level, rng)
+    if spec.label:
+        write_associated(path, spec, uids, 'LABEL')
+    if spec.overview:
+        write_associated(path, spec, uids, 'OVERVIEW')
+    if spec.annotations:
+        write_annotations(path, spec, uids, rng)
+    return path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic WSI DICOM slide.")
+    parser.add_argument('path', type=Path, help="Slide directory to write")
+    for field in fields(SlideSpec):
+        option = '--' + field.name.replace('_', '-')
+        if field.type is bool:
+            parser.add_argument(option, type=lambda v: v.lower() in ('1', 'true', 'yes'), default=field.default)
+        elif field.name == 'codec':
+            parser.add_argument(option, choices=sorted(CODECS), default=field.default)
+        else:
+            parser.add_argument(option, type=field.type, default=field.default)
+    options = vars(parser.parse_args(args))
+    path = options.pop('path')
+    generate_slide(path, SlideSpec(**options))
+
+
+if __name__ == '__main__':
+    main()
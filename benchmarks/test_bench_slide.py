@@ -0,0 +1,115 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Latency and throughput of the WSI DICOM format on synthetic slides.
+
+"Cold" reads start with empty plugin caches (slides, tiles, indexes) but
+not an empty OS page cache, which needs root privileges to drop.
+"""
+
+import itertools
+
+import pytest
+from pims.formats.utils.abstract import CachedDataPath
+from pims.processing.region import Region, Tile
+
+from benchmarks.conftest import SLIDES, remove_sidecars, reset_caches
+from pims_plugin_format_dicom.dicom import WSIDicomChecker, WSIDicomFormat
+
+ROUNDS = 10
+
+
+def open_format(path) -> WSIDicomFormat:
+    format = WSIDicomFormat(path)
+    format.main_imd  # noqa
+    format.pyramid  # noqa
+    return format
+
+
+def tissue_tiles(format: WSIDicomFormat):
+    """Iterate over the tiles of an 8x8 block at the center of the base tier, row by row."""
+    tier = format.pyramid.tiers[0]
+    cx, cy = tier.max_tx // 2, tier.max_ty // 2
+    for ty, tx in itertools.product(range(cy - 4, cy + 4), range(cx - 4, cx + 4)):
+        yield Tile(tier, tx, ty)
+
+
+def test_checker_match(benchmark, slide):
+    assert benchmark(lambda: WSIDicomChecker.match(CachedDataPath(slide)))
+
+
+@pytest.mark.parametrize("sidecars", [False, True], ids=["no-sidecars", "sidecars"])
+def test_open(benchmark, slide, sidecars):
+    open_format(slide)
+
+    def setup():
+        reset_caches()
+        if not sidecars:
+            remove_sidecars(slide)
+
+    benchmark.pedantic(open_format, args=(slide,), setup=setup, rounds=ROUNDS)
+
+
+def test_read_tile_cold(benchmark, slide):
+    format = open_format(slide)
+    tiles = tissue_tiles(format)
+
+    def setup():
+        reset_caches()
+        return (next(tiles),), {}
+
+    benchmark.pedantic(lambda tile: format.reader.read_tile(tile), setup=setup, rounds=ROUNDS)
+
+
+def test_read_tile_warm(benchmark, slide):
+    format = open_format(slide)
+    tile = next(tissue_tiles(format))
+    format.reader.read_tile(tile)
+    benchmark(format.reader.read_tile, tile)
+
+
+@pytest.mark.parametrize("out_size", [2048, 512])
+def test_read_window(benchmark, slide, out_size):
+    format = open_format(slide)
+    width, height = format.main_imd.width, format.main_imd.height
+    size = min(2048, width, height)
+    region = Region((height - size) // 2, (width - size) // 2, size, size)
+
+    benchmark.pedantic(
+        format.reader.read_window, args=(region, out_size, out_size), setup=reset_caches,
+        rounds=ROUNDS
+    )
+    benchmark.extra_info['megapixels_per_s'] = size * size / 1e6 / benchmark.stats.stats.mean
+
+
+@pytest.mark.parametrize("reopen", [False, True], ids=["opened", "reopened"])
+def test_parse_annotations(benchmark, slide, reopen):
+    """
+    Conversion of the annotations to PIMS annotations, including the reading
+    of the annotation files, and the opening of the slide if it is reopened.
+    """
+    n_annotations = 3 * SLIDES[slide.name.rsplit('-', 1)[0]].annotations
+    if not n_annotations:
+        pytest.skip("Slide without annotations")
+    format = open_format(slide)
+
+    def setup():
+        if reopen:
+            reset_caches()
+        format.clear_cache()
+
+    annotations = benchmark.pedantic(format.parser.parse_annotations, setup=setup, rounds=ROUNDS)
+    assert len(annotations) == n_annotations
+    benchmark.extra_info['annotations_per_s'] = n_annotations / benchmark.stats.stats.mean
@@ -0,0 +1,92 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Asynchronous region reads, for use from an asyncio event loop.
+
+Blocking file I/O runs on a dedicated I/O thread pool and decoding on the
+bounded decoding pool, so that the event loop is never blocked. Cancelling
+the awaiting task cancels the frame reads that have not started yet.
+"""
+
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import TYPE_CHECKING, Callable, Collection, List, Optional, Tuple
+
+import numpy as np
+
+from pims_plugin_format_dicom.cache import TileCache
+from pims_plugin_format_dicom.config import get_settings
+from pims_plugin_format_dicom.metrics import count
+from pims_plugin_format_dicom.tiles import Plane, PlanesRegion, TileIndex, get_decode_executor
+
+if TYPE_CHECKING:
+    from pims_plugin_format_dicom.frames import FrameIndex
+
+
+@lru_cache()
+def get_io_executor() -> ThreadPoolExecutor:
+    """Get the process-wide thread pool used for blocking I/O of asynchronous reads."""
+    return ThreadPoolExecutor(
+        max_workers=max(1, get_settings().io_workers), thread_name_prefix="wsidicom-io"
+    )
+
+
+def _in_context(func: Callable, *args, **kwargs) -> Callable:
+    # Executor threads do not inherit the context (e.g. running metrics) otherwise.
+    return partial(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+async def run_io(func: Callable, *args, **kwargs):
+    """Run a blocking function on the I/O pool. It is not run if cancelled before starting."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_io_executor(), _in_context(func, *args, **kwargs))
+
+
+async def read_planes_async(
+    planes: List[Plane], left: int, top: int, width: int, height: int,
+    cache: Optional[TileCache] = None, cache_keys: Optional[List[Tuple]] = None,
+    factor: int = 1, frames: Optional['FrameIndex'] = None,
+    tiles: Optional[Collection[TileIndex]] = None, background: int = 0
+) -> np.ndarray:
+    """Asynchronous variant of `tiles.read_planes`."""
+    loop = asyncio.get_running_loop()
+    # Cache lookups are in-memory, but a single tile read is not.
+    region = await run_io(
+        PlanesRegion, planes, left, top, width, height, cache, cache_keys, factor, frames,
+        tiles, background
+    )
+    if region.single_tile is not None:
+        return region.single_tile
+
+    io_executor = get_io_executor()
+    # Frames are decoded on the I/O pool if parallel decoding is disabled.
+    decode_executor = get_decode_executor() or io_executor
+
+    async def _read(item):
+        frame = await loop.run_in_executor(io_executor, _in_context(region.read_frame, item))
+        await loop.run_in_executor(decode_executor, region.decode_and_paste, item, frame)
+        count('frames_decoded')
+
+    tasks = [asyncio.ensure_future(_read(item)) for item in region.missing]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Abort the outstanding reads on cancellation or error.
+        for task in tasks:
+            task.cancel()
+        raise
+    return region.out
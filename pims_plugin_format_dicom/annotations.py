@@ -0,0 +1,169 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Conversion of Microscopy Bulk Simple Annotations to shapely geometries.
+
+Annotation groups are read from the datasets of the annotation files, without
+building the wsidicom geometries of each annotation: the coordinates of a
+group are read as a single NumPy array from the binary coordinate data,
+converted to pixels at once, and geometries are built in bulk by shapely.
+Geometries can be spatially indexed to query the annotations of a region.
+"""
+
+import logging
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import shapely
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+
+log = logging.getLogger("pims.formats")
+
+Bounds = Tuple[float, float, float, float]
+
+CHUNK_SIZE = 10000
+
+GRAPHIC_TYPES = ('POINT', 'POLYLINE', 'POLYGON')
+
+
+def read_annotation_groups(path: Union[str, Path]) -> List[Dataset]:
+    """Read the annotation group datasets of a Microscopy Bulk Simple Annotations file."""
+    return list(dcmread(path).get('AnnotationGroupSequence', []))
+
+
+def group_coordinates(group: Dataset) -> np.ndarray:
+    """
+    Get the (x, y) coordinates of all the annotations of a group, as a (N, 2)
+    array, read as pairs as wsidicom does.
+    """
+    if 'DoublePointCoordinatesData' in group:
+        data, dtype = group.DoublePointCoordinatesData, '<f8'
+    else:
+        data, dtype = group.PointCoordinatesData, '<f4'
+    return np.frombuffer(data, dtype=dtype).reshape(-1, 2)
+
+
+def group_offsets(group: Dataset, n_coordinates: int) -> np.ndarray:
+    """
+    Get the offsets of the annotations of a group in its coordinate array:
+    annotation `i` spans coordinates `offsets[i]:offsets[i + 1]`.
+    """
+    if group.GraphicType == 'POINT':
+        return np.arange(n_coordinates + 1)
+
+    # Point indices are 1-based and relative to the non-paired coordinates.
+    indices = np.frombuffer(group.LongPrimitivePointIndexList, dtype='<i4')
+    starts = (indices.astype(np.int64) - 1) // 2
+    return np.append(starts, n_coordinates)
+
+
+def to_pixels(coordinates: np.ndarray, pixel_spacing: float) -> np.ndarray:
+    """Convert coordinates in mm to (truncated) pixel coordinates."""
+    return (coordinates / pixel_spacing).astype(np.int64)
+
+
+def build_geometries(graphic_type: str, coordinates: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Build the geometries whose coordinates are delimited by offsets (starting at 0)."""
+    if graphic_type == 'POINT':
+        return shapely.points(coordinates)
+
+    indices = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    if graphic_type == 'POLYLINE':
+        return shapely.linestrings(coordinates, indices=indices)
+    # Rings are closed by shapely if needed.
+    return shapely.polygons(shapely.linearrings(coordinates, indices=indices))
+
+
+def iter_group_geometries(
+    group: Dataset, pixel_spacing: float, chunk_size: int = CHUNK_SIZE
+) -> Iterator[np.ndarray]:
+    """Iterate over the geometries (in pixels) of an annotation group dataset, by chunks."""
+    graphic_type = group.get('GraphicType')
+    if graphic_type not in GRAPHIC_TYPES:
+        log.warning(f"Unsupported DICOM annotation type {graphic_type} is ignored")
+        return
+
+    coordinates = to_pixels(group_coordinates(group), pixel_spacing)
+    offsets = group_offsets(group, len(coordinates))
+    for start in range(0, len(offsets) - 1, chunk_size):
+        chunk_offsets = offsets[start:start + chunk_size + 1]
+        yield build_geometries(
+            graphic_type,
+            coordinates[chunk_offsets[0]:chunk_offsets[-1]],
+            chunk_offsets - chunk_offsets[0]
+        )
+
+
+def iter_geometries(
+    paths: Iterable[Union[str, Path]], pixel_spacing: float,
+    chunk_size: int = CHUNK_SIZE
+) -> Iterator[np.ndarray]:
+    """Iterate over the geometries (in pixels) of all the annotation groups of files, by chunks."""
+    for path in paths:
+        for group in read_annotation_groups(path):
+            yield from iter_group_geometries(group, pixel_spacing, chunk_size)
+
+
+class AnnotationIndex:
+    """
+    Spatial index of the annotations of a slide, in pixels. Each annotation
+    group has its bounding box and a STRtree of its geometries, so that a
+    query only visits the groups and the annotations intersecting a region.
+    """
+
+    def __init__(self, groups: List[np.ndarray]):
+        self._groups = [
+            (geometries, shapely.total_bounds(geometries), shapely.STRtree(geometries))
+            for geometries in groups if len(geometries)
+        ]
+
+    @classmethod
+    def build(
+        cls, paths: Iterable[Union[str, Path]], pixel_spacing: float
+    ) -> 'AnnotationIndex':
+        """Build the index of the annotations of the annotation files at `paths`."""
+        groups = []
+        for path in paths:
+            for group in read_annotation_groups(path):
+                chunks = list(iter_group_geometries(group, pixel_spacing))
+                if chunks:
+                    groups.append(np.concatenate(chunks))
+        return cls(groups)
+
+    def __len__(self) -> int:
+        return sum(len(geometries) for geometries, _, _ in self._groups)
+
+    def query(self, bounds: Optional[Bounds] = None) -> Iterator[np.ndarray]:
+        """
+        Iterate over the geometries intersecting the (min_x, min_y, max_x, max_y)
+        bounds, group by group, in their original order. All geometries are
+        given if bounds are None.
+        """
+        if bounds is None:
+            for geometries, _, _ in self._groups:
+                yield geometries
+            return
+
+        min_x, min_y, max_x, max_y = bounds
+        box = shapely.box(*bounds)
+        for geometries, group_bounds, tree in self._groups:
+            if group_bounds[0] > max_x or group_bounds[2] < min_x or \
+                    group_bounds[1] > max_y or group_bounds[3] < min_y:
+                continue
+            hits = tree.query(box, predicate='intersects')
+            if len(hits):
+                yield geometries[np.sort(hits)]
@@ -0,0 +1,176 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Chunked array views of the pyramid levels of a slide.
+
+A level array is a lazily evaluated, NumPy-like array of shape (height,
+width[, channels]), chunked along the native tiles of the level. Indexing
+it reads and decodes only the intersecting frames (through the frame index
+and the tile cache), so that chunk-aligned reads decode each frame once.
+
+Level arrays only hold the slide path and the plane to read: they can be
+pickled to worker processes, which open the slide on first read through
+their own process-wide caches. The slide is leased from the slide cache
+for each read. `to_dask` wraps a level array in a dask
+array with the same chunks.
+"""
+
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from pims_plugin_format_dicom.cache import SlideCache, get_slide_cache, get_tile_cache
+from pims_plugin_format_dicom.config import get_settings
+from pims_plugin_format_dicom.frames import get_frame_index
+from pims_plugin_format_dicom.tiles import Plane, get_decode_executor, nearest_focal_plane, read_planes
+
+
+def _chunks(size: int, chunk_size: int) -> Tuple[int, ...]:
+    return (chunk_size,) * (size // chunk_size) + ((size % chunk_size,) if size % chunk_size else ())
+
+
+class LevelArray:
+    """A lazily read pyramid level of a slide, chunked along its native tiles."""
+
+    def __init__(
+        self, path: str, level: int, size: Tuple[int, int], tile_size: Tuple[int, int],
+        samples_per_pixel: int, z: Optional[float] = None,
+        optical_paths: Sequence[Optional[str]] = (None,), dtype=np.uint8
+    ):
+        """
+        A view of the `level` (wsidicom pyramid level) of the slide at `path`,
+        of `size` and `tile_size` (width, height), at focal plane `z`, with
+        the optical paths stacked along channels. The default focal plane
+        and optical path of the level are read if None. `dtype` is the dtype
+        of the decoded frames.
+        """
+        self.path = str(path)
+        self.level = level
+        self.z = z
+        self.optical_paths = list(optical_paths)
+        self.dtype = np.dtype(dtype)
+
+        width, height = size
+        n_channels = samples_per_pixel * len(self.optical_paths)
+        self.shape = (height, width) if n_channels == 1 else (height, width, n_channels)
+        self.chunk_shape = (tile_size[1], tile_size[0]) + self.shape[2:]
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self) -> int:
+        return self.size * self.dtype.itemsize
+
+    @property
+    def chunks(self) -> Tuple[Tuple[int, ...], ...]:
+        """Chunk sizes along each axis, as for dask arrays."""
+        return tuple(_chunks(size, chunk) for size, chunk in zip(self.shape, self.chunk_shape))
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}({self.path}, level={self.level}, shape={self.shape}, "
+            f"chunks={self.chunk_shape})"
+        )
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def _planes(self, wsi):
+        wsi_level = wsi.levels.get_level(self.level)
+        focal_plane = None if self.z is None else nearest_focal_plane(wsi_level.focal_planes, self.z)
+        planes = []
+        for optical_path in self.optical_paths:
+            image_data = wsi_level.get_instance(focal_plane, optical_path).image_data
+            z = image_data.default_z if focal_plane is None else focal_plane
+            path = image_data.default_path if optical_path is None else optical_path
+            planes.append((image_data, z, path))
+        return planes
+
+    def _read(self, planes: Sequence[Plane], left: int, top: int, width: int, height: int) -> np.ndarray:
+        if width <= 0 or height <= 0:
+            return np.empty((max(0, height), max(0, width)) + self.shape[2:], dtype=self.dtype)
+        settings = get_settings()
+        slide_key = SlideCache.key(self.path)
+        pixels = read_planes(
+            planes, left, top, width, height, executor=get_decode_executor(),
+            cache=get_tile_cache(),
+            cache_keys=[slide_key + (self.level, z, path) for _, z, path in planes],
+            frames=get_frame_index(self.path) if settings.frame_index_enabled else None
+        )
+        return pixels.astype(self.dtype, copy=False)
+
+    def __getitem__(self, key) -> np.ndarray:
+        """Read a region with basic indexing (integers and slices of any step)."""
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        if len(key) > self.ndim:
+            raise IndexError(f"Too many indices for an array of {self.ndim} dimensions")
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        bounds, steps, squeeze = [], [], []
+        for axis, (k, size) in enumerate(zip(key[:2], self.shape[:2])):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step < 0:
+                    raise IndexError("Negative steps are not supported")
+                bounds.append((start, max(start, stop)))
+                steps.append(step)
+            else:
+                index = int(k)
+                if not -size <= index < size:
+                    raise IndexError(f"Index {index} is out of bounds for axis {axis} with size {size}")
+                index %= size
+                bounds.append((index, index + 1))
+                steps.append(1)
+                squeeze.append(axis)
+
+        (top, bottom), (left, right) = bounds
+        with get_slide_cache().lease(self.path) as wsi:
+            pixels = self._read(self._planes(wsi), left, top, right - left, bottom - top)
+        pixels = pixels[::steps[0], ::steps[1]]
+        if squeeze:
+            pixels = pixels[tuple(0 if axis in squeeze else slice(None) for axis in range(2))]
+        if self.ndim == 3:
+            pixels = pixels[(Ellipsis, key[2])]
+        return pixels
+
+    def read_chunk(self, cy: int, cx: int) -> np.ndarray:
+        """Read the chunk (native tile) at row `cy` and column `cx` of the chunk grid."""
+        chunk_height, chunk_width = self.chunk_shape[:2]
+        return self[cy * chunk_height:(cy + 1) * chunk_height, cx * chunk_width:(cx + 1) * chunk_width]
+
+    def __array__(self, dtype=None) -> np.ndarray:
+        pixels = self[...]
+        return pixels if dtype is None else pixels.astype(dtype, copy=False)
+
+    def to_dask(self):
+        """Get a dask array reading this level, with the same chunks. Requires dask."""
+        import dask.array as da
+
+        planes = '-'.join(map(str, [self.z] + self.optical_paths))
+        name = f"wsidicom-{self.path}-{SlideCache.key(self.path)[1]}-{self.level}-{planes}"
+        return da.from_array(
+            self, chunks=self.chunks, name=name, asarray=False, fancy=False,
+            meta=np.empty((0,) * self.ndim, dtype=self.dtype)
+        )
@@ -0,0 +1,502 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from wsidicom.wsidicom import WsiDicom
+
+from pims_plugin_format_dicom.config import get_settings
+from pims_plugin_format_dicom.metrics import count
+from pims_plugin_format_dicom.slide import LazySlide, open_wsi_dicom
+
+log = logging.getLogger("pims.formats")
+
+SlideKey = Tuple[str, int]
+
+
+def _close_series(series_list):
+    for series in series_list:
+        series.close()
+
+
+def _count_files(slide: WsiDicom) -> int:
+    return len(slide.files)
+
+
+class _CachedSlide:
+    """An opened slide of the cache, with its number of files and of leases."""
+    __slots__ = ('slide', 'close', 'n_files', 'leases', 'evicted')
+
+    def __init__(self, slide: WsiDicom, close: Callable[[], None], n_files: int):
+        self.slide = slide
+        self.close = close
+        self.n_files = n_files
+        self.leases = 0
+        self.evicted = False
+
+
+class SlideCache:
+    """
+    Process-wide LRU cache of opened WsiDicom slides.
+
+    Slides are keyed by path and directory modification time, so that a
+    modified slide directory is opened again. The cache is bounded both by a
+    number of slides and by a number of open files. Slides are used through
+    leases (see `lease`): an evicted slide is closed as soon as no lease on
+    it is held anymore, i.e. at once if it is not being read.
+    """
+
+    def __init__(
+        self, max_slides: int, max_files: int,
+        opener: Callable[[str], WsiDicom] = WsiDicom.open,
+        file_counter: Callable[[WsiDicom], int] = _count_files
+    ):
+        self.max_slides = max_slides
+        self.max_files = max_files
+        self._opener = opener
+        self._file_counter = file_counter
+
+        self._lock = threading.Lock()
+        self._slides: "OrderedDict[SlideKey, _CachedSlide]" = OrderedDict()
+        self._n_files = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_slides > 0
+
+    @staticmethod
+    def key(path: str) -> SlideKey:
+        return path, os.stat(path).st_mtime_ns
+
+    def _open(self, path: str) -> Tuple[WsiDicom, Callable[[], None]]:
+        """Open a slide, and get the function closing it (at most once)."""
+        slide = self._opener(path)
+        # Slides used without lease are closed once garbage-collected.
+        return slide, weakref.finalize(slide, _close_series, [slide.levels, slide.labels, slide.overviews])
+
+    def get(self, path: str) -> WsiDicom:
+        """
+        Get an opened slide, without a lease: it is closed if evicted while
+        still in use. Readers should hold a lease instead, see `lease`.
+        """
+        return self._acquire(path, lease=False)[0]
+
+    @contextmanager
+    def lease(self, path: str) -> Iterator[WsiDicom]:
+        """
+        Use an opened slide, that is not closed before the end of the lease
+        even if evicted meanwhile. If the cache is disabled, the slide is
+        opened for the lease only.
+        """
+        slide, entry = self._acquire(path, lease=True)
+        try:
+            yield slide
+        finally:
+            self._release(entry)
+
+    def _acquire(self, path: str, lease: bool) -> Tuple[WsiDicom, _CachedSlide]:
+        if not self.enabled:
+            count('slide_cache_misses')
+            entry = _CachedSlide(*self._open(path), n_files=0)
+            entry.leases, entry.evicted = int(lease), True
+            return entry.slide, entry
+
+        key = self.key(path)
+        with self._lock:
+            entry = self._slides.get(key)
+            if entry is not None:
+                self._slides.move_to_end(key)
+                entry.leases += lease
+                self.hits += 1
+                count('slide_cache_hits')
+                return entry.slide, entry
+            self.misses += 1
+        count('slide_cache_misses')
+
+        # Open outside the lock so that other slides can be served meanwhile.
+        opened = _CachedSlide(*self._open(path), n_files=0)
+        opened.n_files = self._file_counter(opened.slide)
+
+        with self._lock:
+            entry = self._slides.get(key)
+            if entry is not None:
+                # Opened concurrently by another request, keep the first one.
+                self._slides.move_to_end(key)
+                evicted = [opened]
+            else:
+                entry = opened
+                self._slides[key] = entry
+                self._n_files += entry.n_files
+                evicted = self._evict()
+            entry.leases += lease
+        for other in evicted:
+            other.close()
+        return entry.slide, entry
+
+    def _release(self, entry: _CachedSlide):
+        with self._lock:
+            entry.leases -= 1
+            close = entry.evicted and entry.leases == 0
+        if close:
+            entry.close()
+
+    def _evict(self) -> List[_CachedSlide]:
+        """Evict slides over budget, and get those to close (not leased anymore)."""
+        evicted = []
+        # Always keep the most recent slide, even if it exceeds the budget.
+        while len(self._slides) > 1 and (
+            len(self._slides) > self.max_slides or self._n_files > self.max_files
+        ):
+            (path, _), entry = self._slides.popitem(last=False)
+            self._n_files -= entry.n_files
+            entry.evicted = True
+            if entry.leases == 0:
+                evicted.append(entry)
+            self.evictions += 1
+            log.debug(f"Evict WSI DICOM slide {path} from slide cache")
+        return evicted
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._slides.values())
+            self._slides.clear()
+            self._n_files = 0
+            for entry in entries:
+                entry.evicted = True
+            evicted = [entry for entry in entries if entry.leases == 0]
+        for entry in evicted:
+            entry.close()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'slides': len(self._slides),
+                'files': self._n_files,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+@lru_cache()
+def get_slide_cache() -> SlideCache:
+    settings = get_settings()
+    opener = LazySlide.open if settings.lazy_open_enabled else open_wsi_dicom
+    # With the frame index, frame positions are parsed on first use, see frames.FrameIndex.
+    opener = partial(opener, parse_pixel_data=False if settings.frame_index_enabled else None)
+    return SlideCache(settings.slide_cache_max_slides, settings.slide_cache_max_files, opener=opener)
+
+
+class TileCache:
+    """
+    In-process LRU cache of decoded tiles, bounded by a memory budget in bytes.
+    Cached arrays are read-only.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._tiles: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._n_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key: Hashable, tile: np.ndarray) -> np.ndarray:
+        """
+        Cache a tile, as a read-only view, and get that view. The array of the
+        caller is left writable, but must not be written once cached.
+        """
+        if tile.nbytes > self.max_bytes:
+            return tile
+        tile = tile.view()
+        tile.setflags(write=False)
+        with self._lock:
+            previous = self._tiles.pop(key, None)
+            if previous is not None:
+                self._n_bytes -= previous.nbytes
+            self._tiles[key] = tile
+            self._n_bytes += tile.nbytes
+            while self._n_bytes > self.max_bytes:
+                _, evicted = self._tiles.popitem(last=False)
+                self._n_bytes -= evicted.nbytes
+                self.evictions += 1
+        return tile
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._n_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'tiles': len(self._tiles),
+                'bytes': self._n_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class SharedTileCache:
+    """
+    Cache of decoded tiles living in a memory-mapped arena (typically in
+    /dev/shm), shared by all PIMS worker processes of a node.
+
+    The arena is a direct-mapped table of fixed-size slots: a tile goes in the
+    slot given by the hash of its key and replaces any previous tile there.
+    Writers lock the slot byte range (fcntl), readers are lock-free and use
+    the slot sequence number to detect concurrent writes. Tiles of any
+    numeric dtype are cached, tiles larger than a slot are skipped.
+    """
+    MAGIC = b"PIMSWSIDCMTILES2"
+    FILE_HEADER = struct.Struct("<16sQQ")  # magic, n_slots, slot_size
+    # digest, sequence, height, width, channels, dtype (NumPy type string, e.g. '<u2')
+    SLOT_HEADER = struct.Struct("<16sQIII8s")
+    HEADER_SIZE = 64
+
+    def __init__(self, path: str, max_bytes: int, slot_size: int):
+        self.path = path
+        self.slot_size = slot_size
+        self.n_slots = max(1, max_bytes // slot_size)
+        self.payload_size = slot_size - self.HEADER_SIZE
+
+        size = self.HEADER_SIZE + self.n_slots * slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._mm = self._map(size)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+        self.hits = 0
+        self.misses = 0
+        self.skips = 0
+
+    def _map(self, size: int) -> mmap.mmap:
+        # The arena header is locked so that only one process initializes it.
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.HEADER_SIZE, 0)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            mm = mmap.mmap(self._fd, size)
+            magic, n_slots, slot_size = self.FILE_HEADER.unpack_from(mm, 0)
+            if magic != self.MAGIC:
+                # New arena, or slots of another version to drop.
+                for slot in range(self.n_slots):
+                    offset = self.HEADER_SIZE + slot * self.slot_size
+                    mm[offset:offset + self.HEADER_SIZE] = bytes(self.HEADER_SIZE)
+                self.FILE_HEADER.pack_into(mm, 0, self.MAGIC, self.n_slots, self.slot_size)
+            elif (n_slots, slot_size) != (self.n_slots, self.slot_size):
+                mm.close()
+                raise ValueError(
+                    f"Shared tile cache {self.path} has another layout "
+                    f"({n_slots} slots of {slot_size} bytes)"
+                )
+            return mm
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.HEADER_SIZE, 0)
+
+    @staticmethod
+    def _digest(key: Hashable) -> bytes:
+        # Keys must hash identically in every process, so no builtin hash().
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+    def _slot_offset(self, digest: bytes) -> int:
+        slot = int.from_bytes(digest[:8], 'little') % self.n_slots
+        return self.HEADER_SIZE + slot * self.slot_size
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        digest = self._digest(key)
+        offset = self._slot_offset(digest)
+
+        stored_digest, sequence, height, width, channels, dtype = \
+            self.SLOT_HEADER.unpack_from(self._mm, offset)
+        if stored_digest != digest or sequence % 2:
+            self.misses += 1
+            return None
+
+        dtype = np.dtype(dtype.rstrip(b"\0").decode())
+        n_bytes = height * width * max(channels, 1) * dtype.itemsize
+        start = offset + self.HEADER_SIZE
+        data = self._mm[start:start + n_bytes]
+
+        if self.SLOT_HEADER.unpack_from(self._mm, offset)[:2] != (digest, sequence):
+            # Overwritten while reading.
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        shape = (height, width, channels) if channels else (height, width)
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+    def put(self, key: Hashable, tile: np.ndarray) -> np.ndarray:
+        """Cache a copy of a tile, and get the tile."""
+        if tile.dtype.kind not in 'biufc' or tile.nbytes > self.payload_size:
+            self.skips += 1
+            count('tile_cache_skips')
+            return tile
+        digest = self._digest(key)
+        offset = self._slot_offset(digest)
+        height, width = tile.shape[:2]
+        channels = tile.shape[2] if tile.ndim == 3 else 0
+
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slot_size, offset)
+        try:
+            sequence = self.SLOT_HEADER.unpack_from(self._mm, offset)[1]
+            # Odd sequence number marks the slot as being written.
+            self.SLOT_HEADER.pack_into(self._mm, offset, b"\0" * 16, sequence + 1, 0, 0, 0, b"")
+            start = offset + self.HEADER_SIZE
+            self._mm[start:start + tile.nbytes] = np.ascontiguousarray(tile).tobytes()
+            self.SLOT_HEADER.pack_into(
+                self._mm, offset, digest, sequence + 2, height, width, channels,
+                tile.dtype.str.encode()
+            )
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+        return tile
+
+    def clear(self):
+        for slot in range(self.n_slots):
+            offset = self.HEADER_SIZE + slot * self.slot_size
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                sequence = self.SLOT_HEADER.unpack_from(self._mm, offset)[1]
+                self.SLOT_HEADER.pack_into(
+                    self._mm, offset, b"\0" * 16, sequence + 2, 0, 0, 0, b""
+                )
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'slots': self.n_slots,
+            'bytes': self.n_slots * self.slot_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'skips': self.skips,
+        }
+
+
+@lru_cache()
+def get_tile_cache() -> Optional[Union[TileCache, SharedTileCache]]:
+    settings = get_settings()
+    if settings.tile_cache_max_bytes <= 0:
+        return None
+
+    if settings.tile_cache_shared:
+        try:
+            return SharedTileCache(
+                settings.tile_cache_shared_path,
+                settings.tile_cache_max_bytes,
+                settings.tile_cache_slot_size
+            )
+        except (OSError, ValueError) as e:
+            log.warning(f"Shared tile cache unavailable, fall back on process cache: {e}")
+    return TileCache(settings.tile_cache_max_bytes)
+
+
+@lru_cache()
+def get_associated_cache() -> Optional[TileCache]:
+    max_bytes = get_settings().associated_cache_max_bytes
+    if max_bytes <= 0:
+        return None
+    return TileCache(max_bytes)
+
+
+class ObjectCache:
+    """
+    Process-wide LRU cache of objects computed once per slide (e.g. spatial
+    indexes), bounded by a number of entries.
+    """
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        if self.max_items <= 0:
+            return factory()
+
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+
+        # Computed outside the lock so that other slides can be served meanwhile.
+        item = factory()
+        with self._lock:
+            self._items[key] = item
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+        return item
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'items': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+@lru_cache()
+def get_annotation_index_cache() -> ObjectCache:
+    return ObjectCache(get_settings().annotation_index_cache_max_slides)
+
+
+@lru_cache()
+def get_histogram_cache() -> ObjectCache:
+    return ObjectCache(get_settings().histogram_cache_max_slides)
@@ -0,0 +1,112 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+from functools import lru_cache
+
+from pydantic import BaseSettings, Extra
+
+
+class Settings(BaseSettings):
+    """
+    Plugin settings. They are read from the PIMS configuration file, using
+    the `WSIDICOM_` prefix (e.g. `WSIDICOM_SLIDE_CACHE_MAX_SLIDES=64`).
+    """
+    # Process-wide cache of opened slides. 0 disables the cache.
+    slide_cache_max_slides: int = 32
+    slide_cache_max_files: int = 512
+
+    # Open the levels, labels, overviews and annotations of slides on first
+    # use, from a minimal header of their files, see `slide`.
+    lazy_open_enabled: bool = True
+
+    # Persistent metadata index written next to each slide.
+    index_enabled: bool = True
+
+    # Frame positions computed on first use (and persisted next to each slide
+    # if the index is enabled), and read with positional reads.
+    frame_index_enabled: bool = True
+    # Frames read together are sorted by file offset, and frames at most
+    # `frame_read_max_gap` bytes apart are read in a single read of at most
+    # `frame_read_max_size` bytes.
+    frame_read_max_gap: int = 64 * 1024
+    frame_read_max_size: int = 16 * 1024 * 1024
+
+    # Threads shared by all requests to decode frames of large windows.
+    # 0 or 1 disables parallel decoding.
+    decode_workers: int = min(4, os.cpu_count() or 1)
+    parallel_decode_min_tiles: int = 8
+
+    # Tiles read and decoded together by batched tile reads.
+    tile_batch_size: int = 64
+
+    # Threads doing the blocking file I/O of asynchronous reads.
+    io_workers: int = 8
+
+    # Decode windows read between two pyramid levels at a reduced resolution
+    # (JPEG DCT scaling, JPEG 2000 resolution levels).
+    reduced_decoding: bool = True
+
+    # Cache of decoded tiles. 0 disables the cache. When shared, the cache
+    # is a memory-mapped arena used by all worker processes of the node.
+    tile_cache_max_bytes: int = 256 * 1024 * 1024
+    tile_cache_shared: bool = False
+    tile_cache_shared_path: str = "/dev/shm/pims-wsidicom-tiles"
+    tile_cache_slot_size: int = 1024 * 1024
+
+    # Cache of label and macro images resized for a given output size.
+    associated_cache_max_bytes: int = 64 * 1024 * 1024
+
+    # Return NumPy arrays (possibly read-only) instead of PIL images from
+    # thumbnail, label and macro reads. Windows within a single tile are
+    # returned as views of the decoded tile.
+    numpy_output: bool = False
+
+    # Largest side of the precomputed thumbnail written next to each slide.
+    # 0 disables precomputed thumbnails.
+    thumbnail_size: int = 512
+
+    # Pixel budget of the histograms computed from stored frames: the finest
+    # pyramid level within the budget is used, or frames of the coarsest
+    # level are sampled.
+    histogram_max_pixels: int = 4096 * 4096
+    # Histograms of slides kept in memory. 0 disables the cache.
+    histogram_cache_max_slides: int = 32
+
+    # Background prefetching of the tiles likely to be read next by viewers.
+    prefetch_enabled: bool = False
+    prefetch_workers: int = 1
+    prefetch_max_pending: int = 32
+    prefetch_max_tiles: int = 8
+
+    # Spatial indexes of slide annotations kept in memory, used by
+    # region-filtered annotation queries. 0 disables the cache.
+    annotation_index_cache_max_slides: int = 8
+
+    # Instrumentation of slide opening, parsing and reading, see `metrics`.
+    # Operations slower than the threshold (in seconds, 0 disables it) are logged.
+    metrics_enabled: bool = False
+    metrics_slow_operation_seconds: float = 1.0
+
+    class Config:
+        env_prefix = "WSIDICOM_"
+        env_file = "pims-config.env"
+        env_file_encoding = "utf-8"
+        extra = Extra.ignore
+
+
+@lru_cache()
+def get_settings() -> Settings:
+    env_file = os.getenv("CONFIG_FILE", "pims-config.env")
+    return Settings(_env_file=env_file)
@@ -1,56 +1,230 @@
+import logging
 import os
+import struct
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from copy import copy
 from datetime import datetime
-from functools import cached_property
+from functools import cached_property, partial
 from pathlib import Path
-from typing import List, Optional
-
-import shapely
-from pydicom.multival import MultiValue
-from wsidicom.graphical_annotations import Point as WsiPoint
-from wsidicom.graphical_annotations import Polygon as WsiPolygon
+from itertools import groupby
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image as PILImage
+from pydicom.uid import JPEGBaseline8Bit
+from pyvips import Image as VIPSImage
+from wsidicom.geometry import Size
+from wsidicom.uid import WSI_SOP_CLASS_UID
 from wsidicom.wsidicom import WsiDicom
 
 from pims.formats.utils.abstract import AbstractChecker, AbstractParser, AbstractReader, AbstractFormat, CachedDataPath
-from pims.formats.utils.histogram import DefaultHistogramReader
+from pims.api.utils.models import HistogramType
+from pims.formats.utils.histogram import AbstractHistogramReader
 from pims.formats.utils.structures.annotations import ParsedMetadataAnnotation
 from pims.formats.utils.structures.metadata import ImageMetadata, ImageChannel
 from pims.formats.utils.structures.pyramid import Pyramid
+from pims.processing.region import Region, Tile
 from pims.utils import UNIT_REGISTRY
 from pims.utils.dtypes import np_dtype
 from pims.utils.types import parse_float
+from pims_plugin_format_dicom.aio import read_planes_async, run_io
+from pims_plugin_format_dicom.annotations import CHUNK_SIZE, AnnotationIndex, iter_geometries
+from pims_plugin_format_dicom.arrays import LevelArray
+from pims_plugin_format_dicom.cache import (
+    SlideCache, get_annotation_index_cache, get_associated_cache, get_histogram_cache,
+    get_slide_cache, get_tile_cache
+)
+from pims_plugin_format_dicom.config import get_settings
+from pims_plugin_format_dicom.frames import FrameIndex, get_frame_index
+from pims_plugin_format_dicom.histogram import (
+    SlideHistogram, compute_histogram, histogram_error, plan_histogram
+)
+from pims_plugin_format_dicom.index import (
+    SlideIndex, build_index, load_index, load_thumbnail, write_index, write_thumbnail
+)
+from pims_plugin_format_dicom.metadata import DatasetMetadata
+from pims_plugin_format_dicom.metrics import instrumented, set_level
+from pims_plugin_format_dicom.prefetch import get_prefetcher
+from pims_plugin_format_dicom.slide import annotation_files
+from pims_plugin_format_dicom.tiles import (
+    geometry_tiles, get_decode_executor, nearest_focal_plane, read_associated, read_frames,
+    read_planes, read_thumbnail, read_tiles, reduction_factor, tile_range
+)
+
+log = logging.getLogger("pims.formats")
+
+# Transfer syntaxes whose stored frames can be handed over as-is to libvips.
+PASSTHROUGH_TRANSFER_SYNTAXES = (JPEGBaseline8Bit,)
+
 
+@instrumented('open_slide')
+def open_slide(path: str, stack: Optional[ExitStack] = None) -> WsiDicom:
+    """Open a slide through the slide cache, leased until `stack` is closed if given."""
+    cache = get_slide_cache()
+    if stack is None:
+        return cache.get(path)
+    return stack.enter_context(cache.lease(path))
 
-def dictify(ds):
-    output = dict()
-    for elem in ds:
-        if elem.VR != 'SQ':
-            output[elem.name] = elem.value
-        else:
-            output[elem.name] = [dictify(item) for item in elem]
-    return output
 
+@contextmanager
+def leased_slide(format: AbstractFormat) -> Iterator[WsiDicom]:
+    """
+    Use the slide of a format for the duration of an operation, so that it
+    is not closed meanwhile if evicted from the slide cache (see
+    `SlideCache.lease`). Without slide cache, the slide of a format is
+    opened once.
+    """
+    if not get_slide_cache().enabled:
+        yield format.get_cached('_wsi_dicom', open_slide, str(format.path))
+        return
+    with ExitStack() as stack:
+        yield open_slide(str(format.path), stack)
 
-def recurse_if_SQ(ds):
-    list_ds = []
 
-    for data_element in ds:
-        if data_element.VR != 'SQ':
-            list_ds.append(data_element)
+@asynccontextmanager
+async def leased_slide_async(format: AbstractFormat) -> AsyncIterator[WsiDicom]:
+    """Asynchronous variant of `leased_slide`, opening the slide on the I/O pool."""
+    lease = leased_slide(format)
+    wsi = await run_io(lease.__enter__)
+    try:
+        yield wsi
+    finally:
+        lease.__exit__(None, None, None)
 
-        else:
-            for elmt in data_element:
-                list_recursive = recurse_if_SQ(elmt)
-                list_ds.extend(list_recursive)
-    return list_ds
+
+def _get_dataset_metadata(format: AbstractFormat) -> DatasetMetadata:
+    with leased_slide(format) as wsi:
+        return DatasetMetadata(wsi.levels.base_level.datasets[0])
+
+
+def cached_dataset_metadata(format: AbstractFormat) -> DatasetMetadata:
+    return format.get_cached('_wsi_dicom_metadata', _get_dataset_metadata, format)
+
+
+@instrumented('load_slide_index')
+def _get_slide_index(format: AbstractFormat) -> SlideIndex:
+    use_sidecar = get_settings().index_enabled
+    if use_sidecar:
+        index = load_index(format.path)
+        if index is not None:
+            return index
+
+    with leased_slide(format) as wsi:
+        index = build_index(wsi, format.path, cached_dataset_metadata(format))
+    if use_sidecar:
+        write_index(format.path, index)
+    return index
+
+
+def cached_slide_index(format: AbstractFormat) -> SlideIndex:
+    return format.get_cached('_wsi_dicom_index', _get_slide_index, format)
+
+
+def _get_precomputed_thumbnail(format: AbstractFormat) -> PILImage.Image:
+    thumb = load_thumbnail(format.path)
+    if thumb is None:
+        with leased_slide(format) as wsi:
+            thumb = read_thumbnail(wsi, get_settings().thumbnail_size)
+        write_thumbnail(format.path, thumb)
+    return thumb
 
 
-def cached_wsi_dicom_file(format: AbstractFormat) -> WsiDicom:
-    return format.get_cached('_wsi_dicom', WsiDicom.open, str(format.path))
+def cached_precomputed_thumbnail(format: AbstractFormat) -> PILImage.Image:
+    return format.get_cached('_wsi_dicom_thumb', _get_precomputed_thumbnail, format)
+
+
+def _get_precomputed_thumbnail_array(format: AbstractFormat) -> np.ndarray:
+    thumb = np.asarray(cached_precomputed_thumbnail(format))
+    thumb.setflags(write=False)
+    return thumb
+
+
+def cached_precomputed_thumbnail_array(format: AbstractFormat) -> np.ndarray:
+    return format.get_cached('_wsi_dicom_thumb_array', _get_precomputed_thumbnail_array, format)
+
+
+def _build_annotation_index(format: AbstractFormat) -> AnnotationIndex:
+    with leased_slide(format) as wsi:
+        pixel_spacing = wsi.levels.base_level.pixel_spacing.width
+        return AnnotationIndex.build(annotation_files(wsi, format.path), pixel_spacing)
+
+
+def _get_annotation_index(format: AbstractFormat) -> AnnotationIndex:
+    key = SlideCache.key(str(format.path))
+    return get_annotation_index_cache().get(key, lambda: _build_annotation_index(format))
+
+
+def cached_annotation_index(format: AbstractFormat) -> AnnotationIndex:
+    return format.get_cached('_wsi_dicom_annotation_index', _get_annotation_index, format)
+
+
+def frame_index(format: AbstractFormat) -> Optional[FrameIndex]:
+    if not get_settings().frame_index_enabled:
+        return None
+    return get_frame_index(str(format.path))
+
+
+def _compute_histogram(format: AbstractFormat, max_pixels: Optional[int]) -> np.ndarray:
+    # Levels are chosen from the index so that only the chosen one is opened.
+    index = cached_slide_index(format)
+    levels = index['levels']
+    level, tiles = plan_histogram([
+        (Size(entry['width'], entry['height']), Size(entry['tile_width'], entry['tile_height']))
+        for entry in levels
+    ], max_pixels)
+
+    with leased_slide(format) as wsi:
+        wsi_level = wsi.levels.get_level(levels[level]['level'])
+        image_data = wsi_level.default_instance.image_data
+        focal_planes = index['focal_planes'] or [image_data.default_z]
+        optical_paths = index['optical_paths'] or [image_data.default_path]
+        planes = []
+        for z in focal_planes:
+            z = nearest_focal_plane(wsi_level.focal_planes, z)
+            planes.append([(wsi_level.get_instance(z, path).image_data, z, path) for path in optical_paths])
+
+        workers = max(1, get_settings().decode_workers)
+        return compute_histogram(
+            planes, tiles, 2 ** min(format.main_imd.significant_bits, 16),
+            index['width'] * index['height'], executor=get_decode_executor(),
+            batch_size=4 * workers, frames=frame_index(format)
+        )
+
+
+def _get_slide_histogram(format: AbstractFormat) -> SlideHistogram:
+    key = SlideCache.key(str(format.path))
+    return get_histogram_cache().get(
+        key, lambda: SlideHistogram(_compute_histogram(format, get_settings().histogram_max_pixels))
+    )
+
+
+def cached_slide_histogram(format: AbstractFormat) -> SlideHistogram:
+    return format.get_cached('_wsi_dicom_histogram', _get_slide_histogram, format)
+
+
+def nested_slide_directory(path) -> Optional[str]:
+    """
+    Get the name of the single subfolder of a directory without any file,
+    as produced by archives wrapping the DICOM files in a folder.
+    Hidden entries (such as sidecar indexes) are ignored.
+    """
+    subdirectory = None
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            if not entry.is_dir() or subdirectory is not None:
+                return None
+            subdirectory = entry.name
+    return subdirectory
 
 
 def get_root_file(path: Path) -> Optional[Path]:
     """Try to get WSI DICOM directory (as it is a multi-file format)."""
     if path.is_dir():
+        nested = nested_slide_directory(path)
+        if nested is not None:
+            return path / nested
         if sum(1 for _ in Path(path).glob('*')):
             for child in path.iterdir():
                 if child.is_dir():
@@ -60,59 +234,114 @@ def get_root_file(path: Path) -> Optional[Path]:
 
 class WSIDicomChecker(AbstractChecker):
     OFFSET = 128
+    # Bytes read to find the SOP Class UID in the file meta information.
+    HEADER_SIZE = 1024
+    # Maximum number of files inspected in a slide directory.
+    SAMPLE_SIZE = 16
 
     @classmethod
     def match(cls, pathlike: CachedDataPath) -> bool:
-        from pims.files.file import Path
         path = pathlike.path
         if os.path.isdir(path):
-            # list_subdir = [f.path for f in os.scandir(path) if os.path.isdir(f)]
-            # if len(list_subdir) == 1:
-            for child in os.listdir(path):
-                # verification on the format signature for each .dcm file
-                complete_path = Path(os.path.join(path, child))
-                cached_child = CachedDataPath(complete_path)
-                buf = cached_child.get_cached('signature', cached_child.path.signature)
-                if not (len(buf) > cls.OFFSET + 4 and
-                        buf[cls.OFFSET] == 0x44 and
-                        buf[cls.OFFSET + 1] == 0x49 and
-                        buf[cls.OFFSET + 2] == 0x43 and
-                        buf[cls.OFFSET + 3] == 0x4D):
-                    return False
-            return True
-            # return False
+            return cls.match_directory(path)
+        return False
+
+    @classmethod
+    def match_directory(cls, path, recurse: bool = True) -> bool:
+        """
+        Check that a directory holds a WSI DICOM slide, by inspecting a bounded
+        sample of its files. Non-DICOM files (e.g. sidecars) are tolerated.
+        """
+        n_files = 0
+        with os.scandir(path) as it:
+            for entry in it:
+                if n_files >= cls.SAMPLE_SIZE:
+                    break
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                n_files += 1
+                if cls.read_sop_class_uid(entry.path) == WSI_SOP_CLASS_UID:
+                    return True
+
+        if recurse and n_files == 0:
+            nested = nested_slide_directory(path)
+            if nested is not None:
+                return cls.match_directory(os.path.join(path, nested), recurse=False)
         return False
 
+    @classmethod
+    def read_sop_class_uid(cls, filepath) -> Optional[str]:
+        """
+        Get the Media Storage SOP Class UID of a DICOM file from a partial
+        header read, or None if the file is not a DICOM file.
+        """
+        try:
+            with open(filepath, 'rb') as f:
+                buf = f.read(cls.HEADER_SIZE)
+        except OSError:
+            return None
+
+        if buf[cls.OFFSET:cls.OFFSET + 4] != b'DICM':
+            return None
+
+        # File meta information is always encoded in explicit VR little endian.
+        pos = cls.OFFSET + 4
+        while pos + 8 <= len(buf):
+            group, element = struct.unpack_from('<HH', buf, pos)
+            if group != 0x0002:
+                break
+            vr = buf[pos + 4:pos + 6]
+            if vr in (b'OB', b'OW', b'OF', b'SQ', b'UN', b'UT'):
+                if pos + 12 > len(buf):
+                    break
+                length = struct.unpack_from('<I', buf, pos + 8)[0]
+                pos += 12
+            else:
+                length = struct.unpack_from('<H', buf, pos + 6)[0]
+                pos += 8
+            if element == 0x0002:
+                if pos + length > len(buf):
+                    # Truncated file.
+                    break
+                return buf[pos:pos + length].rstrip(b'\x00 ').decode('ascii', errors='replace')
+            pos += length
+        return None
+
 
 class WSIDicomParser(AbstractParser):
 
+    @instrumented('parse_main_metadata')
     def parse_main_metadata(self):
-        wsidicom_object = cached_wsi_dicom_file(self.format)
-        levels = wsidicom_object.levels
+        index = cached_slide_index(self.format)
         imd = ImageMetadata()
 
-        imd.width = levels.base_level.size.width
-        imd.height = levels.base_level.size.height
-        metadata = dictify(wsidicom_object.levels.groups[0].datasets[0])
-        if 'Bits Stored' in metadata:
-            imd.significant_bits = metadata["Bits Stored"]
+        imd.width = index['width']
+        imd.height = index['height']
+        if index['bits_stored'] is not None:
+            imd.significant_bits = index['bits_stored']
         else:
             imd.significant_bits = 8
 
         imd.duration = 1
-        if "Samples per Pixel" in metadata:
-            imd.n_samples = metadata["Samples per Pixel"]
-        imd.depth = 1
-        imd.n_concrete_channels = 1
+        if index['samples_per_pixel'] is not None:
+            imd.n_samples = index['samples_per_pixel']
+        imd.depth = max(1, len(index['focal_planes']))
+        imd.n_concrete_channels = max(1, len(index['optical_paths']))
         imd.pixel_type = np_dtype(imd.significant_bits)
-        if "Manufacturer's Model Name" in metadata:
-            imd.microscope.model = metadata["Manufacturer's Model Name"]
-
-        if 'Objective Lens Power' in metadata['Optical Path Sequence'][0]:
-            imd.objective.nominal_magnification = parse_float(
-                metadata['Optical Path Sequence'][0]['Objective Lens Power'])
-
-        if imd.n_channels == 3:
+        if index['model_name'] is not None:
+            imd.microscope.model = index['model_name']
+
+        if index['objective_lens_power'] is not None:
+            imd.objective.nominal_magnification = parse_float(index['objective_lens_power'])
+
+        if imd.n_concrete_channels > 1:
+            # One concrete channel per optical path.
+            for c in range(imd.n_channels):
+                name = index['optical_paths'][c // imd.n_samples]
+                if imd.n_samples > 1:
+                    name = f"{name}-{c % imd.n_samples}"
+                imd.set_channel(ImageChannel(index=c, suggested_name=name))
+        elif imd.n_channels == 3:
             imd.set_channel(ImageChannel(index=0, suggested_name='R'))
             imd.set_channel(ImageChannel(index=1, suggested_name='G'))
             imd.set_channel(ImageChannel(index=2, suggested_name='B'))
@@ -120,96 +349,85 @@ class WSIDicomParser(AbstractParser):
             imd.set_channel(ImageChannel(index=0, suggested_name='L'))
         imd.n_channels_per_read = imd.n_channels
 
-        if wsidicom_object.labels:
-            label_img = wsidicom_object.read_label()
-            imd.associated_label.width = label_img.width
-            imd.associated_label.height = label_img.height
-            imd.associated_label.n_channels = 3
+        if index['label'] is not None:
+            imd.associated_label.width = index['label']['width']
+            imd.associated_label.height = index['label']['height']
+            imd.associated_label.n_channels = index['label']['n_channels']
 
-        if wsidicom_object.overviews:
-            overview = wsidicom_object.read_overview()
-            imd.associated_macro.width = overview.width
-            imd.associated_macro.height = overview.height
-            imd.associated_macro.n_channels = 3
+        if index['macro'] is not None:
+            imd.associated_macro.width = index['macro']['width']
+            imd.associated_macro.height = index['macro']['height']
+            imd.associated_macro.n_channels = index['macro']['n_channels']
 
         return imd
 
+    @instrumented('parse_known_metadata')
     def parse_known_metadata(self):
-        wsidicom_object = cached_wsi_dicom_file(self.format)
-        levels = wsidicom_object.levels
+        index = cached_slide_index(self.format)
 
-        metadata = dictify(wsidicom_object.levels.groups[0].datasets[0])
         imd = super().parse_known_metadata()
-        imd.physical_size_x = wsidicom_object.levels.groups[0].mpp.width * UNIT_REGISTRY("micrometers")
-        imd.physical_size_y = wsidicom_object.levels.groups[0].mpp.height * UNIT_REGISTRY("micrometers")
+        imd.physical_size_x = index['mpp'][0] * UNIT_REGISTRY("micrometers")
+        imd.physical_size_y = index['mpp'][1] * UNIT_REGISTRY("micrometers")
 
-        imd.physical_size_z = self.parse_physical_size(
-            metadata['Shared Functional Groups Sequence'][0]['Pixel Measures Sequence'][0]['Spacing Between Slices'])
-        if 'Acquisition DateTime' in metadata:
-            imd.acquisition_datetime = self.parse_acquisition_date(metadata['Acquisition DateTime'])
+        imd.physical_size_z = self.parse_physical_size(index['spacing_between_slices'])
+        if index['acquisition_datetime'] is not None:
+            imd.acquisition_datetime = self.parse_acquisition_date(index['acquisition_datetime'])
         return imd
 
+    @instrumented('parse_raw_metadata')
     def parse_raw_metadata(self):
-        wsidicom_object = cached_wsi_dicom_file(self.format)
-        levels = wsidicom_object.levels
         store = super().parse_raw_metadata()
-        ds = wsidicom_object.levels.groups[0].datasets[0]
-        data_elmts = recurse_if_SQ(ds)
-
-        for data_element in data_elmts:
-            name = data_element.name
-            if data_element.is_private:
-                tag = data_element.tag
-                name = f"{tag.group:04x}_{tag.element:04x}"  # noqa
-            name = name.replace(' ', '')
-
-            value = data_element.value
-            if type(value) is MultiValue:
-                value = list(value)
+        for name, value in cached_dataset_metadata(self.format).raw.items():
             store.set(name, value, namespace="DICOM")
-
         return store
 
+    @instrumented('parse_pyramid')
     def parse_pyramid(self):
         pyramid = Pyramid()
 
-        wsidicom_object = cached_wsi_dicom_file(self.format)
-        levels = wsidicom_object.levels
-
-        for level in wsidicom_object.levels.levels:
-            level_info = wsidicom_object.levels.get_level(level)
-            level_size = level_info.size
-            tile_size = level_info.tile_size
-            pyramid.insert_tier(level_size.width, level_size.height, (tile_size.width, tile_size.height))
+        index = cached_slide_index(self.format)
+        for level in index['levels']:
+            pyramid.insert_tier(level['width'], level['height'], (level['tile_width'], level['tile_height']))
 
         return pyramid
 
-    def parse_annotations(self) -> List[ParsedMetadataAnnotation]:
-        wsidicom_object = cached_wsi_dicom_file(self.format)
-        channels = list(range(self.format.main_imd.n_channels))
+    @instrumented('parse_annotations')
+    def parse_annotations(self, region: Optional[Region] = None) -> List[ParsedMetadataAnnotation]:
         parsed_annots = []
-        pixel_spacing = wsidicom_object.levels.groups[0].pixel_spacing.width
-
-        ds_annot = wsidicom_object.annotations
-        for annot in ds_annot:
-            annotation_groups = annot.groups
-            for annotation_group in annotation_groups:
-                for annotation in annotation_group:
-                    coords = annotation.geometry.to_coords()  # list of tuples
-                    coords_pixels = []
-                    for xy in coords:  # tuple
-                        new_xy = tuple(int(value / pixel_spacing) for value in xy)
-                        coords_pixels.append(new_xy)
-                    if isinstance(annotation.geometry, WsiPolygon):
-                        annotation_geom = shapely.geometry.Polygon(coords_pixels)
-                    elif isinstance(annotation.geometry, WsiPoint):
-                        annotation_geom = shapely.geometry.Point(coords_pixels)
-                    else:
-                        pass
-                    parsed = ParsedMetadataAnnotation(annotation_geom, channels, 0, 0)
-                    parsed_annots.append(parsed)
+        for chunk in self.iter_annotations(region):
+            parsed_annots.extend(chunk)
         return parsed_annots
 
+    def iter_annotations(
+        self, region: Optional[Region] = None, chunk_size: int = CHUNK_SIZE
+    ) -> Iterator[List[ParsedMetadataAnnotation]]:
+        """
+        Iterate over the slide annotations, by chunks of at most `chunk_size`
+        annotations. If a region (at any tier) is given, only annotations
+        intersecting it are returned, using the slide annotation index.
+        """
+        channels = list(range(self.format.main_imd.n_channels))
+        with ExitStack() as stack:
+            if region is None:
+                wsidicom_object = stack.enter_context(leased_slide(self.format))
+                pixel_spacing = wsidicom_object.levels.base_level.pixel_spacing.width
+                chunks = iter_geometries(
+                    annotation_files(wsidicom_object, self.format.path), pixel_spacing, chunk_size
+                )
+            else:
+                bounds = (
+                    region.true_left, region.true_top,
+                    region.true_left + region.true_width, region.true_top + region.true_height
+                )
+                chunks = (
+                    geometries[start:start + chunk_size]
+                    for geometries in cached_annotation_index(self.format).query(bounds)
+                    for start in range(0, len(geometries), chunk_size)
+                )
+
+            for geometries in chunks:
+                yield [ParsedMetadataAnnotation(geom, channels, 0, 0) for geom in geometries]
+
     @staticmethod
     def parse_acquisition_date(date: str):
         """
@@ -234,37 +452,355 @@ class WSIDicomParser(AbstractParser):
 
 class WSIDicomReader(AbstractReader):
 
+    @instrumented('read_thumb')
     def read_thumb(self, out_width, out_height, precomputed=True, c=None, z=None, t=None):
-        img = cached_wsi_dicom_file(self.format)
+        numpy_output = get_settings().numpy_output
+        if self._is_multi_plane(z):
+            return self._read_whole_image(out_width, out_height, c, z, t)
+
+        thumbnail_size = get_settings().thumbnail_size
+        if precomputed and max(out_width, out_height) <= thumbnail_size:
+            thumb = cached_precomputed_thumbnail(self.format)
+            if thumb.width >= out_width and thumb.height >= out_height:
+                if numpy_output:
+                    return cached_precomputed_thumbnail_array(self.format)
+                return thumb
+
+        if numpy_output:
+            return self._read_whole_image(out_width, out_height, c, z, t)
+        with leased_slide(self.format) as img:
+            return img.read_thumbnail((out_width, out_height))
+
+    @instrumented('read_thumb_async')
+    async def read_thumb_async(self, out_width, out_height, precomputed=True, c=None, z=None, t=None):
+        """Asynchronous variant of `read_thumb`, see `aio`."""
+        if get_settings().numpy_output or await run_io(self._is_multi_plane, z):
+            imd = self.format.main_imd
+            return await self.read_window_async(
+                Region(0, 0, imd.width, imd.height), out_width, out_height, c, z, t
+            )
+        return await run_io(self.read_thumb, out_width, out_height, precomputed, c, z, t)
+
+    def _read_whole_image(self, out_width, out_height, c=None, z=None, t=None):
+        """Read the whole image as a window, assembled from frames into one array."""
+        imd = self.format.main_imd
+        return self.read_window(Region(0, 0, imd.width, imd.height), out_width, out_height, c, z, t)
+
+    def _is_multi_plane(self, z=None):
+        """Whether a read can involve another plane than the default one."""
+        index = cached_slide_index(self.format)
+        return len(index['optical_paths']) > 1 or (z is not None and len(index['focal_planes']) > 1)
+
+    def _planes(self, wsi_level, c=None, z=None):
+        """
+        Get the (image data, focal plane, optical path) planes of a level to
+        read for the asked channels and z-slice. Optical paths are concrete
+        channels, focal planes are z-slices.
+        """
+        index = cached_slide_index(self.format)
+        image_data = wsi_level.default_instance.image_data
 
-        return img.read_thumbnail((out_width, out_height))
+        focal_plane = image_data.default_z
+        if z is not None and len(index['focal_planes']) > 1:
+            focal_plane = nearest_focal_plane(wsi_level.focal_planes, index['focal_planes'][z])
 
+        optical_paths = index['optical_paths']
+        if len(optical_paths) <= 1:
+            paths = [image_data.default_path]
+        else:
+            if c is None:
+                c = range(len(optical_paths) * image_data.samples_per_pixel)
+            elif isinstance(c, int):
+                c = [c]
+            # Paths are read in the asked channel order.
+            paths = list(dict.fromkeys(
+                optical_paths[channel // image_data.samples_per_pixel] for channel in c
+            ))
+
+        return [
+            (wsi_level.get_instance(focal_plane, path).image_data, focal_plane, path)
+            for path in paths
+        ]
+
+    @instrumented('read_window')
     def read_window(self, region, out_width, out_height, c=None, z=None, t=None):
-        img = cached_wsi_dicom_file(self.format)
-
+        with leased_slide(self.format):
+            return read_planes(
+                **self._window_args(region, out_width, out_height, c, z), executor=get_decode_executor()
+            )
+
+    @instrumented('read_window_async')
+    async def read_window_async(self, region, out_width, out_height, c=None, z=None, t=None):
+        """Asynchronous variant of `read_window`, see `aio`."""
+        async with leased_slide_async(self.format):
+            kwargs = await run_io(self._window_args, region, out_width, out_height, c, z)
+            return await read_planes_async(**kwargs)
+
+    @instrumented('read_geometry_window')
+    def read_geometry_window(
+        self, region, geometry, out_width, out_height, c=None, z=None, t=None, background=0
+    ):
+        """
+        Read a window (such as the bounding box of annotations) where only
+        the native tiles intersecting a shapely geometry (in full resolution
+        pixels) are decoded, and the others are filled with `background`.
+        """
+        with leased_slide(self.format):
+            return read_planes(
+                **self._window_args(region, out_width, out_height, c, z, geometry, background),
+                executor=get_decode_executor()
+            )
+
+    @instrumented('read_geometry_window_async')
+    async def read_geometry_window_async(
+        self, region, geometry, out_width, out_height, c=None, z=None, t=None, background=0
+    ):
+        """Asynchronous variant of `read_geometry_window`, see `aio`."""
+        async with leased_slide_async(self.format):
+            kwargs = await run_io(
+                self._window_args, region, out_width, out_height, c, z, geometry, background
+            )
+            return await read_planes_async(**kwargs)
+
+    def _window_args(self, region, out_width, out_height, c=None, z=None, geometry=None, background=0):
+        """
+        Get the `read_planes` arguments to read a window, restricted to the
+        tiles intersecting a geometry if given. The planes are read from the
+        slide, which must be leased until they are read.
+        """
         tier = self.format.pyramid.most_appropriate_tier(region, (out_width, out_height))
         region = region.scale_to_tier(tier)
         level = tier.level
-        norm_level = img.levels.levels[level]
-        return img.read_region((region.left, region.top), norm_level, (region.width, region.height))
-
+        with leased_slide(self.format) as img:
+            norm_level = img.levels.levels[level]
+            set_level(norm_level)
+            planes = self._planes(img.levels.get_level(norm_level), c, z)
+
+        tile_size = (tier.tile_width, tier.tile_height)
+        factor = 1
+        if get_settings().reduced_decoding:
+            factor = reduction_factor(region.width, region.height, out_width, out_height, tile_size)
+        return dict(
+            planes=planes, left=region.left, top=region.top, width=region.width, height=region.height,
+            cache=get_tile_cache(),
+            cache_keys=[
+                self._tile_cache_key(norm_level, focal_plane, path)
+                for _, focal_plane, path in planes
+            ],
+            factor=factor, frames=frame_index(self.format),
+            tiles=None if geometry is None else geometry_tiles(
+                geometry, tile_range(region.left, region.top, region.width, region.height, tile_size),
+                tile_size, (tier.width_factor, tier.height_factor)
+            ),
+            background=background
+        )
+
+    def _tile_cache_key(self, level, z, path):
+        return SlideCache.key(str(self.format.path)) + (level, z, path)
+
+    @instrumented('read_tile')
     def read_tile(self, tile, c=None, z=None, t=None):
+        self._observe_tile(tile, c, z)
+        native_tile = self._read_native_tile(tile, c, z)
+        if native_tile is not None:
+            return native_tile
         return self.read_window(tile, tile.width, tile.height, c, z, t)
 
+    @instrumented('read_tile_async')
+    async def read_tile_async(self, tile, c=None, z=None, t=None):
+        """Asynchronous variant of `read_tile`, see `aio`."""
+        self._observe_tile(tile, c, z)
+        native_tile = await run_io(self._read_native_tile, tile, c, z)
+        if native_tile is not None:
+            return native_tile
+        return await self.read_window_async(tile, tile.width, tile.height, c, z, t)
+
+    def read_tiles(self, tiles: Iterable[Region], c=None, z=None, t=None) -> Iterator[np.ndarray]:
+        """
+        Read many tiles, as arrays yielded in the given order, for analysis
+        clients. Consecutive tiles of a same native tier (of the slide
+        pyramid) are read by batches, see `tiles.read_tiles`: without tier
+        lookup, sorted and coalesced frame reads, parallel decoding. Tiles
+        of other tiers (such as the normalized pyramid) and other regions
+        are read as windows.
+        """
+        batch_size = max(1, get_settings().tile_batch_size)
+        pyramid = self.format.pyramid
+        for tier, run in groupby(tiles, key=lambda tile: getattr(tile, 'tier', None)):
+            native = tier is not None and tier.level < len(pyramid) \
+                and pyramid.get_tier_at_level(tier.level) == tier
+            if not native:
+                for region in run:
+                    yield self.read_window(region, region.width, region.height, c, z, t)
+                continue
+
+            with leased_slide(self.format) as img:
+                norm_level = img.levels.levels[tier.level]
+                planes = self._planes(img.levels.get_level(norm_level), c, z)
+                yield from read_tiles(
+                    planes, [(tile.tx, tile.ty) for tile in run], get_decode_executor(),
+                    frame_index(self.format), batch_size
+                )
+
+    def read_tier_tiles(self, level: int, c=None, z=None, t=None) -> Iterator[Tuple[Tile, np.ndarray]]:
+        """Read all the tiles of a pyramid tier, row by row, yielded with their pixels."""
+        tier = self.format.pyramid.get_tier_at_level(level)
+        tiles = [Tile(tier, tx, ty) for ty in range(tier.max_ty) for tx in range(tier.max_tx)]
+        return zip(tiles, self.read_tiles(tiles, c, z, t))
+
+    def level_arrays(self, z=None) -> List[LevelArray]:
+        """
+        Get the pyramid tiers (in `parse_pyramid` order) as lazily read arrays,
+        chunked along their native tiles, with all the optical paths stacked
+        along channels, at the z-slice `z`. See `arrays`.
+        """
+        index = cached_slide_index(self.format)
+        focal_plane = None
+        if z is not None and len(index['focal_planes']) > 1:
+            focal_plane = index['focal_planes'][z]
+        optical_paths = index['optical_paths'] if len(index['optical_paths']) > 1 else [None]
+        return [
+            LevelArray(
+                str(self.format.path), level['level'], (level['width'], level['height']),
+                (level['tile_width'], level['tile_height']), index['samples_per_pixel'] or 1,
+                focal_plane, optical_paths, np_dtype(index['bits_stored'] or 8)
+            )
+            for level in index['levels']
+        ]
+
+    def _observe_tile(self, tile, c=None, z=None):
+        prefetcher = get_prefetcher()
+        if prefetcher is not None:
+            planes = (tuple(c) if isinstance(c, list) else c, z)
+            prefetcher.observe(str(self.format.path), tile, partial(self._prefetch_tile, c=c, z=z), planes)
+
+    def _prefetch_tile(self, tile, c=None, z=None):
+        """
+        Read a tile in advance. Native tiles are only read (warming the OS
+        page cache), other tiles are decoded into the tile cache.
+        """
+        if self._read_native_tile(tile, c, z) is None and get_tile_cache() is not None:
+            with leased_slide(self.format):
+                read_planes(**self._window_args(tile, tile.width, tile.height, c, z))
+
+    def _read_native_tile(self, tile, c=None, z=None):
+        """
+        Get the stored frame matching the tile, without decoding it through
+        wsidicom. Return None if the tile does not exactly match a native
+        frame (geometry, level, single plane and transfer syntax), so that
+        the caller can fall back on a decoded window.
+        """
+        tier = self.format.pyramid.most_appropriate_tier(tile, (tile.width, tile.height))
+        region = copy(tile).scale_to_tier(tier)
+        if region.width != tile.width or region.height != tile.height:
+            return None
+        if region.left % tier.tile_width or region.top % tier.tile_height:
+            return None
+        if region.width != min(tier.tile_width, tier.width - region.left) or \
+                region.height != min(tier.tile_height, tier.height - region.top):
+            return None
+
+        with leased_slide(self.format) as img:
+            norm_level = img.levels.levels[tier.level]
+            set_level(norm_level)
+            wsi_level = img.levels.get_level(norm_level)
+            planes = self._planes(wsi_level, c, z)
+            if len(planes) != 1:
+                return None
+            image_data, focal_plane, path = planes[0]
+            if image_data.transfer_syntax not in PASSTHROUGH_TRANSFER_SYNTAXES:
+                return None
+
+            tile_index = (region.left // tier.tile_width, region.top // tier.tile_height)
+            frame, = read_frames(image_data, [tile_index], focal_plane, path, frame_index(self.format))
+            image = VIPSImage.new_from_buffer(frame, "")
+            if image.width != region.width or image.height != region.height:
+                # Edge frames are padded up to the tile size.
+                image = image.crop(0, 0, region.width, region.height)
+            return image
+
+    @instrumented('read_macro')
     def read_macro(self, out_width, out_height):
-        img = cached_wsi_dicom_file(self.format)
-        return img.read_overview()
+        return self._read_associated('macro', out_width, out_height)
 
+    @instrumented('read_label')
     def read_label(self, out_width, out_height):
-        img = cached_wsi_dicom_file(self.format)
-        return img.read_label()
+        return self._read_associated('label', out_width, out_height)
+
+    def _read_associated(self, kind, out_width, out_height):
+        with leased_slide(self.format) as img:
+            series = img.labels if kind == 'label' else img.overviews
+            if not series:
+                return None
+
+            cache = get_associated_cache()
+            key = SlideCache.key(str(self.format.path)) + (kind, out_width, out_height)
+            numpy_output = get_settings().numpy_output
+            if cache is not None:
+                pixels = cache.get(key)
+                if pixels is not None:
+                    return pixels if numpy_output else PILImage.fromarray(pixels)
+
+            image = read_associated(series[0], out_width, out_height)
+            if cache is not None or numpy_output:
+                pixels = np.asarray(image)
+                if cache is not None:
+                    pixels = cache.put(key, pixels)
+                if numpy_output:
+                    return pixels
+            return image
+
+
+class WSIDicomHistogramReader(AbstractHistogramReader):
+    """
+    Approximate histograms computed from the stored frames of a small
+    pyramid level, or of frames sampled over the coarsest level (see
+    `histogram`). Used when there is no histogram file for the image.
+    """
+
+    def type(self) -> HistogramType:
+        return HistogramType.FAST
+
+    def image_bounds(self):
+        return cached_slide_histogram(self.format).image_bounds()
+
+    def image_histogram(self, squeeze=True):
+        return cached_slide_histogram(self.format).image_histogram(squeeze)
+
+    def channels_bounds(self):
+        return cached_slide_histogram(self.format).channels_bounds()
+
+    def channel_bounds(self, c):
+        return cached_slide_histogram(self.format).channel_bounds(c)
+
+    def channel_histogram(self, c, squeeze=True):
+        return cached_slide_histogram(self.format).channel_histogram(c, squeeze)
+
+    def planes_bounds(self):
+        return cached_slide_histogram(self.format).planes_bounds()
+
+    def plane_bounds(self, c, z, t):
+        return cached_slide_histogram(self.format).plane_bounds(c, z, t)
+
+    def plane_histogram(self, c, z, t, squeeze=True):
+        return cached_slide_histogram(self.format).plane_histogram(c, z, t, squeeze)
+
+    def approximation_error(self) -> float:
+        """
+        Compare the histograms with those of a full resolution pass over all
+        frames (which is slow), see `histogram.histogram_error`.
+        """
+        exact = _compute_histogram(self.format, max_pixels=None)
+        error = histogram_error(cached_slide_histogram(self.format).planes, exact)
+        log.info(f"Approximation error of the histograms of {self.format.path}: {error:.4f}")
+        return error
 
 
 class WSIDicomFormat(AbstractFormat):
     checker_class = WSIDicomChecker
     parser_class = WSIDicomParser
     reader_class = WSIDicomReader
-    histogram_reader_class = DefaultHistogramReader
+    histogram_reader_class = WSIDicomHistogramReader
 
     def __init__(self, path, *args, **kwargs):
         super().__init__(path, *args, **kwargs)
@@ -0,0 +1,201 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Random access to the frames of a slide.
+
+Frame positions of an image file come from its Basic/Extended Offset Table,
+or from a scan of its pixel data fragments when the tables are empty. They
+are computed once per file, when one of its frames is first read, and
+persisted next to the slide in the background, by a single writer thread
+(positions computed meanwhile are written together). Frames are then read
+with positional reads (`os.pread`) on the descriptors wsidicom opened the
+files with, shared by all threads without any lock: no descriptor is opened
+besides the ones of the slide cache.
+
+Frames of many tiles are read sorted by file offset, and frames close to
+each other in a file are read together in a single sequential read.
+"""
+
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from wsidicom.errors import WsiDicomOutOfBoundsError
+from wsidicom.file import WsiDicomFile
+from wsidicom.geometry import Point, Region, Size
+from wsidicom.image_data import ImageData, WsiDicomImageData
+
+from pims_plugin_format_dicom.cache import ObjectCache, SlideCache
+from pims_plugin_format_dicom.config import get_settings
+from pims_plugin_format_dicom.index import load_frame_positions, write_frame_positions
+
+
+@lru_cache()
+def get_index_writer() -> ThreadPoolExecutor:
+    """Get the process-wide thread writing the frame position sidecars."""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="wsidicom-frames")
+
+
+def _fileno(file: WsiDicomFile) -> int:
+    # Raises ValueError once the slide is closed, instead of reading a reused descriptor.
+    return file._fp.parent.fileno()
+
+
+# File, offset and length of a frame.
+FramePosition = Tuple[WsiDicomFile, int, int]
+
+
+class FrameIndex:
+    """Frame positions and positional frame reads of the image files of a slide."""
+
+    def __init__(
+        self, path: Path, persist: bool = True, max_gap: int = 0, max_read_size: int = 16 * 1024 * 1024
+    ):
+        self.path = Path(path)
+        self.persist = persist
+        # Frames at most `max_gap` bytes apart are read together, in reads of
+        # at most `max_read_size` bytes (a larger frame is read alone).
+        self.max_gap = max_gap
+        self.max_read_size = max_read_size
+
+        self._lock = threading.Lock()
+        self._positions: Dict[str, np.ndarray] = load_frame_positions(self.path) if persist else dict()
+        # Pending write of the positions, and last scheduled write.
+        self._write: Optional[Future] = None
+        self._last_write: Optional[Future] = None
+
+    def positions(self, file: WsiDicomFile) -> np.ndarray:
+        """Get the (offset, length) of the frames of a file, as a (frame_count, 2) array."""
+        name = file.filepath.name
+        positions = self._positions.get(name)
+        if positions is not None:
+            return positions
+
+        with self._lock:
+            positions = self._positions.get(name)
+            if positions is None:
+                # Parses the offset tables or scans the pixel data, once.
+                positions = np.asarray(file.frame_positions, dtype=np.int64).reshape(-1, 2)
+                self._positions[name] = positions
+                if self.persist and self._write is None:
+                    self._write = self._last_write = get_index_writer().submit(self._write_positions)
+        return positions
+
+    def _write_positions(self):
+        with self._lock:
+            positions = dict(self._positions)
+            # Positions computed from now on are written by the next write.
+            self._write = None
+        write_frame_positions(self.path, positions)
+
+    def flush(self):
+        """Wait until the positions computed so far are persisted."""
+        if self._last_write is not None:
+            self._last_write.result()
+
+    def read_frame(self, file: WsiDicomFile, frame_index: int) -> bytes:
+        """Read a frame of a file, by its frame index including the concatenation offset."""
+        offset, length = self.positions(file)[frame_index - file.frame_offset]
+        return os.pread(_fileno(file), int(length), int(offset))
+
+    def locate(
+        self, image_data: WsiDicomImageData, tile: Point, z: float, path: str
+    ) -> Optional[FramePosition]:
+        """
+        Get the position of the frame of a tile of an image data, or None for
+        a sparse tile. Raises WsiDicomOutOfBoundsError for a tile, focal plane
+        or optical path out of the image data, as `get_encoded_tile`.
+        """
+        tile_region = Region(position=tile, size=Size(0, 0))
+        if not image_data.valid_tiles(tile_region, z, path):
+            raise WsiDicomOutOfBoundsError(f"Tile region {tile_region}", f"plane {image_data.tiled_size}")
+        frame_index = image_data.tiles.get_frame_index(tile, z, path)
+        if frame_index == -1:
+            return None
+
+        file = image_data._get_file(frame_index)
+        offset, length = self.positions(file)[frame_index - file.frame_offset]
+        return file, int(offset), int(length)
+
+    def read_tile(self, image_data: ImageData, tile: Point, z: float, path: str) -> bytes:
+        """Read the encoded frame of a tile of an image data. Sparse tiles give a blank frame."""
+        if not isinstance(image_data, WsiDicomImageData):
+            return image_data.get_encoded_tile(tile, z, path, crop=False)
+
+        position = self.locate(image_data, tile, z, path)
+        if position is None:
+            return image_data.blank_encoded_tile
+        file, offset, length = position
+        return os.pread(_fileno(file), length, offset)
+
+    def read_tiles(self, image_data: ImageData, tiles: List[Point], z: float, path: str) -> List[bytes]:
+        """
+        Read the encoded frames of tiles of an image data, in the given order.
+        Frames are read sorted by file and offset, and coalesced into
+        sequential reads. Sparse tiles give a blank frame.
+        """
+        if len(tiles) <= 1 or not isinstance(image_data, WsiDicomImageData):
+            return [self.read_tile(image_data, tile, z, path) for tile in tiles]
+
+        encoded: List[Optional[bytes]] = [None] * len(tiles)
+        reads = []
+        for i, tile in enumerate(tiles):
+            position = self.locate(image_data, tile, z, path)
+            if position is None:
+                encoded[i] = image_data.blank_encoded_tile
+            else:
+                file, offset, length = position
+                reads.append((file.filepath.name, offset, length, i, file))
+        reads.sort(key=lambda read: read[:3])
+
+        run, run_end = [], 0
+        for read in reads:
+            name, offset, length = read[:3]
+            if run and (
+                name != run[0][0] or offset - run_end > self.max_gap
+                or max(run_end, offset + length) - run[0][1] > self.max_read_size
+            ):
+                self._read_run(run, run_end, encoded)
+                run, run_end = [], 0
+            run.append(read)
+            run_end = max(run_end, offset + length)
+        if run:
+            self._read_run(run, run_end, encoded)
+        return encoded
+
+    def _read_run(self, run, end: int, encoded: List[Optional[bytes]]):
+        start = run[0][1]
+        data = os.pread(_fileno(run[0][4]), end - start, start)
+        for _, offset, length, i, _ in run:
+            encoded[i] = data[offset - start:offset - start + length]
+
+
+@lru_cache()
+def get_frame_index_cache() -> ObjectCache:
+    return ObjectCache(get_settings().slide_cache_max_slides)
+
+
+def get_frame_index(path: str) -> FrameIndex:
+    """Get the process-wide frame index of a slide."""
+    settings = get_settings()
+    return get_frame_index_cache().get(
+        SlideCache.key(path), lambda: FrameIndex(
+            path, settings.index_enabled, settings.frame_read_max_gap, settings.frame_read_max_size
+        )
+    )
@@ -0,0 +1,207 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Approximate histograms of WSI DICOM slides, computed from stored frames.
+
+Histograms come from all the frames of the finest pyramid level within a
+pixel budget, or from frames evenly sampled over the coarsest level if no
+level is small enough. Frames are read and decoded in parallel, in bounded
+batches, and each decoded frame is reduced right away to its per-channel
+counts by a single `np.bincount`. Counts are scaled to the number of pixels
+of the full resolution image.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from wsidicom.geometry import Size
+
+from pims_plugin_format_dicom.tiles import Plane, TileIndex, decode_frame, read_frames
+
+if TYPE_CHECKING:
+    from pims_plugin_format_dicom.frames import FrameIndex
+
+PlaneIndex = Union[int, List[int]]
+
+
+def plan_histogram(
+    level_sizes: Sequence[Tuple[Size, Size]], max_pixels: Optional[int]
+) -> Tuple[int, List[TileIndex]]:
+    """
+    Choose the level (index in `level_sizes`, the image and tile sizes of
+    the levels, finest first) and the tiles to compute a histogram from: all
+    the tiles of the finest level having at most `max_pixels` pixels, or tiles
+    evenly sampled over the coarsest level if there is none. All the tiles of
+    the finest level if `max_pixels` is None.
+    """
+    for level, (size, tile_size) in enumerate(level_sizes):
+        if max_pixels is None or size.width * size.height <= max_pixels:
+            return level, all_tiles(size, tile_size)
+
+    level = len(level_sizes) - 1
+    size, tile_size = level_sizes[level]
+    max_tiles = max(1, max_pixels // (tile_size.width * tile_size.height))
+    return level, sample_tiles(all_tiles(size, tile_size), max_tiles)
+
+
+def all_tiles(size: Size, tile_size: Size) -> List[TileIndex]:
+    columns = -(-size.width // tile_size.width)
+    rows = -(-size.height // tile_size.height)
+    return [(tx, ty) for ty in range(rows) for tx in range(columns)]
+
+
+def sample_tiles(tiles: List[TileIndex], max_tiles: int) -> List[TileIndex]:
+    """Select up to `max_tiles` tiles evenly spaced in the (row by row) tile order."""
+    if len(tiles) <= max_tiles:
+        return tiles
+    # Rows rarely hold a multiple of the step, so that samples spread over columns too.
+    indices = np.unique(np.linspace(0, len(tiles) - 1, max_tiles).round().astype(int))
+    return [tiles[i] for i in indices]
+
+
+def frame_histogram(pixels: np.ndarray, n_values: int) -> np.ndarray:
+    """Count the values of each channel of decoded pixels, as a (n_channels, n_values) array."""
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+    n_channels = pixels.shape[2]
+    values = np.minimum(pixels.reshape(-1, n_channels), n_values - 1).astype(np.intp)
+    # A single count for all channels, shifted to their own range of values.
+    values += np.arange(n_channels) * n_values
+    counts = np.bincount(values.ravel(), minlength=n_channels * n_values)
+    return counts.reshape(n_channels, n_values)
+
+
+def compute_histogram(
+    planes: List[List[Plane]], tiles: List[TileIndex], n_values: int, full_pixels: int,
+    executor: Optional[ThreadPoolExecutor] = None, batch_size: int = 64,
+    frames: Optional['FrameIndex'] = None
+) -> np.ndarray:
+    """
+    Compute the histograms of the planes (one list of planes, stacked along
+    channels, per z-slice) from the given tiles, as a (1, depth, n_channels,
+    n_values) array of counts scaled to `full_pixels` pixels per plane.
+
+    Frames are decoded concurrently if an executor is given, at most
+    `batch_size` at a time so that memory is bounded.
+    """
+    image_data = planes[0][0][0]
+    samples = image_data.samples_per_pixel
+    tile_width, tile_height = image_data.tile_size.to_tuple()
+    width, height = image_data.image_size.to_tuple()
+
+    def _count(item):
+        (image_data, z, path), (tx, ty) = item
+        frame, = read_frames(image_data, [(tx, ty)], z, path, frames)
+        # Edge frames are padded up to the tile size.
+        pixels = decode_frame(frame)[:height - ty * tile_height, :width - tx * tile_width]
+        return frame_histogram(pixels, n_values)
+
+    items = [
+        ((z, p), (plane, tile))
+        for z, z_planes in enumerate(planes)
+        for p, plane in enumerate(z_planes)
+        for tile in tiles
+    ]
+    counts = np.zeros((1, len(planes), len(planes[0]) * samples, n_values), dtype=np.uint64)
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        if executor is None:
+            histograms = map(_count, [item for _, item in batch])
+        else:
+            histograms = executor.map(_count, [item for _, item in batch])
+        for ((z, p), _), histogram in zip(batch, histograms):
+            counts[0, z, p * samples:(p + 1) * samples] += histogram.astype(np.uint64)
+
+    sampled_pixels = sum(
+        min(tile_width, width - tx * tile_width) * min(tile_height, height - ty * tile_height)
+        for tx, ty in tiles
+    )
+    return np.rint(counts * (full_pixels / max(1, sampled_pixels))).astype(np.uint64)
+
+
+def histogram_error(approximate: np.ndarray, exact: np.ndarray) -> float:
+    """
+    Get the approximation error of histograms: the largest total variation
+    distance between the normalized histograms of a plane, in [0, 1].
+    """
+    def _normalize(histograms):
+        histograms = histograms.astype(np.float64)
+        totals = histograms.sum(axis=-1, keepdims=True)
+        return np.divide(histograms, totals, out=np.zeros_like(histograms), where=totals > 0)
+
+    distances = 0.5 * np.abs(_normalize(approximate) - _normalize(exact)).sum(axis=-1)
+    return float(distances.max(initial=0.0))
+
+
+def _bounds(histograms: np.ndarray) -> np.ndarray:
+    """Get the smallest and greatest values with a non-zero count, as a (..., 2) array."""
+    nonzero = histograms != 0
+    n_values = histograms.shape[-1]
+    return np.stack(
+        (np.argmax(nonzero, axis=-1), n_values - 1 - np.argmax(nonzero[..., ::-1], axis=-1)),
+        axis=-1
+    )
+
+
+def _as_list(index: PlaneIndex) -> List[int]:
+    return index if type(index) is list else [index]
+
+
+class SlideHistogram:
+    """
+    Per-plane histograms of a slide, as a (duration, depth, n_channels,
+    n_values) array, with the per-channel and per-image reductions and the
+    lookups of PIMS histogram readers.
+    """
+
+    def __init__(self, planes: np.ndarray):
+        self.planes = planes
+        self.channels = planes.sum(axis=(0, 1))
+        self.image = self.channels.sum(axis=0)
+
+    def image_bounds(self) -> Tuple[int, int]:
+        return tuple(_bounds(self.image).tolist())
+
+    def image_histogram(self, squeeze: bool = True) -> np.ndarray:
+        return self.image if squeeze else self.image[np.newaxis, :]
+
+    def channels_bounds(self) -> List[Tuple[int, int]]:
+        return list(map(tuple, _bounds(self.channels).tolist()))
+
+    def channel_bounds(self, c: int) -> Tuple[int, int]:
+        return tuple(_bounds(self.channels[c]).tolist())
+
+    def channel_histogram(self, c: PlaneIndex, squeeze: bool = True) -> np.ndarray:
+        if type(c) is list:
+            histogram = self.channels[c]
+            return np.squeeze(histogram) if squeeze else histogram
+        histogram = self.channels[c]
+        return histogram if squeeze else histogram[np.newaxis, :]
+
+    def planes_bounds(self) -> List[Tuple[int, int]]:
+        return list(map(tuple, _bounds(self.planes).reshape((-1, 2)).tolist()))
+
+    def plane_bounds(self, c: int, z: int, t: int) -> Tuple[int, int]:
+        return tuple(_bounds(self.planes[t, z, c]).tolist())
+
+    def plane_histogram(
+        self, c: PlaneIndex, z: PlaneIndex, t: PlaneIndex, squeeze: bool = True
+    ) -> np.ndarray:
+        if type(c) is list or type(z) is list or type(t) is list:
+            histogram = self.planes[np.ix_(_as_list(t), _as_list(z), _as_list(c))]
+            return np.squeeze(histogram) if squeeze else histogram
+        histogram = self.planes[t, z, c]
+        return histogram if squeeze else histogram[np.newaxis, np.newaxis, np.newaxis, :]
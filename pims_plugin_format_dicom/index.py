@@ -0,0 +1,262 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Persistent sidecar files of a slide.
+
+The index is a small JSON file written next to the slide directory the first
+time the slide is parsed. It holds everything needed to build the image
+metadata and the pyramid, so that subsequent parses do not need to open every
+instance of the slide.
+
+The precomputed thumbnail is a PNG file written next to the slide directory
+the first time a precomputed thumbnail is requested.
+
+The frame positions are a NumPy archive written next to the slide directory,
+holding the (offset, length) of every frame of the image files read so far.
+
+All are invalidated when files are added to, removed from or replaced in
+the slide directory (see `slide_fingerprint`).
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from PIL import Image, PngImagePlugin
+from wsidicom.wsidicom import WsiDicom
+
+from pims_plugin_format_dicom.metadata import DatasetMetadata
+
+log = logging.getLogger("pims.formats")
+
+INDEX_VERSION = 4
+INDEX_SUFFIX = ".wsidicom-index.json"
+THUMBNAIL_SUFFIX = ".wsidicom-thumb.png"
+FRAMES_SUFFIX = ".wsidicom-frames.npz"
+
+SlideIndex = Dict[str, Any]
+
+
+def _sidecar_path(path: Path, suffix: str) -> Path:
+    path = Path(path)
+    return path.with_name(f".{path.name}{suffix}")
+
+
+def index_path(path: Path) -> Path:
+    """Get the sidecar index path for a slide directory."""
+    return _sidecar_path(path, INDEX_SUFFIX)
+
+
+def thumbnail_path(path: Path) -> Path:
+    """Get the sidecar thumbnail path for a slide directory."""
+    return _sidecar_path(path, THUMBNAIL_SUFFIX)
+
+
+def frames_path(path: Path) -> Path:
+    """Get the sidecar frame positions path for a slide directory."""
+    return _sidecar_path(path, FRAMES_SUFFIX)
+
+
+def slide_fingerprint(path: Path) -> Dict[str, Any]:
+    """
+    Get a cheap fingerprint of the slide directory content, used to detect
+    that an index is outdated: the directory modification time (which
+    changes when files are added, removed or replaced) and its number of
+    entries. Files are neither opened nor stat'ed, so that it costs a single
+    directory listing on network storage. Files rewritten in place are not
+    detected.
+    """
+    return {'mtime': os.stat(path).st_mtime_ns, 'n_files': len(os.listdir(path))}
+
+
+def _json_value(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_json_value(v) for v in value]
+    # pydicom value representations (DSfloat, IS, PersonName, ...)
+    for cast in (int, float):
+        if isinstance(value, cast):
+            return cast(value)
+    return str(value)
+
+
+def _build_levels(wsi: WsiDicom) -> List[Dict[str, Any]]:
+    levels = []
+    for level in wsi.levels.levels:
+        wsi_level = wsi.levels.get_level(level)
+        levels.append({
+            'level': level,
+            'width': wsi_level.size.width,
+            'height': wsi_level.size.height,
+            'tile_width': wsi_level.tile_size.width,
+            'tile_height': wsi_level.tile_size.height,
+        })
+    return levels
+
+
+def _build_associated(wsi: WsiDicom, kind: str) -> Optional[Dict[str, int]]:
+    """
+    Get associated image dimensions from the instance attributes
+    (Total Pixel Matrix / Rows / Columns, Samples per Pixel), without decoding.
+    """
+    series = wsi.labels if kind == 'label' else wsi.overviews
+    if not series:
+        return None
+    group = series[0]
+    return {
+        'width': group.size.width,
+        'height': group.size.height,
+        'n_channels': group.default_instance.image_data.samples_per_pixel,
+    }
+
+
+def _optical_path_key(path: str):
+    # Numeric identifiers are sorted numerically, before other identifiers.
+    return (0, int(path), '') if path.isdigit() else (1, 0, path)
+
+
+def _build_planes(wsi: WsiDicom) -> Dict[str, list]:
+    """Get the focal planes (in µm) and optical paths of the base level, sorted."""
+    base_level = wsi.levels.base_level
+    return {
+        'focal_planes': sorted(base_level.focal_planes),
+        'optical_paths': sorted(base_level.optical_paths, key=_optical_path_key),
+    }
+
+
+def build_index(
+    wsi: WsiDicom, path: Path, metadata: Optional[DatasetMetadata] = None
+) -> SlideIndex:
+    """
+    Build the index of an opened slide. The metadata of the base level
+    dataset are extracted if not given.
+    """
+    base_group = wsi.levels.base_level
+    if metadata is None:
+        metadata = DatasetMetadata(base_group.datasets[0])
+
+    def _get(*keywords):
+        return _json_value(metadata.get(*keywords))
+
+    return {
+        'version': INDEX_VERSION,
+        'fingerprint': slide_fingerprint(path),
+        'width': wsi.levels.base_level.size.width,
+        'height': wsi.levels.base_level.size.height,
+        'bits_stored': _get('BitsStored'),
+        'samples_per_pixel': _get('SamplesPerPixel'),
+        'model_name': _get('ManufacturerModelName'),
+        'objective_lens_power': _get('OpticalPathSequence', 'ObjectiveLensPower'),
+        'mpp': [base_group.mpp.width, base_group.mpp.height],
+        'spacing_between_slices': _get(
+            'SharedFunctionalGroupsSequence', 'PixelMeasuresSequence', 'SpacingBetweenSlices'
+        ),
+        'acquisition_datetime': _get('AcquisitionDateTime'),
+        **_build_planes(wsi),
+        'levels': _build_levels(wsi),
+        'label': _build_associated(wsi, 'label'),
+        'macro': _build_associated(wsi, 'macro'),
+    }
+
+
+def load_index(path: Path) -> Optional[SlideIndex]:
+    """Load the index of a slide, if it exists and is up-to-date."""
+    try:
+        with open(index_path(path), 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if index.get('version') != INDEX_VERSION:
+        return None
+    if index.get('fingerprint') != slide_fingerprint(path):
+        return None
+    return index
+
+
+def _write_atomic(dest: Path, write):
+    tmp = dest.with_name(f"{dest.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.replace(tmp, dest)
+    except OSError as e:
+        log.warning(f"Impossible to write WSI DICOM sidecar {dest}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def write_index(path: Path, index: SlideIndex):
+    """Atomically write the index of a slide. Failures are not fatal."""
+    _write_atomic(
+        index_path(path),
+        lambda f: f.write(json.dumps(index, separators=(',', ':')).encode())
+    )
+
+
+def load_thumbnail(path: Path) -> Optional[Image.Image]:
+    """Load the precomputed thumbnail of a slide, if it exists and is up-to-date."""
+    try:
+        image = Image.open(thumbnail_path(path))
+        image.load()
+    except (OSError, ValueError):
+        return None
+
+    fingerprint = json.dumps(slide_fingerprint(path), sort_keys=True)
+    if image.info.get('fingerprint') != fingerprint:
+        return None
+    return image
+
+
+def write_thumbnail(path: Path, image: Image.Image):
+    """Atomically write the precomputed thumbnail of a slide. Failures are not fatal."""
+    info = PngImagePlugin.PngInfo()
+    info.add_text('fingerprint', json.dumps(slide_fingerprint(path), sort_keys=True))
+    _write_atomic(
+        thumbnail_path(path),
+        lambda f: image.save(f, format='PNG', pnginfo=info)
+    )
+
+
+def load_frame_positions(path: Path) -> Dict[str, np.ndarray]:
+    """
+    Load the frame positions of the image files of a slide, by file name,
+    if they exist and are up-to-date.
+    """
+    try:
+        with np.load(frames_path(path)) as archive:
+            positions = {name: archive[name] for name in archive.files}
+    except (OSError, ValueError):
+        return dict()
+
+    fingerprint = positions.pop('.fingerprint', None)
+    if fingerprint is None or str(fingerprint) != json.dumps(slide_fingerprint(path), sort_keys=True):
+        return dict()
+    return positions
+
+
+def write_frame_positions(path: Path, positions: Dict[str, np.ndarray]):
+    """Atomically write the frame positions of a slide. Failures are not fatal."""
+    fingerprint = np.array(json.dumps(slide_fingerprint(path), sort_keys=True))
+    _write_atomic(
+        frames_path(path),
+        lambda f: np.savez(f, **{'.fingerprint': fingerprint}, **positions)
+    )
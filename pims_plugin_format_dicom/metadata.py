@@ -0,0 +1,116 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Lazy extraction of the metadata of a DICOM dataset.
+"""
+
+from typing import Any, Dict, Optional, Tuple
+
+from pydicom.datadict import tag_for_keyword
+from pydicom.dataset import Dataset
+from pydicom.multival import MultiValue
+from pydicom.sequence import Sequence
+
+from pims_plugin_format_dicom.metrics import instrumented
+
+# Binary data elements (pixel data, ICC profiles, ...) are never converted.
+BULK_VRS = {'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN'}
+
+_MISSING = object()
+
+
+def raw_name(data_element) -> str:
+    if data_element.is_private:
+        tag = data_element.tag
+        return f"{tag.group:04x}_{tag.element:04x}"  # noqa
+    return data_element.name.replace(' ', '')
+
+
+def _value(data_element) -> Any:
+    value = data_element.value
+    return list(value) if type(value) is MultiValue else value
+
+
+class DatasetMetadata:
+    """
+    Metadata of a dataset, extracted on first access.
+
+    `raw` holds every value by name, prefixed by its sequence path (e.g.
+    `OpticalPathSequence[1].ObjectiveLensPower`), so that repeated names in
+    sequence items are all kept. It is built by a traversal of the dataset
+    and its sequences on first access. Keyword lookups only convert the
+    elements along their path, see `get`.
+    """
+
+    def __init__(self, ds: Dataset):
+        self._ds = ds
+        self._raw: Optional[Dict[str, Any]] = None
+        self._keywords: Dict[Tuple[str, ...], Any] = dict()
+
+    @property
+    def raw(self) -> Dict[str, Any]:
+        if self._raw is None:
+            self._raw = self._extract_raw()
+        return self._raw
+
+    @instrumented('parse_dataset_metadata')
+    def _extract_raw(self) -> Dict[str, Any]:
+        raw = dict()
+        self._walk(self._ds, '', raw)
+        return raw
+
+    def _walk(self, ds: Dataset, prefix: str, raw: Dict[str, Any]):
+        for tag in sorted(ds.keys()):
+            # Raw elements are only converted if they are not bulk data.
+            if ds.get_item(tag).VR in BULK_VRS:
+                continue
+            data_element = ds[tag]
+            if data_element.VR in BULK_VRS:
+                continue
+
+            name = prefix + raw_name(data_element)
+            if data_element.VR == 'SQ':
+                for i, item in enumerate(data_element):
+                    self._walk(item, f"{name}[{i}].", raw)
+                continue
+            raw[name] = _value(data_element)
+
+    @instrumented('lookup_dataset_metadata')
+    def _lookup(self, keywords: Tuple[str, ...]) -> Any:
+        ds = self._ds
+        for i, keyword in enumerate(keywords):
+            tag = tag_for_keyword(keyword)
+            if tag is None or tag not in ds or ds.get_item(tag).VR in BULK_VRS:
+                return _MISSING
+            data_element = ds[tag]
+            if data_element.VR in BULK_VRS:
+                return _MISSING
+            if i == len(keywords) - 1:
+                return _MISSING if data_element.VR == 'SQ' else _value(data_element)
+            if data_element.VR != 'SQ' or not isinstance(data_element.value, Sequence) \
+                    or len(data_element.value) == 0:
+                return _MISSING
+            ds = data_element.value[0]
+        return _MISSING
+
+    def get(self, *keywords: str, default: Any = None) -> Any:
+        """
+        Get a value by keyword, following the first item of sequences, e.g.
+        `get('OpticalPathSequence', 'ObjectiveLensPower')`.
+        """
+        if keywords not in self._keywords:
+            self._keywords[keywords] = self._lookup(keywords)
+        value = self._keywords[keywords]
+        return default if value is _MISSING else value
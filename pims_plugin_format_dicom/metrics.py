@@ -0,0 +1,257 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Opt-in instrumentation of the plugin hot paths.
+
+Instrumented operations (slide opening, parser and reader methods) record
+their duration and the work done on their behalf: bytes and frames read,
+frames decoded, cache hits and misses. Each operation is recorded in
+per-operation histograms, exposed in the Prometheus text format
+(`prometheus_metrics`), and handed to the registered callbacks. Operations
+slower than a threshold are logged with their slide and pyramid level.
+
+Work is counted with `count`, in the context of the running operation,
+so that nested operations (e.g. opening a slide while reading a tile) are
+also included in their parent. When disabled, an instrumented call costs
+a single cached settings lookup and `count` a context variable lookup.
+"""
+
+import inspect
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import lru_cache, wraps
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from pims_plugin_format_dicom.config import get_settings
+
+log = logging.getLogger("pims.formats")
+
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+BYTES_BUCKETS = tuple(4 ** i * 1024 for i in range(10))
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+# Name: buckets and help text.
+COUNTERS = {
+    'bytes_read': (BYTES_BUCKETS, "Bytes of frames read"),
+    'frames_read': (COUNT_BUCKETS, "Frames read"),
+    'frames_decoded': (COUNT_BUCKETS, "Frames decoded"),
+    'tile_cache_hits': (COUNT_BUCKETS, "Decoded tiles found in the tile cache"),
+    'tile_cache_misses': (COUNT_BUCKETS, "Decoded tiles missing from the tile cache"),
+    'tile_cache_skips': (COUNT_BUCKETS, "Decoded tiles too large for the shared tile cache"),
+    'slide_cache_hits': (COUNT_BUCKETS, "Slides found opened in the slide cache"),
+    'slide_cache_misses': (COUNT_BUCKETS, "Slides opened"),
+}
+
+
+class OperationMetrics:
+    """The duration and counted work of a running or finished operation."""
+
+    def __init__(self, operation: str, slide: Optional[str], parent: Optional['OperationMetrics']):
+        self.operation = operation
+        self.slide = slide if slide is not None or parent is None else parent.slide
+        self.level: Optional[int] = None
+        self.parent = parent
+        self.duration = 0.0
+        self.counts: Dict[str, int] = dict()
+        # Work can be counted from I/O threads running in the operation context.
+        self._lock = threading.Lock()
+
+    def add(self, name: str, value: int = 1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def merge_into_parent(self):
+        if self.parent is not None:
+            for name, value in self.counts.items():
+                self.parent.add(name, value)
+            if self.parent.level is None:
+                self.parent.level = self.level
+
+
+_current: ContextVar[Optional[OperationMetrics]] = ContextVar('wsidicom_metrics', default=None)
+
+
+class Histogram:
+    """A Prometheus-like histogram, with cumulative buckets."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> List[Tuple[str, int]]:
+        """Get the (le, cumulative count) of the buckets."""
+        samples, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            samples.append(('+Inf' if bound == float('inf') else f"{bound:g}", total))
+        return samples
+
+
+MetricsCallback = Callable[[OperationMetrics], None]
+
+
+class MetricsRegistry:
+    """Per-operation histograms of durations and counted work."""
+
+    def __init__(self, slow_operation_seconds: float = 0):
+        self.slow_operation_seconds = slow_operation_seconds
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, str], Histogram] = dict()
+        self._callbacks: List[MetricsCallback] = []
+
+    def add_callback(self, callback: MetricsCallback):
+        """Call `callback` with the metrics of every finished operation."""
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback: MetricsCallback):
+        self._callbacks.remove(callback)
+
+    def _histogram(self, name: str, operation: str, buckets: Sequence[float]) -> Histogram:
+        histogram = self._histograms.get((name, operation))
+        if histogram is None:
+            histogram = self._histograms[(name, operation)] = Histogram(buckets)
+        return histogram
+
+    def record(self, metrics: OperationMetrics):
+        with self._lock:
+            self._histogram('duration_seconds', metrics.operation, DURATION_BUCKETS) \
+                .observe(metrics.duration)
+            for name, value in metrics.counts.items():
+                self._histogram(name, metrics.operation, COUNTERS[name][0]).observe(value)
+
+        if 0 < self.slow_operation_seconds <= metrics.duration:
+            counts = ", ".join(f"{name}={value}" for name, value in sorted(metrics.counts.items()))
+            log.warning(
+                f"Slow WSI DICOM {metrics.operation} of {metrics.slide} "
+                f"(level {metrics.level}): {metrics.duration:.3f} s ({counts})"
+            )
+        for callback in self._callbacks:
+            try:
+                callback(metrics)
+            except Exception as e:
+                log.warning(f"WSI DICOM metrics callback failed: {e}")
+
+    def render_prometheus(self) -> str:
+        """Get the histograms in the Prometheus text exposition format."""
+        helps = dict(duration_seconds="Duration of operations, in seconds")
+        helps.update({name: text for name, (_, text) in COUNTERS.items()})
+
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._histograms}):
+                metric = f"wsidicom_{name}"
+                lines += [f"# HELP {metric} {helps[name]}.", f"# TYPE {metric} histogram"]
+                for (other, operation), histogram in sorted(self._histograms.items()):
+                    if other != name:
+                        continue
+                    labels = f'operation="{operation}"'
+                    for le, count in histogram.samples():
+                        lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {count}')
+                    lines.append(f"{metric}_sum{{{labels}}} {histogram.sum:g}")
+                    lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+
+@lru_cache()
+def get_metrics() -> Optional[MetricsRegistry]:
+    """Get the process-wide metrics registry, or None if instrumentation is disabled."""
+    settings = get_settings()
+    if not settings.metrics_enabled:
+        return None
+    return MetricsRegistry(settings.metrics_slow_operation_seconds)
+
+
+def prometheus_metrics() -> str:
+    """Get the plugin metrics in the Prometheus text exposition format (empty if disabled)."""
+    registry = get_metrics()
+    return registry.render_prometheus() if registry is not None else ""
+
+
+def count(name: str, value: int = 1):
+    """Count work done for the running operation, if any."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add(name, value)
+
+
+def set_level(level: int):
+    """Set the pyramid level read by the running operation, if any."""
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.level = level
+
+
+def _slide_of(args) -> Optional[str]:
+    # Parser and reader methods, functions of a format or of a slide path.
+    if not args:
+        return None
+    if isinstance(args[0], str):
+        return args[0]
+    path = getattr(getattr(args[0], 'format', args[0]), 'path', None)
+    return str(path) if path is not None else None
+
+
+def _start(operation: str, args) -> Tuple[OperationMetrics, object, float]:
+    metrics = OperationMetrics(operation, _slide_of(args), _current.get())
+    return metrics, _current.set(metrics), time.perf_counter()
+
+
+def _finish(registry: MetricsRegistry, metrics: OperationMetrics, token, start: float):
+    metrics.duration = time.perf_counter() - start
+    _current.reset(token)
+    metrics.merge_into_parent()
+    registry.record(metrics)
+
+
+def instrumented(operation: str):
+    """Decorate a function or coroutine function as an instrumented operation."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                registry = get_metrics()
+                if registry is None:
+                    return await func(*args, **kwargs)
+                metrics, token, start = _start(operation, args)
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    _finish(registry, metrics, token, start)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            registry = get_metrics()
+            if registry is None:
+                return func(*args, **kwargs)
+            metrics, token, start = _start(operation, args)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _finish(registry, metrics, token, start)
+        return wrapper
+    return decorator
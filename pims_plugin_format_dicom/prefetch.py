@@ -0,0 +1,213 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Speculative tile prefetching.
+
+Viewers request predictable neighbourhoods: the next tiles in the panning
+direction, adjacent tiles, and the parent or children tiles when zooming.
+The prefetcher watches the tiles read per slide and session, and reads the
+likely next tiles in the background, so that they are in the tile cache
+(or at least in the OS page cache) when requested.
+
+The session is taken from the `prefetch_session` context variable, that
+the application can set per request (e.g. from a header). Prefetching runs
+on its own small thread pool, with a bounded number of pending prefetches;
+pending prefetches of a session are cancelled when it reads another tile.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Dict, Hashable, List, Optional, Tuple
+
+from pims_plugin_format_dicom.config import get_settings
+
+if TYPE_CHECKING:
+    from pims.formats.utils.structures.pyramid import PyramidTier
+    from pims.processing.region import Tile
+
+log = logging.getLogger("pims.formats")
+
+prefetch_session: ContextVar[Optional[str]] = ContextVar('wsidicom_prefetch_session', default=None)
+
+# Tier level, tx, ty
+TileKey = Tuple[int, int, int]
+
+
+def _sign(value: int) -> int:
+    return (value > 0) - (value < 0)
+
+
+def _scale_between(tier: 'PyramidTier', other: 'PyramidTier') -> Tuple[float, float]:
+    return tier.width / other.width, tier.height / other.height
+
+
+def predict_tiles(previous: Optional[TileKey], current: 'Tile') -> List[TileKey]:
+    """
+    Get the tiles likely to be read after `current`, most likely first: the
+    next tiles in the panning direction, the adjacent tiles, then the parent
+    and children tiles.
+    """
+    tier = current.tier
+    pyramid = tier.pyramid
+    level, tx, ty = tier.level, current.tx, current.ty
+
+    candidates = []
+    if previous is not None and previous[0] == level and previous[1:] != (tx, ty):
+        dx, dy = _sign(tx - previous[1]), _sign(ty - previous[2])
+        candidates += [(level, tx + dx, ty + dy), (level, tx + 2 * dx, ty + 2 * dy)]
+    candidates += [(level, tx + 1, ty), (level, tx - 1, ty), (level, tx, ty + 1), (level, tx, ty - 1)]
+
+    if level + 1 < pyramid.n_levels:
+        sx, sy = _scale_between(pyramid.tiers[level + 1], tier)
+        candidates.append((level + 1, int(tx * sx), int(ty * sy)))
+    if level > 0:
+        child = pyramid.tiers[level - 1]
+        sx, sy = _scale_between(child, tier)
+        x0, y0 = int(tx * sx), int(ty * sy)
+        candidates += [
+            (level - 1, x, y)
+            for y in range(y0, max(y0 + 1, int((ty + 1) * sy)))
+            for x in range(x0, max(x0 + 1, int((tx + 1) * sx)))
+        ]
+
+    predicted = []
+    for key in candidates:
+        candidate_tier = pyramid.tiers[key[0]]
+        if key != (level, tx, ty) and key not in predicted \
+                and 0 <= key[1] < candidate_tier.max_tx and 0 <= key[2] < candidate_tier.max_ty:
+            predicted.append(key)
+    return predicted
+
+
+class TilePrefetcher:
+    """
+    Background prefetcher of tiles, bounded by a number of threads and of
+    pending prefetches. Prefetched tiles are remembered (up to `max_tracked`)
+    to report hit rates: a hit is a read of a tile whose prefetch completed.
+    """
+
+    def __init__(self, workers: int, max_pending: int, max_predictions: int, max_tracked: int = 4096):
+        self.max_pending = max_pending
+        self.max_predictions = max_predictions
+        self.max_tracked = max_tracked
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wsidicom-prefetch")
+
+        # Reentrant, as cancelling a future runs its done callback right away.
+        self._lock = threading.RLock()
+        self._last: "OrderedDict[Hashable, TileKey]" = OrderedDict()
+        self._pending: Dict[Hashable, List[Tuple[Future, Hashable]]] = dict()
+        self._prefetched: "OrderedDict[Hashable, Future]" = OrderedDict()
+        self._n_pending = 0
+
+        self.issued = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.dropped = 0
+        self.hits = 0
+
+    @staticmethod
+    def _tile_id(slide: Hashable, tier: 'PyramidTier', key: TileKey, planes: Hashable) -> Hashable:
+        # Normalized and native pyramids can have the same levels.
+        return slide, tier.tile_width, tier.tile_height, key, planes
+
+    def observe(
+        self, slide: Hashable, tile: 'Tile', fetch: Callable[['Tile'], None], planes: Hashable = None
+    ):
+        """
+        Record that a tile of a slide is read for the current session, and
+        prefetch its likely successors with `fetch`. `planes` identifies the
+        read channels and z-slice, prefetches use the same ones.
+        """
+        tier = tile.tier
+        session = (slide, prefetch_session.get(), planes)
+        current = (tier.level, tile.tx, tile.ty)
+
+        current_id = self._tile_id(slide, tier, current, planes)
+
+        with self._lock:
+            prefetched = self._prefetched.pop(current_id, None)
+            if prefetched is not None and prefetched.done() and not prefetched.cancelled():
+                self.hits += 1
+
+            for future, tile_id in self._pending.pop(session, []):
+                # The prefetch of the read tile is left running.
+                if tile_id != current_id and future.cancel():
+                    self.cancelled += 1
+                    self._prefetched.pop(tile_id, None)
+
+            previous = self._last.pop(session, None)
+            self._last[session] = current
+            while len(self._last) > self.max_tracked:
+                evicted, _ = self._last.popitem(last=False)
+                self._pending.pop(evicted, None)
+
+            futures = []
+            for key in predict_tiles(previous, tile)[:self.max_predictions]:
+                tile_id = self._tile_id(slide, tier, key, planes)
+                if tile_id in self._prefetched:
+                    continue
+                if self._n_pending >= self.max_pending:
+                    self.dropped += 1
+                    continue
+                future = self._executor.submit(
+                    self._fetch, fetch, tier.pyramid.tiers[key[0]].get_txty_tile(key[1], key[2])
+                )
+                self._n_pending += 1
+                self.issued += 1
+                future.add_done_callback(self._done)
+                futures.append((future, tile_id))
+
+                self._prefetched[tile_id] = future
+                while len(self._prefetched) > self.max_tracked:
+                    self._prefetched.popitem(last=False)
+            self._pending[session] = futures
+
+    @staticmethod
+    def _fetch(fetch: Callable[['Tile'], None], tile: 'Tile'):
+        try:
+            fetch(tile)
+        except Exception as e:
+            log.debug(f"Tile prefetch failed: {e}")
+
+    def _done(self, future: Future):
+        with self._lock:
+            self._n_pending -= 1
+            if not future.cancelled():
+                self.completed += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                'issued': self.issued,
+                'completed': self.completed,
+                'cancelled': self.cancelled,
+                'dropped': self.dropped,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.completed if self.completed else 0.0,
+            }
+
+
+@lru_cache()
+def get_prefetcher() -> Optional[TilePrefetcher]:
+    settings = get_settings()
+    if not settings.prefetch_enabled:
+        return None
+    return TilePrefetcher(
+        settings.prefetch_workers, settings.prefetch_max_pending, settings.prefetch_max_tiles
+    )
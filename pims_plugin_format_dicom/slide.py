@@ -0,0 +1,395 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Slides opened level by level.
+
+`WsiDicom.open` parses the full header of every instance of a slide
+directory (all levels, labels, overviews and annotations) before anything
+can be read. A lazy slide only reads a minimal header of each file (SOP
+class, image flavor, slide UIDs, image and tile size, pixel spacing),
+stopping before the per-frame functional groups and the pixel data. The
+files of a pyramid level, of the labels, of the overviews or of the
+annotations are opened with wsidicom the first time they are used.
+
+A lazy slide exposes the subset of the `WsiDicom` interface used by the
+plugin, and levels, labels and overviews are wsidicom objects once opened.
+
+Whether the pixel data of files is parsed when they are opened (to locate
+their frames) is given to each open, instead of through the process-wide
+wsidicom settings.
+"""
+
+import logging
+import math
+import threading
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from PIL import Image
+from pydicom.errors import InvalidDicomError
+from pydicom.filereader import read_partial
+from pydicom.tag import BaseTag, Tag
+from wsidicom.errors import WsiDicomNotFoundError
+from wsidicom.file import WsiDicomFile
+from wsidicom.geometry import Point, Region, Size, SizeMm
+from wsidicom.graphical_annotations import AnnotationInstance
+from wsidicom.instance import WsiDicomLevel, WsiInstance
+from wsidicom.series import WsiDicomLabels, WsiDicomLevels, WsiDicomOverviews
+from wsidicom.uid import ANN_SOP_CLASS_UID, WSI_SOP_CLASS_UID, SlideUids
+from wsidicom.wsidicom import WsiDicom
+
+log = logging.getLogger("pims.formats")
+
+HEADER_TAGS = [
+    Tag(keyword) for keyword in (
+        'SOPClassUID', 'ImageType', 'StudyInstanceUID', 'SeriesInstanceUID',
+        'FrameOfReferenceUID', 'Rows', 'Columns', 'TotalPixelMatrixColumns',
+        'TotalPixelMatrixRows', 'SharedFunctionalGroupsSequence'
+    )
+]
+# Per-frame functional groups and pixel data come after the last header tag.
+LAST_HEADER_TAG = Tag('SharedFunctionalGroupsSequence')
+
+
+@dataclass(frozen=True)
+class FileHeader:
+    """The attributes of a slide file needed to know what it holds."""
+    path: Path
+    sop_class_uid: str
+    wsi_type: Optional[str] = None
+    slide_uids: Optional[Tuple[str, str, Optional[str]]] = None
+    size: Optional[Tuple[int, int]] = None
+    tile_size: Optional[Tuple[int, int]] = None
+    pixel_spacing: Optional[Tuple[float, float]] = None
+
+
+def _stop_after_header(tag: BaseTag, vr: Optional[str], length: int) -> bool:
+    return tag > LAST_HEADER_TAG
+
+
+def read_file_header(path: Path) -> Optional[FileHeader]:
+    """Read the minimal header of a file, or None if it is not a DICOM file."""
+    try:
+        with open(path, 'rb') as f:
+            ds = read_partial(f, stop_when=_stop_after_header, specific_tags=HEADER_TAGS)
+    except (OSError, InvalidDicomError, EOFError):
+        return None
+
+    sop_class_uid = str(ds.get('SOPClassUID', ''))
+    if sop_class_uid != WSI_SOP_CLASS_UID:
+        return FileHeader(path, sop_class_uid)
+
+    image_type = ds.get('ImageType')
+    pixel_spacing = None
+    try:
+        pixel_measure = ds.SharedFunctionalGroupsSequence[0].PixelMeasuresSequence[0]
+        pixel_spacing = tuple(float(v) for v in pixel_measure.PixelSpacing)
+    except (AttributeError, IndexError):
+        pass
+    frame_of_reference = ds.get('FrameOfReferenceUID')
+    try:
+        return FileHeader(
+            path, sop_class_uid,
+            wsi_type=image_type[2] if image_type is not None and len(image_type) > 2 else None,
+            slide_uids=(
+                str(ds.StudyInstanceUID), str(ds.SeriesInstanceUID),
+                str(frame_of_reference) if frame_of_reference is not None else None
+            ),
+            size=(int(ds.TotalPixelMatrixColumns), int(ds.TotalPixelMatrixRows)),
+            tile_size=(int(ds.Columns), int(ds.Rows)),
+            pixel_spacing=pixel_spacing,
+        )
+    except (AttributeError, TypeError, ValueError):
+        # Not usable by wsidicom either.
+        return FileHeader(path, sop_class_uid)
+
+
+def scan_slide(path: Union[str, Path]) -> List[FileHeader]:
+    """Read the minimal header of the (non-hidden) files of a slide directory."""
+    headers = []
+    for filepath in sorted(Path(path).iterdir()):
+        if filepath.name.startswith('.') or not filepath.is_file():
+            continue
+        header = read_file_header(filepath)
+        if header is not None:
+            headers.append(header)
+    return headers
+
+
+def _open_files(paths: List[Path], parse_pixel_data: Optional[bool] = None) -> List[WsiDicomFile]:
+    return [WsiDicomFile(path, parse_pixel_data) for path in paths]
+
+
+def _close_all(items):
+    for item in items:
+        item.close()
+
+
+def _pyramid_level(pixel_spacing: Tuple[float, float], base_pixel_spacing: Tuple[float, float]) -> int:
+    # As assigned by wsidicom.
+    return int(round(math.log2(pixel_spacing[0] / base_pixel_spacing[0])))
+
+
+class LazyLevels:
+    """Pyramid levels of a slide, each opened on first use."""
+
+    def __init__(
+        self, level_files: Dict[int, List[Path]], sizes: Dict[int, Size],
+        slide_uids: SlideUids, base_tile_size: Size, base_pixel_spacing: SizeMm,
+        parse_pixel_data: Optional[bool] = None
+    ):
+        self._level_files = dict(sorted(level_files.items()))
+        self._sizes = sizes
+        self._slide_uids = slide_uids
+        self._base_tile_size = base_tile_size
+        self._base_pixel_spacing = base_pixel_spacing
+        self._parse_pixel_data = parse_pixel_data
+
+        self._lock = threading.Lock()
+        self._opened: Dict[int, WsiDicomLevel] = dict()
+
+    @property
+    def levels(self) -> List[int]:
+        return list(self._level_files.keys())
+
+    def size(self, level: int) -> Size:
+        """Get the size of a level, without opening it."""
+        return self._sizes[level]
+
+    def get_level(self, level: int) -> WsiDicomLevel:
+        wsi_level = self._opened.get(level)
+        if wsi_level is not None:
+            return wsi_level
+
+        with self._lock:
+            wsi_level = self._opened.get(level)
+            if wsi_level is None:
+                if level not in self._level_files:
+                    raise WsiDicomNotFoundError(f"Level of {level}", "level series")
+                instances = WsiInstance.open(
+                    _open_files(self._level_files[level], self._parse_pixel_data),
+                    self._slide_uids, self._base_tile_size
+                )
+                wsi_level = WsiDicomLevel(instances, self._base_pixel_spacing)
+                self._opened[level] = wsi_level
+        return wsi_level
+
+    @property
+    def groups(self) -> List[WsiDicomLevel]:
+        return [self.get_level(level) for level in self.levels]
+
+    @property
+    def base_level(self) -> WsiDicomLevel:
+        return self.get_level(self.levels[0])
+
+    @property
+    def files(self) -> List[Path]:
+        return [path for paths in self._level_files.values() for path in paths]
+
+    @property
+    def datasets(self):
+        return [dataset for group in self.groups for dataset in group.datasets]
+
+    def get_closest_by_size(self, size: Size) -> WsiDicomLevel:
+        """Get the smallest level at least as wide as `size`, as wsidicom does."""
+        closest = None
+        for level, level_size in self._sizes.items():
+            if size.width <= level_size.width and (
+                closest is None or level_size.width <= self._sizes[closest].width
+            ):
+                closest = level
+        if closest is None:
+            raise WsiDicomNotFoundError(f"Level for size {size}", "level series")
+        return self.get_level(closest)
+
+    def close(self):
+        with self._lock:
+            _close_all(self._opened.values())
+            self._opened.clear()
+
+
+class LazySeries:
+    """Label or overview series of a slide, opened on first use."""
+
+    def __init__(
+        self, opener: Callable[[List[WsiInstance]], object], paths: List[Path], slide_uids: SlideUids,
+        parse_pixel_data: Optional[bool] = None
+    ):
+        self._opener = opener
+        self._paths = paths
+        self._slide_uids = slide_uids
+        self._parse_pixel_data = parse_pixel_data
+
+        self._lock = threading.Lock()
+        self._series = None
+
+    def _open(self):
+        if self._series is None:
+            with self._lock:
+                if self._series is None:
+                    instances = WsiInstance.open(
+                        _open_files(self._paths, self._parse_pixel_data), self._slide_uids
+                    )
+                    self._series = self._opener(instances)
+        return self._series
+
+    def __bool__(self) -> bool:
+        return len(self._paths) > 0
+
+    def __len__(self) -> int:
+        return len(self._open()) if self._paths else 0
+
+    def __getitem__(self, index: int):
+        return self._open()[index]
+
+    @property
+    def groups(self):
+        return self._open().groups if self._paths else []
+
+    @property
+    def files(self) -> List[Path]:
+        return list(self._paths)
+
+    @property
+    def datasets(self):
+        return self._open().datasets if self._paths else []
+
+    def close(self):
+        with self._lock:
+            if self._series is not None:
+                self._series.close()
+                self._series = None
+
+
+class LazySlide:
+    """A slide whose levels, labels, overviews and annotations are opened on first use."""
+
+    def __init__(self, headers: List[FileHeader], parse_pixel_data: Optional[bool] = None):
+        level_headers = [h for h in headers if h.wsi_type == WsiDicomLevels.WSI_TYPE]
+        base = level_headers[0]
+        for header in level_headers[1:]:
+            if header.size[0] > base.size[0]:
+                base = header
+        slide_uids = SlideUids(*base.slide_uids)
+
+        # Files of other slides, or levels of another tile size, are ignored as by wsidicom.
+        def _of_slide(header):
+            return header.slide_uids == base.slide_uids
+
+        level_files: Dict[int, List[Path]] = dict()
+        sizes: Dict[int, Size] = dict()
+        for header in level_headers:
+            if not _of_slide(header) or header.tile_size != base.tile_size:
+                continue
+            level = _pyramid_level(header.pixel_spacing, base.pixel_spacing)
+            level_files.setdefault(level, []).append(header.path)
+            sizes[level] = Size(*header.size)
+
+        self.levels = LazyLevels(
+            level_files, sizes, slide_uids, Size(*base.tile_size), SizeMm.from_tuple(base.pixel_spacing),
+            parse_pixel_data
+        )
+        self.labels = LazySeries(WsiDicomLabels.open, [
+            h.path for h in headers if h.wsi_type == WsiDicomLabels.WSI_TYPE and _of_slide(h)
+        ], slide_uids, parse_pixel_data)
+        self.overviews = LazySeries(WsiDicomOverviews.open, [
+            h.path for h in headers if h.wsi_type == WsiDicomOverviews.WSI_TYPE and _of_slide(h)
+        ], slide_uids, parse_pixel_data)
+        self._annotation_files = [h.path for h in headers if h.sop_class_uid == ANN_SOP_CLASS_UID]
+
+    @classmethod
+    def open(
+        cls, path: Union[str, Path], parse_pixel_data: Optional[bool] = None
+    ) -> Union['LazySlide', WsiDicom]:
+        """
+        Open a slide lazily. Slides whose levels can not be told apart from
+        their minimal header (no pixel spacing) are fully opened by wsidicom.
+        """
+        headers = scan_slide(path)
+        levels = [h for h in headers if h.wsi_type == WsiDicomLevels.WSI_TYPE]
+        if not levels or any(h.pixel_spacing is None for h in levels):
+            log.debug(f"Open WSI DICOM slide {path} without lazy opening")
+            return _open_wsi_dicom(headers, parse_pixel_data)
+        return cls(headers, parse_pixel_data)
+
+    @cached_property
+    def annotations(self) -> List[AnnotationInstance]:
+        return AnnotationInstance.open(self._annotation_files)
+
+    @property
+    def annotation_files(self) -> List[Path]:
+        return list(self._annotation_files)
+
+    @property
+    def files(self) -> List[Path]:
+        return self.levels.files + self.labels.files + self.overviews.files
+
+    @property
+    def datasets(self):
+        return self.levels.datasets + self.labels.datasets + self.overviews.datasets
+
+    def read_thumbnail(
+        self, size: Tuple[int, int] = (512, 512), z: Optional[float] = None, path: Optional[str] = None
+    ) -> Image.Image:
+        """Read a thumbnail no larger than `size`, from a single level, as `WsiDicom` does."""
+        level = self.levels.get_closest_by_size(Size.from_tuple(size))
+        image = level.get_region(Region(position=Point(0, 0), size=level.size), z, path)
+        image.thumbnail(size, resample=Image.Resampling.BILINEAR)
+        return image
+
+    def close(self):
+        _close_all((self.levels, self.labels, self.overviews))
+
+
+def annotation_files(slide: Union[LazySlide, WsiDicom], path: Union[str, Path]) -> List[Path]:
+    """Get the paths of the annotation files of a slide opened from `path`."""
+    files = getattr(slide, 'annotation_files', None)
+    if files is None:
+        # Slides opened by wsidicom do not keep them.
+        files = [h.path for h in scan_slide(path) if h.sop_class_uid == ANN_SOP_CLASS_UID]
+    return files
+
+
+def open_wsi_dicom(path: Union[str, Path], parse_pixel_data: Optional[bool] = None) -> WsiDicom:
+    """Open all the files of a slide, as `WsiDicom.open` does."""
+    return _open_wsi_dicom(scan_slide(path), parse_pixel_data)
+
+
+def _open_wsi_dicom(headers: List[FileHeader], parse_pixel_data: Optional[bool] = None) -> WsiDicom:
+    files = {
+        WsiDicomLevels.WSI_TYPE: [], WsiDicomLabels.WSI_TYPE: [], WsiDicomOverviews.WSI_TYPE: []
+    }
+    for header in headers:
+        if header.sop_class_uid != WSI_SOP_CLASS_UID:
+            continue
+        wsi_file = WsiDicomFile(header.path, parse_pixel_data)
+        if wsi_file.wsi_type in files:
+            files[wsi_file.wsi_type].append(wsi_file)
+        else:
+            wsi_file.close()
+
+    level_files = files[WsiDicomLevels.WSI_TYPE]
+    if not level_files:
+        raise WsiDicomNotFoundError("Level files", "slide")
+    base_dataset = WsiDicom._get_base_dataset(level_files)
+    slide_uids = base_dataset.uids.slide
+    return WsiDicom(
+        WsiDicomLevels.open(WsiInstance.open(level_files, slide_uids, base_dataset.tile_size)),
+        WsiDicomLabels.open(WsiInstance.open(files[WsiDicomLabels.WSI_TYPE], slide_uids)),
+        WsiDicomOverviews.open(WsiInstance.open(files[WsiDicomOverviews.WSI_TYPE], slide_uids)),
+        AnnotationInstance.open([h.path for h in headers if h.sop_class_uid == ANN_SOP_CLASS_UID])
+    )
@@ -0,0 +1,466 @@
+#  * Copyright (c) 2020-2021. Authors: see NOTICE file.
+#  *
+#  * Licensed under the GNU Lesser General Public License, Version 2.1 (the "License");
+#  * you may not use this file except in compliance with the License.
+#  * You may obtain a copy of the License at
+#  *
+#  *      https://www.gnu.org/licenses/lgpl-2.1.txt
+#  *
+#  * Unless required by applicable law or agreed to in writing, software
+#  * distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+"""
+Frame level access to WSI DICOM image data, used to assemble regions
+directly from the stored frames.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from itertools import groupby
+from typing import TYPE_CHECKING, Collection, Iterator, List, Optional, Tuple
+
+import numpy as np
+import shapely
+from PIL import Image
+from wsidicom.geometry import Point, Size
+from wsidicom.image_data import ImageData
+from wsidicom.instance import WsiDicomGroup
+from wsidicom.wsidicom import WsiDicom
+
+from pims_plugin_format_dicom.cache import TileCache
+from pims_plugin_format_dicom.config import get_settings
+from pims_plugin_format_dicom.metrics import count
+
+if TYPE_CHECKING:
+    from pims_plugin_format_dicom.frames import FrameIndex
+
+TileIndex = Tuple[int, int]
+
+# Largest reduction factor of frame decoding (JPEG DCT scaling goes down to 1/8).
+MAX_REDUCTION = 8
+# Image data, focal plane and optical path.
+Plane = Tuple[ImageData, float, str]
+
+
+@lru_cache()
+def get_decode_executor() -> Optional[ThreadPoolExecutor]:
+    """
+    Get the process-wide thread pool used to decode frames, or None if
+    parallel decoding is disabled. Sharing a single pool bounds the number
+    of decoding threads whatever the number of concurrent requests.
+    """
+    workers = get_settings().decode_workers
+    if workers <= 1:
+        return None
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wsidicom-decode")
+
+
+def nearest_focal_plane(focal_planes: Collection[float], z: float) -> float:
+    """
+    Get the focal plane closest to `z` among the focal planes of a level,
+    as levels do not always hold all the focal planes of the base level.
+    """
+    if z in focal_planes:
+        return z
+    return min(sorted(focal_planes), key=lambda plane: abs(plane - z))
+
+
+def tile_range(
+    left: int, top: int, width: int, height: int, tile_size: Tuple[int, int]
+) -> List[TileIndex]:
+    """Get the (tx, ty) indexes of the tiles intersecting a pixel region, row by row."""
+    tile_width, tile_height = tile_size
+    tx_range = range(left // tile_width, (left + width - 1) // tile_width + 1)
+    ty_range = range(top // tile_height, (top + height - 1) // tile_height + 1)
+    return [(tx, ty) for ty in ty_range for tx in tx_range]
+
+
+def geometry_tiles(
+    geometry: shapely.Geometry, tiles: List[TileIndex], tile_size: Tuple[int, int],
+    scale: Tuple[float, float] = (1, 1)
+) -> List[TileIndex]:
+    """
+    Select the tiles intersecting a geometry, in the given order. The
+    geometry is in full resolution pixels, and `scale` is the number of full
+    resolution pixels per pixel of the tiles' level along each axis.
+    """
+    if not tiles:
+        return []
+    indexes = np.asarray(tiles, dtype=np.float64)
+    width, height = tile_size[0] * scale[0], tile_size[1] * scale[1]
+    left, top = indexes[:, 0] * width, indexes[:, 1] * height
+    # Tiles do not include their right and bottom edges, which belong to the next tiles.
+    right, bottom = left + width, top + height
+    boxes = shapely.box(left, top, np.nextafter(right, left), np.nextafter(bottom, top))
+    shapely.prepare(geometry)
+    intersects = shapely.intersects(geometry, boxes)
+    return [tile for tile, keep in zip(tiles, intersects) if keep]
+
+
+def read_frames(
+    image_data: ImageData, tiles: List[TileIndex], z: float, path: str,
+    frames: Optional['FrameIndex'] = None
+) -> List[bytes]:
+    """
+    Read the encoded frames of the tiles. Sparse tiles give a blank frame.
+    Frames are read through the frame index if given, sorted by file offset
+    and coalesced.
+    """
+    if frames is not None:
+        encoded = frames.read_tiles(image_data, [Point(tx, ty) for tx, ty in tiles], z, path)
+    else:
+        encoded = [
+            image_data.get_encoded_tile(Point(tx, ty), z, path, crop=False)
+            for tx, ty in tiles
+        ]
+    count('frames_read', len(encoded))
+    count('bytes_read', sum(len(frame) for frame in encoded))
+    return encoded
+
+
+def reduction_factor(
+    width: int, height: int, out_width: int, out_height: int, tile_size: Tuple[int, int]
+) -> int:
+    """
+    Get the largest power of 2 (up to MAX_REDUCTION) by which a region can
+    be decoded so that it stays at least as large as the asked output, and
+    that divides the tile size.
+    """
+    factor = 1
+    while factor < MAX_REDUCTION \
+            and width // (factor * 2) >= out_width and height // (factor * 2) >= out_height \
+            and tile_size[0] % (factor * 2) == 0 and tile_size[1] % (factor * 2) == 0:
+        factor *= 2
+    return factor
+
+
+def decode_frame(frame: bytes, factor: int = 1) -> np.ndarray:
+    """
+    Decode a frame, reduced by a power of 2 factor. JPEG frames are decoded
+    at the reduced size in the DCT domain (draft mode), JPEG 2000 frames at
+    the matching resolution level. Other frames are box-filtered after decoding.
+    """
+    with Image.open(BytesIO(frame)) as image:
+        if factor == 1:
+            return np.asarray(image)
+
+        size = (image.width // factor, image.height // factor)
+        if image.format == 'JPEG':
+            image.draft(image.mode, size)
+        elif image.format == 'JPEG2000':
+            image.reduce = factor.bit_length() - 1
+        image.load()
+        if image.size != size:
+            image = image.resize(size, Image.Resampling.BOX)
+        return np.asarray(image)
+
+
+def empty_region(
+    image_data: ImageData, width: int, height: int, n_planes: int = 1, dtype=np.uint8
+) -> np.ndarray:
+    """Allocate a region of `n_planes` planes, of the dtype of the decoded frames."""
+    n_channels = image_data.samples_per_pixel * n_planes
+    if n_channels == 1:
+        return np.empty((height, width), dtype=dtype)
+    return np.empty((height, width, n_channels), dtype=dtype)
+
+
+def paste_tile(
+    out: np.ndarray, tile_pixels: np.ndarray, tile: TileIndex,
+    tile_size: Tuple[int, int], left: int, top: int
+):
+    """Copy the part of a decoded tile intersecting the region into `out`."""
+    tile_left = tile[0] * tile_size[0]
+    tile_top = tile[1] * tile_size[1]
+    height, width = out.shape[:2]
+
+    x0, x1 = max(left, tile_left), min(left + width, tile_left + tile_size[0])
+    y0, y1 = max(top, tile_top), min(top + height, tile_top + tile_size[1])
+    out[y0 - top:y1 - top, x0 - left:x1 - left] = \
+        tile_pixels[y0 - tile_top:y1 - tile_top, x0 - tile_left:x1 - tile_left]
+
+
+def plane_views(out: np.ndarray, n_planes: int, samples_per_pixel: int) -> List[np.ndarray]:
+    """Get the views of `out` holding each plane, stacked along the channel axis."""
+    if n_planes == 1:
+        return [out]
+    if samples_per_pixel == 1:
+        return [out[:, :, i] for i in range(n_planes)]
+    return [
+        out[:, :, i * samples_per_pixel:(i + 1) * samples_per_pixel]
+        for i in range(n_planes)
+    ]
+
+
+def read_region(
+    image_data: ImageData, left: int, top: int, width: int, height: int,
+    z: float, path: str, executor: Optional[ThreadPoolExecutor] = None,
+    cache: Optional[TileCache] = None, cache_key: Tuple = (), factor: int = 1,
+    frames: Optional['FrameIndex'] = None
+) -> np.ndarray:
+    """
+    Read a pixel region of an image data. Intersecting frames are read in
+    bulk, then decoded directly into a preallocated output array. Decoding
+    is concurrent if an executor is given and enough frames are decoded.
+
+    If a cache is given, decoded tiles are looked up and stored in it under
+    `cache_key + (tx, ty)`, where `cache_key` identifies the image data plane.
+
+    If a reduction factor is given, frames are decoded at a reduced
+    resolution and the output covers the region reduced by this factor.
+
+    If a frame index is given, frames are read through it.
+    """
+    return read_planes(
+        [(image_data, z, path)], left, top, width, height,
+        executor=executor, cache=cache, cache_keys=[cache_key], factor=factor,
+        frames=frames
+    )
+
+
+def read_planes(
+    planes: List[Plane], left: int, top: int, width: int, height: int,
+    executor: Optional[ThreadPoolExecutor] = None,
+    cache: Optional[TileCache] = None, cache_keys: Optional[List[Tuple]] = None,
+    factor: int = 1, frames: Optional['FrameIndex'] = None,
+    tiles: Optional[Collection[TileIndex]] = None, background: int = 0
+) -> np.ndarray:
+    """
+    Read a pixel region of several planes (focal planes, optical paths) of
+    a level, stacked along the channel axis of a single output array.
+    If `tiles` is given, only these tiles are read and the rest of the
+    region is filled with `background`.
+
+    Frames of all planes are read in one batch, plane by plane and row by
+    row, which is the frame order of TILED_FULL instances. They are decoded
+    together, concurrently if an executor is given and enough frames are
+    decoded. Cache keys, reduction factor and frame index are described in
+    `read_region`.
+    """
+    region = PlanesRegion(
+        planes, left, top, width, height, cache, cache_keys, factor, frames, tiles, background
+    )
+    if region.single_tile is not None:
+        return region.single_tile
+
+    frames = region.read_frames()
+    count('frames_decoded', len(frames))
+    if executor is None or len(frames) < get_settings().parallel_decode_min_tiles:
+        for item, frame in zip(region.missing, frames):
+            region.decode_and_paste(item, frame)
+    else:
+        # Consume the iterator to propagate decoding errors.
+        for _ in executor.map(region.decode_and_paste, region.missing, frames):
+            pass
+    return region.out
+
+
+class PlanesRegion:
+    """
+    A pixel region of several planes being read. Cached tiles are pasted
+    into the output on creation, `missing` lists the (plane, tile) items
+    whose frame must still be read (`read_frame`, or `read_frames` for all
+    of them) then decoded and pasted (`decode_and_paste`), in any order and
+    from any thread.
+
+    If the region lies within a single tile of a single plane and NumPy
+    output is enabled, `single_tile` holds the result and nothing is missing.
+
+    If `only_tiles` is given, the other tiles are not read and their part
+    of the region is filled with `background`.
+
+    The output (`out`) is allocated when the first tile is pasted, with the
+    dtype of its pixels, so that frames deeper than 8 bits are not truncated.
+    """
+
+    def __init__(
+        self, planes: List[Plane], left: int, top: int, width: int, height: int,
+        cache: Optional[TileCache] = None, cache_keys: Optional[List[Tuple]] = None,
+        factor: int = 1, frames: Optional['FrameIndex'] = None,
+        only_tiles: Optional[Collection[TileIndex]] = None, background: int = 0
+    ):
+        image_data = planes[0][0]
+        tiles = tile_range(left, top, width, height, image_data.tile_size.to_tuple())
+        if only_tiles is not None:
+            only_tiles = set(only_tiles)
+            tiles = [tile for tile in tiles if tile in only_tiles]
+        if cache_keys is None:
+            cache_keys = [()] * len(planes)
+
+        if factor > 1:
+            # Work in the reduced pixel space from now on.
+            cache_keys = [cache_key + ('reduced', factor) for cache_key in cache_keys]
+            right, bottom = -(-(left + width) // factor), -(-(top + height) // factor)
+            left, top = left // factor, top // factor
+            width, height = right - left, bottom - top
+        self.tile_size = (image_data.tile_size.width // factor, image_data.tile_size.height // factor)
+        self.left, self.top = left, top
+        self.cache = cache
+        self.factor = factor
+        self.frames = frames
+
+        self.single_tile = None
+        self.missing = []
+        if len(planes) == 1 and len(tiles) == 1 and only_tiles is None and get_settings().numpy_output:
+            self.single_tile = read_single_tile(
+                planes[0], tiles[0], self.tile_size, left, top, width, height,
+                cache, cache_keys[0], factor, frames
+            )
+            return
+
+        self._image_data = image_data
+        self._shape = (width, height, len(planes))
+        self._background = background if only_tiles is not None else None
+        self._lock = threading.Lock()
+        self._out = None
+        self._views = None
+        for i, (plane, cache_key) in enumerate(zip(planes, cache_keys)):
+            for tile in tiles:
+                tile_pixels = cache.get(cache_key + tile) if cache is not None else None
+                if tile_pixels is None:
+                    self.missing.append((i, plane, cache_key, tile))
+                else:
+                    self._paste(i, tile_pixels, tile)
+        if cache is not None:
+            count('tile_cache_hits', len(planes) * len(tiles) - len(self.missing))
+            count('tile_cache_misses', len(self.missing))
+
+    @property
+    def out(self) -> np.ndarray:
+        if self._out is None:
+            # Nothing pasted.
+            self._allocate(np.uint8)
+        return self._out
+
+    def _allocate(self, dtype):
+        with self._lock:
+            if self._out is None:
+                out = empty_region(self._image_data, *self._shape, dtype=dtype)
+                if self._background is not None:
+                    out.fill(self._background)
+                self._views = plane_views(out, self._shape[2], self._image_data.samples_per_pixel)
+                self._out = out
+
+    def _paste(self, plane: int, tile_pixels: np.ndarray, tile: TileIndex):
+        if self._out is None:
+            self._allocate(tile_pixels.dtype)
+        paste_tile(self._views[plane], tile_pixels, tile, self.tile_size, self.left, self.top)
+
+    def read_frame(self, item) -> bytes:
+        _, (image_data, z, path), _, tile = item
+        frame, = read_frames(image_data, [tile], z, path, self.frames)
+        return frame
+
+    def read_frames(self) -> List[bytes]:
+        """Read the frames of all the missing items at once, plane by plane."""
+        encoded = []
+        for (image_data, z, path), items in groupby(self.missing, key=lambda item: item[1]):
+            encoded += read_frames(image_data, [item[3] for item in items], z, path, self.frames)
+        return encoded
+
+    def decode_and_paste(self, item, frame: bytes):
+        plane, _, cache_key, tile = item
+        tile_pixels = decode_frame(frame, self.factor)
+        if self.cache is not None:
+            self.cache.put(cache_key + tile, tile_pixels)
+        self._paste(plane, tile_pixels, tile)
+
+
+def read_single_tile(
+    plane: Plane, tile: TileIndex, tile_size: Tuple[int, int], left: int, top: int,
+    width: int, height: int, cache: Optional[TileCache], cache_key: Tuple, factor: int,
+    frames: Optional['FrameIndex'] = None
+) -> np.ndarray:
+    """
+    Read a region within a single tile of a plane, as a view of the decoded
+    (or cached) tile when it is contiguous, without any output allocation.
+    The returned array can be read-only.
+    """
+    image_data, z, path = plane
+    tile_pixels = cache.get(cache_key + tile) if cache is not None else None
+    if cache is not None:
+        count('tile_cache_misses' if tile_pixels is None else 'tile_cache_hits')
+    if tile_pixels is None:
+        frame, = read_frames(image_data, [tile], z, path, frames)
+        tile_pixels = decode_frame(frame, factor)
+        count('frames_decoded')
+        if cache is not None:
+            tile_pixels = cache.put(cache_key + tile, tile_pixels)
+
+    x, y = left - tile[0] * tile_size[0], top - tile[1] * tile_size[1]
+    return np.ascontiguousarray(tile_pixels[y:y + height, x:x + width])
+
+
+def read_tiles(
+    planes: List[Plane], tiles: List[TileIndex], executor: Optional[ThreadPoolExecutor] = None,
+    frames: Optional['FrameIndex'] = None, batch_size: int = 64
+) -> Iterator[np.ndarray]:
+    """
+    Read whole tiles of several planes of a level, stacked along the channel
+    axis, and yield them in the given order. Edge tiles are cropped to the
+    image. The tile cache is bypassed, as such reads rarely read a tile twice.
+
+    Tiles are read by batches of `batch_size`: the frames of a batch are
+    read at once (sorted by file offset and coalesced, if a frame index is
+    given), then decoded, concurrently if an executor is given, and each
+    tile is yielded as soon as it is decoded.
+    """
+    image_data = planes[0][0]
+    tile_width, tile_height = image_data.tile_size.to_tuple()
+    width, height = image_data.image_size.to_tuple()
+
+    for start in range(0, len(tiles), batch_size):
+        batch = tiles[start:start + batch_size]
+        encoded = [read_frames(plane_data, batch, z, path, frames) for plane_data, z, path in planes]
+
+        def _decode(i: int) -> np.ndarray:
+            tx, ty = batch[i]
+            w, h = min(tile_width, width - tx * tile_width), min(tile_height, height - ty * tile_height)
+            decoded = [decode_frame(plane_frames[i])[:h, :w] for plane_frames in encoded]
+            if len(planes) == 1:
+                return decoded[0]
+            out = empty_region(image_data, w, h, len(planes), decoded[0].dtype)
+            for view, pixels in zip(plane_views(out, len(planes), image_data.samples_per_pixel), decoded):
+                view[...] = pixels
+            return out
+
+        count('frames_decoded', len(batch) * len(planes))
+        if executor is None:
+            yield from map(_decode, range(len(batch)))
+        else:
+            yield from executor.map(_decode, range(len(batch)))
+
+
+def read_associated(group: WsiDicomGroup, out_width: int, out_height: int) -> Image.Image:
+    """
+    Read an associated image (label, overview) at a size close to, but not
+    smaller than, the asked size. Single-frame JPEG images are decoded at a
+    reduced resolution in the DCT domain (draft mode).
+    """
+    image_data = group.default_instance.image_data
+    if image_data.tiled_size != Size(1, 1) or image_data.tile_size != image_data.image_size:
+        return group.get_default_full()
+
+    frame, = read_frames(image_data, [(0, 0)], image_data.default_z, image_data.default_path)
+    image = Image.open(BytesIO(frame))
+    # No-op for other codecs. The drafted size is never smaller than asked.
+    image.draft(image.mode, (out_width, out_height))
+    image.load()
+    count('frames_decoded')
+    return image
+
+
+def read_thumbnail(wsi: WsiDicom, max_size: int) -> Image.Image:
+    """
+    Compute a thumbnail whose largest side is `max_size` (or the slide size
+    if smaller), from the smallest pyramid level that is large enough.
+    """
+    size = wsi.levels.base_level.size
+    ratio = min(1.0, max_size / max(size.width, size.height))
+    thumb_size = (max(1, round(size.width * ratio)), max(1, round(size.height * ratio)))
+    return wsi.read_thumbnail(thumb_size)
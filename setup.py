@@ -32,6 +32,8 @@ DEPENDENCY_LINKS = []
 # What packages are optional?
 EXTRAS = {
     'tests': ['pytest>=6.2.2'],
+    'benchmarks': ['pytest>=6.2.2', 'pytest-benchmark>=3.4'],
+    'arrays': ['dask[array]'],
 }
 
 # Load the package's __version__.py module as a dictionary.
@@ -60,7 +62,7 @@ setup(
     author_email=about['__email__'],
     python_requires=REQUIRES_PYTHON,
     url=about['__url__'],
-    packages=find_packages(exclude=["tests", "*.tests", "*.tests.*", "tests.*"]),
+    packages=find_packages(exclude=["tests", "*.tests", "*.tests.*", "tests.*", "benchmarks", "benchmarks.*"]),
     entry_points={
         'pims.formats': f'{about["__plugin__"]} = {project_slug}',
     },
@@ -0,0 +1,47 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from pims_plugin_format_dicom.aio import read_planes_async
+from test_tiles import FakeImageData
+
+
+@pytest.fixture
+def image_data():
+    rng = np.random.default_rng(0)
+    return FakeImageData(rng.integers(0, 256, (700, 900, 3), dtype=np.uint8))
+
+
+def test_read_planes_async(image_data):
+    out = asyncio.run(read_planes_async([(image_data, 0, '0')], 100, 50, 700, 600))
+    assert np.array_equal(out, image_data.pixels[50:650, 100:800])
+
+
+class BlockingImageData(FakeImageData):
+    """Image data whose frame reads wait until released."""
+    def __init__(self, pixels):
+        super().__init__(pixels)
+        self.release = threading.Event()
+
+    def get_encoded_tile(self, tile, z, path, crop=True):
+        self.release.wait(5)
+        return super().get_encoded_tile(tile, z, path, crop)
+
+
+def test_read_planes_async_cancel():
+    rng = np.random.default_rng(0)
+    image_data = BlockingImageData(rng.integers(0, 256, (4096, 4096, 3), dtype=np.uint8))
+
+    async def _cancelled_read():
+        task = asyncio.ensure_future(read_planes_async([(image_data, 0, '0')], 0, 0, 4096, 4096))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(_cancelled_read())
+    image_data.release.set()
+    # Only the reads already running on the I/O pool were done.
+    assert image_data.n_reads < 16 * 16
@@ -0,0 +1,117 @@
+import numpy as np
+import shapely
+from pydicom.uid import generate_uid
+from wsidicom.conceptcode import AnnotationCategoryCode, AnnotationTypeCode
+from wsidicom.graphical_annotations import (
+    Annotation, AnnotationInstance, Point, PointAnnotationGroup, Polygon,
+    PolygonAnnotationGroup, Polyline, PolylineAnnotationGroup
+)
+from wsidicom.uid import SlideUids
+
+from pims_plugin_format_dicom.annotations import (
+    AnnotationIndex, iter_geometries, iter_group_geometries, read_annotation_groups
+)
+
+PIXEL_SPACING = 0.5
+
+
+def make_group(group_class, geometries, is_double=True):
+    return group_class(
+        [Annotation(geometry) for geometry in geometries], 'group',
+        AnnotationCategoryCode('Tissue'), AnnotationTypeCode('Nucleus'), is_double=is_double
+    )
+
+
+def write_annotations(path, groups):
+    uids = SlideUids(generate_uid(), generate_uid(), generate_uid())
+    AnnotationInstance(groups, 'image', uids).save(path)
+    return path
+
+
+def read_group(tmp_path, group):
+    group_ds, = read_annotation_groups(write_annotations(tmp_path / "annotations.dcm", [group]))
+    return group_ds
+
+
+def test_points(tmp_path):
+    group = read_group(tmp_path, make_group(PointAnnotationGroup, [Point(1, 2), Point(3.9, 0.4)]))
+    geometries, = iter_group_geometries(group, PIXEL_SPACING)
+    assert list(geometries) == [shapely.Point(2, 4), shapely.Point(7, 0)]
+
+
+def test_polylines(tmp_path):
+    # Single precision coordinates.
+    group = read_group(tmp_path, make_group(PolylineAnnotationGroup, [
+        Polyline.from_coords([(0, 0), (1, 1)]),
+        Polyline.from_coords([(2, 2), (3, 3), (4, 2)]),
+    ], is_double=False))
+    geometries, = iter_group_geometries(group, PIXEL_SPACING)
+    assert list(geometries) == [
+        shapely.LineString([(0, 0), (2, 2)]),
+        shapely.LineString([(4, 4), (6, 6), (8, 4)]),
+    ]
+
+
+def test_polygons_by_chunks(tmp_path):
+    squares = [
+        Polygon.from_coords([(i, 0), (i + 1, 0), (i + 1, 1), (i, 1)])
+        for i in range(5)
+    ]
+    group = read_group(tmp_path, make_group(PolygonAnnotationGroup, squares))
+    chunks = list(iter_group_geometries(group, PIXEL_SPACING, chunk_size=2))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+    expected = [shapely.box(2 * i, 0, 2 * i + 2, 2) for i in range(5)]
+    geometries = [geometry for chunk in chunks for geometry in chunk]
+    assert all(g.equals(e) for g, e in zip(geometries, expected))
+
+
+def test_iter_geometries(tmp_path):
+    path = write_annotations(tmp_path / "annotations.dcm", [
+        make_group(PointAnnotationGroup, [Point(1, 1)]),
+        make_group(PolygonAnnotationGroup, [Polygon.from_coords([(0, 0), (1, 0), (1, 1)])]),
+    ])
+    geometries = [g for chunk in iter_geometries([path], PIXEL_SPACING) for g in chunk]
+    assert [g.geom_type for g in geometries] == ['Point', 'Polygon']
+
+
+def test_annotation_index_query(tmp_path):
+    squares = [
+        Polygon.from_coords([(i, i), (i + 0.5, i), (i + 0.5, i + 0.5), (i, i + 0.5)])
+        for i in range(10)
+    ]
+    far_points = make_group(PointAnnotationGroup, [Point(1000, 1000)])
+    path = write_annotations(
+        tmp_path / "annotations.dcm", [make_group(PolygonAnnotationGroup, squares), far_points]
+    )
+    index = AnnotationIndex.build([path], PIXEL_SPACING)
+    assert len(index) == 11
+
+    hits = [g for geometries in index.query((3, 3, 8.5, 8.5)) for g in geometries]
+    assert [g.bounds[:2] for g in hits] == [(2, 2), (4, 4), (6, 6), (8, 8)]
+    assert list(index.query((100, 0, 200, 50))) == []
+    assert sum(len(geometries) for geometries in index.query()) == 11
+
+
+def test_geometries_match_wsidicom(tmp_path):
+    rng = np.random.default_rng(0)
+    polylines = [Polyline.from_coords(rng.uniform(0, 100, (n, 2))) for n in rng.integers(2, 6, 20)]
+    path = write_annotations(tmp_path / "annotations.dcm", [
+        make_group(PointAnnotationGroup, [Point(*p) for p in rng.uniform(0, 100, (20, 2))], is_double=False),
+        make_group(PolylineAnnotationGroup, polylines),
+    ])
+
+    geometries = [g for chunk in iter_geometries([path], PIXEL_SPACING, chunk_size=7) for g in chunk]
+    instance, = AnnotationInstance.open([path])
+    expected = [
+        [(int(x / PIXEL_SPACING), int(y / PIXEL_SPACING)) for x, y in annotation.geometry.to_coords()]
+        for group in instance.groups for annotation in group.annotations
+    ]
+    assert [list(shapely.get_coordinates(g).astype(int).tolist()) for g in geometries] == \
+        [[list(c) for c in coords] for coords in expected]
+
+
+def test_unsupported_graphic_type(tmp_path):
+    group = read_group(tmp_path, make_group(PointAnnotationGroup, [Point(1, 2)]))
+    group.GraphicType = 'ELLIPSE'
+    assert list(iter_group_geometries(group, PIXEL_SPACING)) == []
@@ -0,0 +1,57 @@
+import pickle
+
+import numpy as np
+import pytest
+from wsidicom import WsiDicom
+
+from benchmarks.synthetic import SlideSpec, generate_slide
+from pims_plugin_format_dicom.arrays import LevelArray
+
+
+@pytest.fixture(scope="module")
+def slide_path(tmp_path_factory):
+    spec = SlideSpec(width=1000, height=700, label=False, overview=False)
+    return str(generate_slide(tmp_path_factory.mktemp("slides") / "slide", spec))
+
+
+@pytest.fixture(scope="module")
+def level0(slide_path):
+    with WsiDicom.open(slide_path) as wsi:
+        return np.asarray(wsi.read_region((0, 0), 0, (1000, 700)))
+
+
+def make_array(slide_path, level=0, size=(1000, 700)):
+    return LevelArray(slide_path, level, size, (256, 256), 3)
+
+
+def test_level_array_chunks(slide_path):
+    array = make_array(slide_path)
+    assert array.shape == (700, 1000, 3)
+    assert array.chunk_shape == (256, 256, 3)
+    assert array.chunks == ((256, 256, 188), (256, 256, 256, 232), (3,))
+    assert array.nbytes == 700 * 1000 * 3
+
+
+def test_level_array_indexing(slide_path, level0):
+    array = make_array(slide_path)
+    assert np.array_equal(array[100:400, 250:900], level0[100:400, 250:900])
+    assert np.array_equal(array[-10:, ::7, 1], level0[-10:, ::7, 1])
+    assert np.array_equal(array[5, 600:], level0[5, 600:])
+    assert np.array_equal(array[..., 2][3, 4], level0[3, 4, 2])
+    assert array[10:10, 5:20].shape == (0, 15, 3)
+    assert np.array_equal(array.read_chunk(2, 3), level0[512:, 768:])
+    assert np.array_equal(np.asarray(array), level0)
+    with pytest.raises(IndexError):
+        array[700]
+
+
+def test_level_array_pickle(slide_path, level0):
+    array = pickle.loads(pickle.dumps(make_array(slide_path)))
+    assert np.array_equal(array[:256, :256], level0[:256, :256])
+
+
+def test_level_array_to_dask(slide_path, level0):
+    pytest.importorskip("dask.array")
+    array = make_array(slide_path).to_dask()
+    assert array.chunks == make_array(slide_path).chunks
+    assert np.array_equal(array[300:600].mean(axis=(0, 1)).compute(), level0[300:600].mean(axis=(0, 1)))
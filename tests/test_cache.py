@@ -0,0 +1,248 @@
+import os
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import SlideSpec, generate_slide
+from pims_plugin_format_dicom.cache import ObjectCache, SharedTileCache, SlideCache, TileCache
+from pims_plugin_format_dicom.slide import open_wsi_dicom
+
+
+class FakeSlide:
+    def __init__(self, path, n_files=1):
+        self.path = path
+        self.n_files = n_files
+        self.closed = False
+        self.levels = FakeSeries(self)
+        self.labels = FakeSeries(self)
+        self.overviews = FakeSeries(self)
+
+
+class FakeSeries:
+    def __init__(self, slide):
+        self.slide_path = slide.path
+
+    def close(self):
+        CLOSED.append(self.slide_path)
+
+
+CLOSED = []
+
+
+def make_cache(max_slides=2, max_files=10, n_files=1):
+    opened = []
+
+    def opener(path):
+        opened.append(path)
+        return FakeSlide(path, n_files)
+
+    cache = SlideCache(max_slides, max_files, opener=opener, file_counter=lambda s: s.n_files)
+    return cache, opened
+
+
+def make_slides(tmp_path, n):
+    paths = []
+    for i in range(n):
+        path = tmp_path / f"slide{i}"
+        path.mkdir()
+        paths.append(str(path))
+    return paths
+
+
+def test_slide_cache_hit_miss(tmp_path):
+    cache, opened = make_cache()
+    path, = make_slides(tmp_path, 1)
+
+    slide = cache.get(path)
+    assert cache.get(path) is slide
+    assert opened == [path]
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_slide_cache_lru_eviction(tmp_path):
+    cache, opened = make_cache(max_slides=2)
+    a, b, c = make_slides(tmp_path, 3)
+
+    cache.get(a)
+    cache.get(b)
+    cache.get(a)
+    cache.get(c)  # evicts b, the least recently used
+
+    assert cache.stats()['slides'] == 2
+    assert cache.stats()['evictions'] == 1
+    cache.get(b)
+    assert opened == [a, b, c, b]
+
+
+def test_slide_cache_file_budget(tmp_path):
+    cache, _ = make_cache(max_slides=10, max_files=5, n_files=3)
+    a, b = make_slides(tmp_path, 2)
+
+    cache.get(a)
+    cache.get(b)
+    assert cache.stats()['slides'] == 1
+    assert cache.stats()['files'] == 3
+
+
+def test_slide_cache_closes_evicted_slide(tmp_path):
+    cache, _ = make_cache(max_slides=1)
+    a, b = make_slides(tmp_path, 2)
+
+    slide = cache.get(a)
+    cache.get(b)
+    # Closed at eviction, even if still referenced.
+    assert slide is not None and CLOSED.count(a) == 3
+
+
+def test_slide_cache_closes_leased_slide_after_use(tmp_path):
+    cache, _ = make_cache(max_slides=1)
+    a, b = make_slides(tmp_path, 2)
+
+    with cache.lease(a) as slide:
+        with cache.lease(a) as other:
+            assert other is slide
+        with cache.lease(b):
+            assert cache.stats()['evictions'] == 1
+        assert a not in CLOSED
+    assert CLOSED.count(a) == 3
+    assert b not in CLOSED
+
+    cache.clear()
+    assert CLOSED.count(b) == 3
+
+
+def test_slide_cache_disabled_lease(tmp_path):
+    cache, opened = make_cache(max_slides=0)
+    path, = make_slides(tmp_path, 1)
+
+    with cache.lease(path):
+        assert path not in CLOSED
+    assert CLOSED.count(path) == 3
+
+
+def test_slide_cache_releases_descriptors(tmp_path):
+    paths = [
+        generate_slide(tmp_path / f"slide{i}", SlideSpec(width=512, height=512, label=False, overview=False))
+        for i in range(2)
+    ]
+    cache = SlideCache(max_slides=1, max_files=10, opener=open_wsi_dicom)
+
+    def open_fds():
+        return len(os.listdir('/proc/self/fd'))
+
+    n_fds = open_fds()
+    first = cache.get(str(paths[0]))
+    n_files = len(first.files)
+    assert open_fds() == n_fds + n_files
+    with cache.lease(str(paths[1])):
+        # The first slide is closed at eviction, although still referenced.
+        assert open_fds() == n_fds + n_files
+    cache.clear()
+    assert open_fds() == n_fds
+
+
+def test_slide_cache_invalidated_on_change(tmp_path):
+    cache, opened = make_cache()
+    path, = make_slides(tmp_path, 1)
+
+    cache.get(path)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    cache.get(path)
+    assert opened == [path, path]
+
+
+def test_slide_cache_disabled(tmp_path):
+    cache, opened = make_cache(max_slides=0)
+    path, = make_slides(tmp_path, 1)
+
+    cache.get(path)
+    cache.get(path)
+    assert opened == [path, path]
+
+
+def test_tile_cache_budget():
+    cache = TileCache(max_bytes=3 * 256 * 256)
+    tiles = [np.full((256, 256), i, dtype=np.uint8) for i in range(4)]
+    for i, tile in enumerate(tiles):
+        cache.put(('slide', 0, i), tile)
+
+    assert cache.get(('slide', 0, 0)) is None
+    assert cache.get(('slide', 0, 3))[0, 0] == 3
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['bytes'] == 3 * 256 * 256
+
+
+def test_tile_cache_read_only_view():
+    cache = TileCache(max_bytes=2 ** 20)
+    tile = np.zeros((256, 256), dtype=np.uint8)
+    cached = cache.put(('slide', 0, 0), tile)
+
+    assert tile.flags.writeable
+    assert not cached.flags.writeable and cached.base is tile
+    assert cache.get(('slide', 0, 0)) is cached
+
+
+def test_shared_tile_cache(tmp_path):
+    arena = str(tmp_path / "arena")
+    writer = SharedTileCache(arena, max_bytes=8 * 2 ** 20, slot_size=2 ** 20)
+    reader = SharedTileCache(arena, max_bytes=8 * 2 ** 20, slot_size=2 ** 20)
+    tile = np.arange(256 * 256 * 3, dtype=np.uint32).astype(np.uint8).reshape((256, 256, 3))
+
+    assert reader.get(('slide', 0, 1, 2)) is None
+    writer.put(('slide', 0, 1, 2), tile)
+    assert np.array_equal(reader.get(('slide', 0, 1, 2)), tile)
+
+    reader.clear()
+    assert writer.get(('slide', 0, 1, 2)) is None
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float32])
+def test_shared_tile_cache_dtypes(tmp_path, dtype):
+    cache = SharedTileCache(str(tmp_path / "arena"), max_bytes=8 * 2 ** 20, slot_size=2 ** 20)
+    tile = np.arange(256 * 256, dtype=dtype).reshape((256, 256))
+    cache.put(('slide', 0, 1, 2), tile)
+
+    cached = cache.get(('slide', 0, 1, 2))
+    assert cached.dtype == tile.dtype and np.array_equal(cached, tile)
+
+
+def test_shared_tile_cache_skips_large_tiles(tmp_path):
+    cache = SharedTileCache(str(tmp_path / "arena"), max_bytes=8 * 2 ** 20, slot_size=2 ** 20)
+    cache.put(('slide', 0, 1, 2), np.zeros((1024, 1024), dtype=np.uint16))
+    assert cache.get(('slide', 0, 1, 2)) is None
+    assert cache.stats()['skips'] == 1
+
+
+def test_shared_tile_cache_drops_previous_version(tmp_path):
+    arena = str(tmp_path / "arena")
+    cache = SharedTileCache(arena, max_bytes=8 * 2 ** 20, slot_size=2 ** 20)
+    cache.put(('slide', 0, 1, 2), np.ones((256, 256), dtype=np.uint8))
+    cache.FILE_HEADER.pack_into(cache._mm, 0, b"PIMSWSIDCMTILES1", cache.n_slots, cache.slot_size)
+
+    reopened = SharedTileCache(arena, max_bytes=8 * 2 ** 20, slot_size=2 ** 20)
+    assert reopened.get(('slide', 0, 1, 2)) is None
+
+
+def test_shared_tile_cache_layout_mismatch(tmp_path):
+    arena = str(tmp_path / "arena")
+    SharedTileCache(arena, max_bytes=8 * 2 ** 20, slot_size=2 ** 20)
+    with pytest.raises(ValueError):
+        SharedTileCache(arena, max_bytes=4 * 2 ** 20, slot_size=2 ** 20)
+
+
+def test_object_cache():
+    cache = ObjectCache(max_items=2)
+    calls = []
+
+    def factory(value):
+        return lambda: calls.append(value) or value
+
+    assert cache.get('a', factory(1)) == 1
+    assert cache.get('a', factory(2)) == 1
+    cache.get('b', factory(3))
+    cache.get('c', factory(4))
+    assert cache.get('a', factory(5)) == 5
+    assert calls == [1, 3, 4, 5]
+    assert cache.stats() == {'items': 2, 'hits': 1, 'misses': 4}
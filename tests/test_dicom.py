@@ -0,0 +1,230 @@
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pytest
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+from wsidicom import WsiDicom
+from wsidicom.geometry import Point
+from wsidicom.uid import WSI_SOP_CLASS_UID
+
+from benchmarks.synthetic import SlideSpec, generate_slide
+
+pytest.importorskip("pims")
+pytest.importorskip("pyvips")
+
+from pims.formats.utils.abstract import CachedDataPath  # noqa: E402
+from pims.formats.utils.structures.pyramid import normalized_pyramid  # noqa: E402
+from pims.processing.region import Tile  # noqa: E402
+
+from pims_plugin_format_dicom import dicom  # noqa: E402
+from pims_plugin_format_dicom.dicom import WSIDicomChecker, WSIDicomFormat, get_root_file  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def slide_path(tmp_path_factory):
+    # 512px native tiles, so that the normalized pyramid (256px tiles) differs.
+    spec = SlideSpec(width=1500, height=1100, tile_size=512, codec='jpeg2000-lossless')
+    return generate_slide(tmp_path_factory.mktemp("slides") / "slide", spec)
+
+
+@pytest.fixture(scope="module")
+def jpeg_slide_path(tmp_path_factory):
+    spec = SlideSpec(width=1500, height=1100, tile_size=512, label=False, overview=False)
+    return generate_slide(tmp_path_factory.mktemp("slides") / "slide", spec)
+
+
+@pytest.fixture(scope="module")
+def wsi(slide_path):
+    with WsiDicom.open(slide_path) as wsi:
+        yield wsi
+
+
+def read_region(wsi, left, top, width, height, level=0):
+    return np.asarray(wsi.read_region((left, top), level, (width, height)))
+
+
+def test_read_tiles_native_tier(slide_path, wsi):
+    reader = WSIDicomFormat(Path(slide_path)).reader
+    tier = reader.format.pyramid.get_tier_at_level(0)
+    tiles = [tier.get_txty_tile(2, 2), tier.get_txty_tile(1, 0)]
+    edge, inner = reader.read_tiles(tiles)
+    assert np.array_equal(edge, read_region(wsi, 1024, 1024, 476, 76))
+    assert np.array_equal(inner, read_region(wsi, 512, 0, 512, 512))
+
+
+def test_read_tiles_normalized_tier(slide_path, wsi):
+    reader = WSIDicomFormat(Path(slide_path)).reader
+    pyramid = normalized_pyramid(1500, 1100)
+    tiles = [
+        pyramid.get_tier_at_level(0).get_txty_tile(3, 1),
+        pyramid.get_tier_at_level(1).get_txty_tile(1, 1),
+        # No native tier at this level.
+        pyramid.get_tier_at_level(3).get_txty_tile(0, 0),
+    ]
+    base, level1, smallest = reader.read_tiles(tiles)
+    assert np.array_equal(base, read_region(wsi, 768, 256, 256, 256))
+    assert np.array_equal(level1, read_region(wsi, 256, 256, 256, 256, level=1))
+    # Read as a window of the smallest native tier, resized by PIMS afterwards.
+    assert np.array_equal(smallest, read_region(wsi, 0, 0, 375, 275, level=2))
+
+
+def write_ct(path):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(str(path), {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = CTImageStorage
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.save_as(str(path), write_like_original=False)
+    return path
+
+
+def test_checker_slide_with_sidecar(slide_path, tmp_path):
+    path = tmp_path / "slide"
+    shutil.copytree(slide_path, path)
+    (path / "notes.txt").write_text("not a DICOM file")
+    assert WSIDicomChecker.match_directory(path)
+    assert WSIDicomChecker.match(CachedDataPath(path))
+    assert get_root_file(path) is None
+
+
+def test_checker_nested_slide(slide_path, tmp_path):
+    path = tmp_path / "archive"
+    shutil.copytree(slide_path, path / "slide")
+    assert WSIDicomChecker.match_directory(path)
+    assert not WSIDicomChecker.match_directory(path, recurse=False)
+    assert get_root_file(path) == path / "slide"
+    assert WSIDicomFormat(path).path == path / "slide"
+
+
+def test_checker_other_dicom(tmp_path):
+    path = tmp_path / "ct"
+    path.mkdir()
+    write_ct(path / "image.dcm")
+    assert WSIDicomChecker.read_sop_class_uid(path / "image.dcm") == CTImageStorage
+    assert not WSIDicomChecker.match_directory(path)
+
+
+def test_checker_not_dicom(tmp_path):
+    (tmp_path / "image.png").write_bytes(b"\x89PNG\r\n\x1a\n" + b"\0" * 2000)
+    (tmp_path / "empty").write_bytes(b"")
+    assert WSIDicomChecker.read_sop_class_uid(tmp_path / "image.png") is None
+    assert WSIDicomChecker.read_sop_class_uid(tmp_path / "empty") is None
+    assert WSIDicomChecker.read_sop_class_uid(tmp_path / "missing") is None
+    assert not WSIDicomChecker.match_directory(tmp_path)
+
+
+def test_checker_truncated_header(slide_path, tmp_path):
+    header = (slide_path / "level-0.dcm").read_bytes()[:WSIDicomChecker.HEADER_SIZE]
+    sop_class_end = header.index(WSI_SOP_CLASS_UID.encode()) + len(WSI_SOP_CLASS_UID)
+
+    # Shorter than the header sample, but holding the SOP class.
+    (tmp_path / "short.dcm").write_bytes(header[:sop_class_end + 2])
+    assert WSIDicomChecker.read_sop_class_uid(tmp_path / "short.dcm") == WSI_SOP_CLASS_UID
+    # Cut within the SOP class element, or before it.
+    for size in (sop_class_end - 4, sop_class_end - len(WSI_SOP_CLASS_UID) - 6, 130):
+        (tmp_path / "truncated.dcm").write_bytes(header[:size])
+        assert WSIDicomChecker.read_sop_class_uid(tmp_path / "truncated.dcm") is None
+
+
+@pytest.fixture
+def vips_buffers(monkeypatch):
+    """Buffers handed to libvips, while decoding through the plugin fails."""
+    buffers = []
+    new_from_buffer = dicom.VIPSImage.new_from_buffer
+
+    def _new_from_buffer(data, options, **kwargs):
+        buffers.append(data)
+        return new_from_buffer(data, options, **kwargs)
+
+    monkeypatch.setattr(dicom.VIPSImage, 'new_from_buffer', _new_from_buffer)
+    return buffers
+
+
+def stored_frame(slide_path, tx, ty):
+    with WsiDicom.open(slide_path) as wsi:
+        image_data = wsi.levels.get_level(0).default_instance.image_data
+        return image_data.get_encoded_tile(
+            Point(tx, ty), image_data.default_z, image_data.default_path, crop=False
+        )
+
+
+def test_read_native_tile(jpeg_slide_path, vips_buffers, monkeypatch):
+    reader = WSIDicomFormat(Path(jpeg_slide_path)).reader
+    monkeypatch.setattr(dicom, 'read_planes', lambda *args, **kwargs: pytest.fail("frame decoded"))
+    tier = reader.format.pyramid.get_tier_at_level(0)
+
+    image = reader.read_tile(tier.get_txty_tile(1, 0))
+    assert (image.width, image.height) == (512, 512)
+    assert vips_buffers == [stored_frame(jpeg_slide_path, 1, 0)]
+
+    # Edge frames are padded up to the tile size, and cropped.
+    image = reader.read_tile(tier.get_txty_tile(2, 2))
+    assert (image.width, image.height) == (476, 76)
+    assert vips_buffers[1] == stored_frame(jpeg_slide_path, 2, 2)
+
+
+def test_read_native_tile_fallback(jpeg_slide_path, vips_buffers):
+    reader = WSIDicomFormat(Path(jpeg_slide_path)).reader
+    tier = reader.format.pyramid.get_tier_at_level(0)
+    normalized = normalized_pyramid(1500, 1100).get_tier_at_level(0)
+    with WsiDicom.open(jpeg_slide_path) as wsi:
+        for tile, (left, top, width, height) in (
+            # Not clipped to the image.
+            (Tile(tier, 2, 2), (1024, 1024, 476, 76)),
+            # Tiles of another tier.
+            (normalized.get_txty_tile(1, 0), (256, 0, 256, 256)),
+            (normalized.get_txty_tile(2, 1), (512, 256, 256, 256)),
+        ):
+            assert reader._read_native_tile(tile) is None
+            assert np.array_equal(reader.read_tile(tile), read_region(wsi, left, top, width, height))
+    assert vips_buffers == []
+
+
+def test_parse_associated_dimensions(slide_path, wsi):
+    imd = WSIDicomFormat(Path(slide_path)).main_imd
+    for associated, series in ((imd.associated_label, wsi.labels), (imd.associated_macro, wsi.overviews)):
+        stored = series[0].default_instance.image_data.image_size
+        assert (associated.width, associated.height) == (stored.width, stored.height)
+        assert associated.n_channels == 3
+    assert (imd.associated_label.width, imd.associated_label.height) == (600, 400)
+
+
+class FakeLevel:
+    """Level holding some focal planes, of a single optical path."""
+    def __init__(self, focal_planes):
+        self.focal_planes = focal_planes
+        self.default_instance = self.get_instance(focal_planes[0], '0')
+
+    def get_instance(self, z, path):
+        assert z in self.focal_planes
+        image_data = type('ImageData', (), {'default_z': self.focal_planes[0], 'default_path': '0'})()
+        image_data.z = z
+        return type('Instance', (), {'image_data': image_data})()
+
+
+def test_planes_of_level_lacking_focal_plane(slide_path):
+    reader = WSIDicomFormat(Path(slide_path)).reader
+    index = dict(dicom.cached_slide_index(reader.format), focal_planes=[0.0, 1.5, 4.0])
+    reader.format.cache_value('_wsi_dicom_index', index, force=True)
+
+    assert [z for _, z, _ in reader._planes(FakeLevel([0.0, 1.5, 4.0]), z=1)] == [1.5]
+    (image_data, z, path), = reader._planes(FakeLevel([0.0, 4.0]), z=1)
+    assert (image_data.z, z, path) == (0.0, 0.0, '0')
+    assert [z for _, z, _ in reader._planes(FakeLevel([0.0, 4.0]), z=2)] == [4.0]
+
+
+def test_histogram_opens_single_level(slide_path, monkeypatch):
+    monkeypatch.setattr(dicom.get_settings(), 'histogram_max_pixels', 800 * 600)
+    fmt = WSIDicomFormat(Path(slide_path))
+    levels = dicom.cached_slide_index(fmt)['levels']
+    assert len(levels) > 2
+
+    dicom.get_slide_cache().clear()
+    histogram = dicom._compute_histogram(fmt, dicom.get_settings().histogram_max_pixels)
+    assert histogram.shape[:3] == (1, 1, 3)
+    with dicom.leased_slide(fmt) as wsi:
+        assert list(wsi.levels._opened) == [levels[1]['level']]
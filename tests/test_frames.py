@@ -0,0 +1,171 @@
+import os
+import threading
+from collections import OrderedDict
+
+import pytest
+from pydicom.filebase import DicomFile
+from wsidicom.errors import WsiDicomOutOfBoundsError
+from wsidicom.geometry import Point, Size
+from wsidicom.image_data import WsiDicomImageData
+
+from pims_plugin_format_dicom import frames as frames_module
+from pims_plugin_format_dicom.frames import FrameIndex, get_index_writer
+from pims_plugin_format_dicom.index import frames_path, load_frame_positions
+
+FRAMES = [b"first", b"second frame", b"third"]
+
+
+class FakeFile:
+    def __init__(self, filepath, frame_offset, frames):
+        self.filepath = filepath
+        self.frame_offset = frame_offset
+        self.frame_count = len(frames)
+        self.parsed = 0
+
+        data = b"\0" * 132
+        self._positions = []
+        for frame in frames:
+            self._positions.append((len(data), len(frame)))
+            data += frame
+        filepath.write_bytes(data)
+        self._fp = DicomFile(filepath, 'rb')
+
+    @property
+    def frame_positions(self):
+        self.parsed += 1
+        return self._positions
+
+
+class FakeTiles:
+    """A row of 4 tiles, the first one being sparse."""
+    image_size = Size(1024, 256)
+    tile_size = Size(256, 256)
+    focal_planes = [0]
+    optical_paths = ['0']
+
+    def get_frame_index(self, tile, z, path):
+        return tile.x - 1
+
+
+class FakeImageData(WsiDicomImageData):
+    blank_encoded_tile = b"blank"
+
+    def __init__(self, files):
+        self.tiles = FakeTiles()
+        self._files = OrderedDict((file.frame_offset, file) for file in files)
+
+
+def make_slide(tmp_path):
+    path = tmp_path / "slide"
+    path.mkdir()
+    files = [
+        FakeFile(path / "level0-1.dcm", 0, FRAMES[:2]),
+        FakeFile(path / "level0-2.dcm", 2, FRAMES[2:]),
+    ]
+    return path, files
+
+
+def test_read_tiles_across_files(tmp_path):
+    path, files = make_slide(tmp_path)
+    image_data = FakeImageData(files)
+    frames = FrameIndex(path)
+
+    assert [frames.read_tile(image_data, Point(x, 0), 0, '0') for x in range(1, 4)] == FRAMES
+    assert frames.read_tile(image_data, Point(0, 0), 0, '0') == b"blank"
+    frames.read_tile(image_data, Point(2, 0), 0, '0')
+    assert [file.parsed for file in files] == [1, 1]
+
+
+def test_read_tile_out_of_bounds(tmp_path):
+    path, files = make_slide(tmp_path)
+    frames = FrameIndex(path, persist=False)
+    for tile, z, optical_path in ((Point(4, 0), 0, '0'), (Point(-1, 0), 0, '0'), (Point(1, 1), 0, '0'),
+                                  (Point(1, 0), 1, '0'), (Point(1, 0), 0, '1')):
+        with pytest.raises(WsiDicomOutOfBoundsError):
+            frames.read_tile(FakeImageData(files), tile, z, optical_path)
+        with pytest.raises(WsiDicomOutOfBoundsError):
+            frames.read_tiles(FakeImageData(files), [Point(1, 0), tile], z, optical_path)
+
+
+def test_read_tiles_without_opening_files(tmp_path):
+    path, files = make_slide(tmp_path)
+    frames = FrameIndex(path, persist=False)
+    n_fds = len(os.listdir('/proc/self/fd'))
+    assert frames.read_tiles(FakeImageData(files), [Point(x, 0) for x in range(1, 4)], 0, '0') == FRAMES
+    assert len(os.listdir('/proc/self/fd')) == n_fds
+
+    # Frames of closed files are not read from their (maybe reused) descriptors.
+    files[0]._fp.close()
+    with pytest.raises(ValueError):
+        frames.read_tile(FakeImageData(files), Point(1, 0), 0, '0')
+
+
+def test_frame_positions_persisted(tmp_path):
+    path, files = make_slide(tmp_path)
+    frames = FrameIndex(path)
+    frames.read_tile(FakeImageData(files), Point(2, 0), 0, '0')
+    frames.flush()
+    assert frames_path(path).parent == tmp_path
+
+    # Positions are read from the sidecar by another index.
+    frames = FrameIndex(path)
+    assert frames.read_tile(FakeImageData(files), Point(2, 0), 0, '0') == FRAMES[1]
+    assert files[0].parsed == 1
+
+
+def test_frame_positions_not_persisted(tmp_path):
+    path, files = make_slide(tmp_path)
+    FrameIndex(path, persist=False).read_tile(FakeImageData(files), Point(2, 0), 0, '0')
+    assert not frames_path(path).exists()
+
+
+def test_frame_positions_invalidated_by_slide_change(tmp_path):
+    path, files = make_slide(tmp_path)
+    frames = FrameIndex(path)
+    frames.read_tile(FakeImageData(files), Point(2, 0), 0, '0')
+    frames.flush()
+    assert set(load_frame_positions(path)) == {"level0-1.dcm"}
+
+    (path / "level1.dcm").write_bytes(b"\0" * 132)
+    assert load_frame_positions(path) == dict()
+
+
+def test_frame_positions_written_together(tmp_path, monkeypatch):
+    path, files = make_slide(tmp_path)
+    writes = []
+    monkeypatch.setattr(
+        frames_module, 'write_frame_positions', lambda path, positions: writes.append(set(positions))
+    )
+
+    frames = FrameIndex(path)
+    # Hold the writer thread until both files are indexed.
+    hold = threading.Event()
+    get_index_writer().submit(hold.wait)
+    frames.read_tiles(FakeImageData(files), [Point(x, 0) for x in range(1, 4)], 0, '0')
+    hold.set()
+    frames.flush()
+    assert writes == [{"level0-1.dcm", "level0-2.dcm"}]
+
+
+def test_read_tiles_coalesced(tmp_path, monkeypatch):
+    path, files = make_slide(tmp_path)
+    reads = []
+
+    def pread(fd, length, offset):
+        reads.append((length, offset))
+        return os_pread(fd, length, offset)
+
+    os_pread = os.pread
+    monkeypatch.setattr(os, 'pread', pread)
+
+    frames = FrameIndex(path, persist=False)
+    tiles = [Point(x, 0) for x in (3, 0, 2, 1)]
+    expected = [FRAMES[2], b"blank", FRAMES[1], FRAMES[0]]
+    assert frames.read_tiles(FakeImageData(files), tiles, 0, '0') == expected
+    # One read per file, the first two frames are adjacent.
+    assert sorted(reads) == [(len(FRAMES[2]), 132), (len(FRAMES[0]) + len(FRAMES[1]), 132)]
+
+    reads.clear()
+    frames = FrameIndex(path, persist=False, max_read_size=len(FRAMES[1]))
+    assert frames.read_tiles(FakeImageData(files), tiles, 0, '0') == expected
+    assert len(reads) == 3
@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from wsidicom.geometry import Size
+
+from pims_plugin_format_dicom.histogram import (
+    SlideHistogram, compute_histogram, frame_histogram, histogram_error, plan_histogram,
+    sample_tiles
+)
+from test_tiles import TILE_SIZE, FakeImageData
+
+
+class FakeLevelImageData(FakeImageData):
+    def __init__(self, pixels):
+        super().__init__(pixels)
+        height, width = pixels.shape[:2]
+        self.image_size = Size(width, height)
+
+
+def make_level(height, width, seed=0):
+    rng = np.random.default_rng(seed)
+    return FakeLevelImageData(rng.integers(1, 200, (height, width, 3), dtype=np.uint8))
+
+
+def exact_histogram(pixels):
+    return np.stack([np.bincount(pixels[:, :, c].ravel(), minlength=256) for c in range(3)])
+
+
+def test_frame_histogram():
+    pixels = np.array([[[0, 1], [1, 1]], [[3, 0], [3, 3]]], dtype=np.uint8)
+    assert frame_histogram(pixels, 4).tolist() == [[1, 1, 0, 2], [1, 2, 0, 1]]
+    assert frame_histogram(pixels[:, :, 0], 4).tolist() == [[1, 1, 0, 2]]
+
+
+def level_sizes(*levels):
+    return [(level.image_size, Size(TILE_SIZE, TILE_SIZE)) for level in levels]
+
+
+def test_plan_histogram():
+    levels = level_sizes(make_level(700, 900), make_level(350, 450))
+    assert plan_histogram(levels, None) == (0, [(tx, ty) for ty in range(3) for tx in range(4)])
+    assert plan_histogram(levels, 700 * 900) == (0, plan_histogram(levels, None)[1])
+    assert plan_histogram(levels, 350 * 450) == (1, [(tx, ty) for ty in range(2) for tx in range(2)])
+
+    # No level is small enough, tiles of the coarsest level are sampled.
+    level, tiles = plan_histogram(levels, 2 * TILE_SIZE * TILE_SIZE)
+    assert level == 1 and tiles == [(0, 0), (1, 1)]
+
+
+def test_sample_tiles():
+    tiles = [(tx, ty) for ty in range(10) for tx in range(10)]
+    sampled = sample_tiles(tiles, 20)
+    assert len(sampled) == 20
+    assert len({tx for tx, _ in sampled}) > 1 and len({ty for _, ty in sampled}) == 10
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_compute_histogram_exact(workers):
+    level = make_level(700, 900)
+    executor = ThreadPoolExecutor(workers) if workers else None
+    _, tiles = plan_histogram(level_sizes(level), None)
+    histogram = compute_histogram(
+        [[(level, 0, '0')]], tiles, 256, 700 * 900, executor=executor, batch_size=5
+    )
+    assert histogram.shape == (1, 1, 3, 256)
+    # Padding of edge frames is not counted.
+    assert np.array_equal(histogram[0, 0], exact_histogram(level.pixels))
+
+
+def test_compute_histogram_scaled():
+    level = make_level(700, 900)
+    histogram = compute_histogram([[(level, 0, '0')], [(level, 1, '0')]], [(0, 0)], 256, 4 * 700 * 900)
+    assert histogram.shape == (1, 2, 3, 256)
+    assert histogram[0, 0, 0].sum() == pytest.approx(4 * 700 * 900, rel=1e-3)
+
+    exact = exact_histogram(level.pixels)[np.newaxis, np.newaxis]
+    assert 0 < histogram_error(histogram[:, :1], exact) < 0.1
+    assert histogram_error(exact, exact) == 0
+
+
+def test_slide_histogram():
+    planes = np.zeros((1, 2, 3, 256), dtype=np.uint64)
+    planes[0, 0, 0, 10] = planes[0, 1, 0, 20] = planes[0, 0, 2, 200] = 1
+    histogram = SlideHistogram(planes)
+
+    assert histogram.image_bounds() == (10, 200)
+    assert histogram.channels_bounds()[0] == (10, 20)
+    assert histogram.channel_bounds(2) == (200, 200)
+    assert histogram.plane_bounds(0, 1, 0) == (20, 20)
+    assert len(histogram.planes_bounds()) == 6
+    assert histogram.image_histogram().shape == (256,)
+    assert histogram.channel_histogram([0, 2], squeeze=False).shape == (2, 256)
+    assert histogram.plane_histogram(0, [0, 1], 0).shape == (2, 256)
+    assert histogram.plane_histogram(0, 0, 0, squeeze=False).shape == (1, 1, 1, 256)
@@ -0,0 +1,150 @@
+import os
+from pathlib import Path
+
+import pytest
+from PIL import Image
+from wsidicom.geometry import Size
+
+from benchmarks.synthetic import SlideSpec, generate_slide
+from pims_plugin_format_dicom.index import (
+    INDEX_VERSION, _build_associated, build_index, index_path, load_index, load_thumbnail, slide_fingerprint,
+    write_index, write_thumbnail
+)
+from pims_plugin_format_dicom.slide import LazySlide
+from pims_plugin_format_dicom.tiles import read_thumbnail
+
+
+def make_slide(tmp_path):
+    path = tmp_path / "slide"
+    path.mkdir()
+    (path / "level0.dcm").write_bytes(b"\0" * 132)
+    return path
+
+
+def make_index(path):
+    return {
+        'version': INDEX_VERSION,
+        'fingerprint': slide_fingerprint(path),
+        'width': 1000,
+        'height': 500,
+    }
+
+
+def test_index_written_next_to_slide(tmp_path):
+    path = make_slide(tmp_path)
+    write_index(path, make_index(path))
+
+    assert index_path(path).parent == tmp_path
+    assert load_index(path)['width'] == 1000
+
+
+def test_index_missing(tmp_path):
+    path = make_slide(tmp_path)
+    assert load_index(path) is None
+
+
+def test_index_invalidated_by_slide_change(tmp_path):
+    path = make_slide(tmp_path)
+    write_index(path, make_index(path))
+
+    (path / "level1.dcm").write_bytes(b"\0" * 132)
+    assert load_index(path) is None
+
+
+def test_index_invalidated_by_version(tmp_path):
+    path = make_slide(tmp_path)
+    index = make_index(path)
+    index['version'] = INDEX_VERSION - 1
+    write_index(path, index)
+
+    assert load_index(path) is None
+
+
+def test_thumbnail_roundtrip(tmp_path):
+    path = make_slide(tmp_path)
+    write_thumbnail(path, Image.new('RGB', (512, 256), (10, 20, 30)))
+
+    thumb = load_thumbnail(path)
+    assert thumb.size == (512, 256)
+    assert thumb.getpixel((0, 0)) == (10, 20, 30)
+
+
+def test_thumbnail_invalidated_by_slide_change(tmp_path):
+    path = make_slide(tmp_path)
+    write_thumbnail(path, Image.new('RGB', (512, 256)))
+
+    # Files are replaced, not rewritten in place.
+    (tmp_path / "level0.dcm").write_bytes(b"\0" * 256)
+    os.replace(tmp_path / "level0.dcm", path / "level0.dcm")
+    assert load_thumbnail(path) is None
+
+
+def test_fingerprint_without_file_stat(tmp_path, monkeypatch):
+    path = make_slide(tmp_path)
+    write_index(path, make_index(path))
+
+    stat = os.stat
+    monkeypatch.setattr(os, 'stat', lambda p, *args, **kwargs: (
+        pytest.fail("slide file stat'ed") if Path(p).parent == path else stat(p, *args, **kwargs)
+    ))
+    monkeypatch.setattr(os, 'scandir', lambda *args: pytest.fail("slide directory scanned"))
+    assert load_index(path)['width'] == 1000
+
+
+def test_build_index_without_dataset_traversal(tmp_path, monkeypatch):
+    path = generate_slide(tmp_path / "slide", SlideSpec(width=1024, height=768, annotations=1))
+    monkeypatch.setattr(LazySlide, 'datasets', property(lambda self: pytest.fail("datasets traversed")))
+    slide = LazySlide.open(path)
+    index = build_index(slide, path)
+    slide.close()
+
+    write_index(path, index)
+    index = load_index(path)
+    assert (index['width'], index['height']) == (1024, 768)
+    assert [level['width'] for level in index['levels']] == [1024, 512, 256]
+    assert 'annotations' not in slide.__dict__
+
+
+class FakeGroup:
+    """Associated image of a stored size, failing if decoded."""
+    def __init__(self, width, height, samples_per_pixel=3):
+        self.size = Size(width, height)
+        image_data = type('ImageData', (), {})()
+        image_data.image_size = image_data.tile_size = Size(width, height)
+        image_data.samples_per_pixel = samples_per_pixel
+        image_data.get_encoded_tile = lambda *args, **kwargs: pytest.fail("associated image decoded")
+        self.default_instance = type('Instance', (), {'image_data': image_data})()
+
+    def get_default_full(self):
+        pytest.fail("associated image decoded")
+
+
+class FakeSlide:
+    def __init__(self, labels, overviews, size=Size(3000, 1000)):
+        self.labels, self.overviews = labels, overviews
+        level = type('Level', (), {'size': size})()
+        self.levels = type('Levels', (), {'base_level': level})()
+        self.thumbnail_sizes = []
+
+    def read_thumbnail(self, size):
+        self.thumbnail_sizes.append(size)
+        return Image.new('RGB', size)
+
+
+def test_associated_dimensions():
+    slide = FakeSlide([FakeGroup(600, 400), FakeGroup(10, 10)], [FakeGroup(1024, 751, 1)])
+    assert _build_associated(slide, 'label') == {'width': 600, 'height': 400, 'n_channels': 3}
+    assert _build_associated(slide, 'macro') == {'width': 1024, 'height': 751, 'n_channels': 1}
+    assert _build_associated(FakeSlide([], []), 'label') is None
+
+
+@pytest.mark.parametrize("size, max_size, expected", [
+    (Size(3000, 1000), 512, (512, 171)),
+    (Size(1000, 3000), 512, (171, 512)),
+    (Size(300, 200), 512, (300, 200)),
+    (Size(5000, 2), 512, (512, 1)),
+])
+def test_thumbnail_dimensions(size, max_size, expected):
+    slide = FakeSlide([], [], size)
+    assert read_thumbnail(slide, max_size).size == expected
+    assert slide.thumbnail_sizes == [expected]
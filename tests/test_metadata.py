@@ -0,0 +1,77 @@
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+from pims_plugin_format_dicom.config import get_settings
+from pims_plugin_format_dicom.metadata import DatasetMetadata
+from pims_plugin_format_dicom.metrics import get_metrics
+
+
+def make_optical_path(power):
+    item = Dataset()
+    item.ObjectiveLensPower = power
+    item.ICCProfile = b'\0' * 1024
+    return item
+
+
+def make_dataset():
+    ds = Dataset()
+    ds.BitsStored = 8
+    ds.ImageType = ['ORIGINAL', 'PRIMARY', 'VOLUME']
+    ds.OpticalPathSequence = Sequence([make_optical_path(20), make_optical_path(40)])
+    ds.add_new(0x00091001, 'LO', 'private')
+    return ds
+
+
+def test_raw_metadata():
+    metadata = DatasetMetadata(make_dataset())
+    assert metadata.raw == {
+        'BitsStored': 8,
+        'ImageType': ['ORIGINAL', 'PRIMARY', 'VOLUME'],
+        'OpticalPathSequence[0].ObjectiveLensPower': 20,
+        'OpticalPathSequence[1].ObjectiveLensPower': 40,
+        '0009_1001': 'private',
+    }
+
+
+def test_keyword_lookup():
+    metadata = DatasetMetadata(make_dataset())
+    assert metadata.get('BitsStored') == 8
+    assert metadata.get('OpticalPathSequence', 'ObjectiveLensPower') == 20
+    assert metadata.get('OpticalPathSequence', 'ICCProfile') is None
+    assert metadata.get('SpacingBetweenSlices', default=1) == 1
+
+
+def test_lazy_extraction(monkeypatch):
+    metadata = DatasetMetadata(make_dataset())
+    walk = DatasetMetadata._walk
+    walks = []
+    monkeypatch.setattr(DatasetMetadata, '_walk', lambda self, *args: walks.append(args) or walk(self, *args))
+
+    assert metadata.get('OpticalPathSequence', 'ObjectiveLensPower') == 20
+    assert metadata.get('ImageType') == ['ORIGINAL', 'PRIMARY', 'VOLUME']
+    assert metadata.get('OpticalPathSequence') is None
+    assert metadata.get('BitsStored', 'ObjectiveLensPower') is None
+    assert metadata.get('NotAKeyword', default=0) == 0
+    assert walks == []
+
+    assert metadata.raw['OpticalPathSequence[1].ObjectiveLensPower'] == 40
+    assert metadata.raw is metadata.raw
+    assert len(walks) == 3
+
+
+def test_extraction_metrics(monkeypatch):
+    monkeypatch.setattr(get_settings(), 'metrics_enabled', True)
+    get_metrics.cache_clear()
+    recorded = []
+    get_metrics().add_callback(recorded.append)
+    try:
+        metadata = DatasetMetadata(make_dataset())
+        assert recorded == []
+
+        metadata.get('BitsStored')
+        metadata.get('BitsStored')
+        metadata.raw
+        metadata.raw
+        assert [m.operation for m in recorded] == ['lookup_dataset_metadata', 'parse_dataset_metadata']
+    finally:
+        get_metrics.cache_clear()
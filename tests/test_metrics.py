@@ -0,0 +1,121 @@
+import asyncio
+import logging
+
+import pytest
+
+from pims_plugin_format_dicom import metrics
+from pims_plugin_format_dicom.config import get_settings
+from pims_plugin_format_dicom.metrics import (
+    Histogram, MetricsRegistry, count, get_metrics, instrumented, prometheus_metrics, set_level
+)
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(get_settings(), 'metrics_enabled', True)
+    monkeypatch.setattr(get_settings(), 'metrics_slow_operation_seconds', 0)
+    get_metrics.cache_clear()
+    yield get_metrics()
+    get_metrics.cache_clear()
+
+
+class FakeFormat:
+    path = "/data/slide"
+
+
+class FakeReader:
+    format = FakeFormat()
+
+    @instrumented('read_tile')
+    def read_tile(self, frames):
+        set_level(2)
+        count('frames_read', frames)
+        return open_slide("/data/other")
+
+    @instrumented('read_tile_async')
+    async def read_tile_async(self, frames):
+        count('frames_decoded', frames)
+        return frames
+
+
+@instrumented('open_slide')
+def open_slide(path):
+    count('slide_cache_misses')
+    count('bytes_read', 100)
+    return path
+
+
+def test_histogram_samples():
+    histogram = Histogram((1, 10))
+    for value in (0, 1, 5, 50):
+        histogram.observe(value)
+    assert histogram.samples() == [('1', 2), ('10', 3), ('+Inf', 4)]
+    assert histogram.sum == 56 and histogram.count == 4
+
+
+def test_instrumented_nested(registry):
+    recorded = []
+    registry.add_callback(recorded.append)
+    assert FakeReader().read_tile(3) == "/data/other"
+    registry.remove_callback(recorded.append)
+
+    opened, read = recorded
+    assert (opened.operation, opened.slide) == ('open_slide', "/data/other")
+    assert opened.counts == dict(slide_cache_misses=1, bytes_read=100)
+    assert (read.operation, read.slide, read.level) == ('read_tile', "/data/slide", 2)
+    assert read.counts == dict(frames_read=3, slide_cache_misses=1, bytes_read=100)
+    assert read.duration >= opened.duration >= 0
+
+
+def test_instrumented_async(registry):
+    recorded = []
+    registry.add_callback(recorded.append)
+    assert asyncio.run(FakeReader().read_tile_async(4)) == 4
+    registry.remove_callback(recorded.append)
+    assert [(m.operation, m.counts) for m in recorded] == [
+        ('read_tile_async', dict(frames_decoded=4))
+    ]
+
+
+def test_count_outside_operation(registry):
+    count('frames_read')
+    assert registry.render_prometheus() == ""
+
+
+def test_prometheus(registry):
+    FakeReader().read_tile(3)
+    text = prometheus_metrics()
+    assert "# TYPE wsidicom_duration_seconds histogram" in text
+    assert 'wsidicom_duration_seconds_count{operation="read_tile"} 1' in text
+    assert 'wsidicom_frames_read_bucket{operation="read_tile",le="4"} 1' in text
+    assert 'wsidicom_frames_read_bucket{operation="read_tile",le="2"} 0' in text
+    assert 'wsidicom_bytes_read_sum{operation="open_slide"} 100' in text
+
+
+def test_slow_operation_log(caplog):
+    registry = MetricsRegistry(slow_operation_seconds=1e-9)
+    operation = metrics.OperationMetrics('read_window', "/data/slide", None)
+    operation.level, operation.duration = 1, 0.5
+    operation.add('frames_decoded', 8)
+    with caplog.at_level(logging.WARNING, logger="pims.formats"):
+        registry.record(operation)
+    assert "Slow WSI DICOM read_window of /data/slide (level 1)" in caplog.text
+    assert "frames_decoded=8" in caplog.text
+
+
+def test_failing_callback(registry, caplog):
+    def fail(_):
+        raise ValueError("boom")
+    registry.add_callback(fail)
+    with caplog.at_level(logging.WARNING, logger="pims.formats"):
+        assert open_slide("/data/slide") == "/data/slide"
+    registry.remove_callback(fail)
+    assert "boom" in caplog.text
+
+
+def test_disabled(monkeypatch):
+    monkeypatch.setattr(get_settings(), 'metrics_enabled', False)
+    get_metrics.cache_clear()
+    assert get_metrics() is None
+    assert FakeReader().read_tile(1) == "/data/other"
+    assert prometheus_metrics() == ""
@@ -0,0 +1,106 @@
+import math
+import threading
+import time
+
+from pims_plugin_format_dicom.prefetch import TilePrefetcher, predict_tiles, prefetch_session
+
+
+class FakeTier:
+    def __init__(self, pyramid, width, height, tile_size=256):
+        self.pyramid = pyramid
+        self.width, self.height = width, height
+        self.tile_width = self.tile_height = tile_size
+
+    @property
+    def level(self):
+        return self.pyramid.tiers.index(self)
+
+    @property
+    def max_tx(self):
+        return math.ceil(self.width / self.tile_width)
+
+    @property
+    def max_ty(self):
+        return math.ceil(self.height / self.tile_height)
+
+    def get_txty_tile(self, tx, ty):
+        return FakeTile(self, tx, ty)
+
+
+class FakePyramid:
+    def __init__(self, width, height, n_levels):
+        self.tiers = [FakeTier(self, width >> i, height >> i) for i in range(n_levels)]
+
+    @property
+    def n_levels(self):
+        return len(self.tiers)
+
+
+class FakeTile:
+    def __init__(self, tier, tx, ty):
+        self.tier, self.tx, self.ty = tier, tx, ty
+
+
+def test_predict_tiles():
+    pyramid = FakePyramid(4096, 4096, 3)
+    tile = FakeTile(pyramid.tiers[1], 3, 3)
+    assert predict_tiles(None, tile) == [
+        (1, 4, 3), (1, 2, 3), (1, 3, 4), (1, 3, 2),
+        (2, 1, 1),
+        (0, 6, 6), (0, 7, 6), (0, 6, 7), (0, 7, 7),
+    ]
+    # Panning to the right: next tiles on the right come first.
+    assert predict_tiles((1, 2, 3), tile)[:2] == [(1, 4, 3), (1, 5, 3)]
+    # Out of bounds tiles are ignored.
+    assert (1, -1, 0) not in predict_tiles(None, FakeTile(pyramid.tiers[1], 0, 0))
+
+
+def test_prefetcher_hits():
+    pyramid = FakePyramid(4096, 4096, 3)
+    fetched = []
+    done = threading.Event()
+
+    def fetch(tile):
+        fetched.append((tile.tier.level, tile.tx, tile.ty))
+        if len(fetched) == 2:
+            done.set()
+
+    prefetcher = TilePrefetcher(workers=1, max_pending=8, max_predictions=2)
+    prefetch_session.set('viewer')
+    prefetcher.observe('slide', FakeTile(pyramid.tiers[0], 2, 2), fetch)
+    assert done.wait(5)
+    while prefetcher.stats()['completed'] < 2:
+        time.sleep(0.01)
+
+    prefetcher.observe('slide', FakeTile(pyramid.tiers[0], *fetched[0][1:]), lambda tile: None)
+    stats = prefetcher.stats()
+    assert stats['issued'] >= 2
+    assert stats['hits'] == 1
+    assert stats['hit_rate'] == 0.5
+
+
+def test_prefetcher_pending_tile_is_not_a_hit():
+    pyramid = FakePyramid(4096, 4096, 3)
+    started, release = threading.Event(), threading.Event()
+    fetched = []
+
+    def fetch(tile):
+        started.set()
+        release.wait(5)
+        fetched.append((tile.tier.level, tile.tx, tile.ty))
+
+    prefetcher = TilePrefetcher(workers=1, max_pending=8, max_predictions=1)
+    prefetch_session.set('viewer')
+    prefetcher.observe('slide', FakeTile(pyramid.tiers[0], 2, 2), fetch)
+    assert started.wait(5)
+    # The predicted tile is read while its prefetch is still running.
+    prefetcher.observe('slide', FakeTile(pyramid.tiers[0], 3, 2), lambda tile: None)
+    release.set()
+    while prefetcher.stats()['completed'] < 1:
+        time.sleep(0.01)
+
+    stats = prefetcher.stats()
+    assert fetched == [(0, 3, 2)]
+    assert stats['hits'] == 0
+    assert stats['cancelled'] == 0
+    assert stats['hit_rate'] <= 1
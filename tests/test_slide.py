@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from wsidicom import WsiDicom
+from wsidicom.config import settings as wsidicom_settings
+from wsidicom.geometry import Point, Size
+
+from benchmarks.synthetic import SlideSpec, generate_slide
+from pims_plugin_format_dicom.slide import LazySlide, open_wsi_dicom, read_file_header, scan_slide
+
+
+@pytest.fixture(scope="module")
+def slide_path(tmp_path_factory):
+    spec = SlideSpec(width=1024, height=768, files_per_level=2, tiled_full=False, annotations=2)
+    return generate_slide(tmp_path_factory.mktemp("slides") / "slide", spec)
+
+
+def test_read_file_header(slide_path):
+    headers = scan_slide(slide_path)
+    levels = [h for h in headers if h.wsi_type == 'VOLUME']
+    assert sorted({h.size for h in levels}, reverse=True) == [(1024, 768), (512, 384), (256, 192)]
+    assert {h.tile_size for h in levels} == {(256, 256)}
+    assert all(h.pixel_spacing is not None for h in levels)
+    assert sorted(h.wsi_type for h in headers if h.wsi_type in ('LABEL', 'OVERVIEW')) == ['LABEL', 'OVERVIEW']
+    assert sum(h.wsi_type is None for h in headers) == 1  # annotations
+
+
+def test_read_file_header_not_dicom(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_bytes(b"not a DICOM file")
+    assert read_file_header(path) is None
+
+
+def test_lazy_slide_opens_levels_on_use(slide_path):
+    slide = LazySlide.open(slide_path)
+    assert isinstance(slide, LazySlide)
+    assert slide.levels.levels == [0, 1, 2]
+    assert slide.levels._opened == {}
+    assert slide.labels and slide.overviews
+
+    tile = slide.levels.get_level(1).get_tile(Point(0, 0), None, None)
+    assert tile.size == (256, 256)
+    assert list(slide.levels._opened) == [1]
+    assert slide.levels.get_level(1) is slide.levels.get_level(1)
+    assert slide.labels._series is None
+    slide.close()
+
+
+def test_lazy_slide_matches_wsidicom(slide_path):
+    slide = LazySlide.open(slide_path)
+    wsi = WsiDicom.open(slide_path)
+
+    assert slide.levels.levels == wsi.levels.levels
+    for level in wsi.levels.levels:
+        lazy_level, wsi_level = slide.levels.get_level(level), wsi.levels.get_level(level)
+        assert lazy_level.size == wsi_level.size
+        assert lazy_level.level == wsi_level.level
+        assert sorted(lazy_level.instances) == sorted(wsi_level.instances)
+    assert slide.levels.base_level.size == wsi.levels.base_level.size
+    assert sorted(map(str, slide.files)) == sorted(map(str, wsi.files))
+    assert len(slide.labels) == len(wsi.labels)
+    assert slide.labels[0].size == wsi.labels[0].size
+    assert len(slide.annotations) == len(wsi.annotations)
+
+    for size in ((100, 100), (300, 200), (600, 400)):
+        assert np.array_equal(np.asarray(slide.read_thumbnail(size)), np.asarray(wsi.read_thumbnail(size)))
+    assert slide.levels.get_closest_by_size(Size(300, 200)).size == Size(512, 384)
+    slide.close()
+    wsi.close()
+
+
+def test_open_without_parsing_pixel_data(slide_path):
+    slide = LazySlide.open(slide_path, parse_pixel_data=False)
+    wsi = open_wsi_dicom(slide_path, parse_pixel_data=False)
+    for opened in (slide, wsi):
+        for instance in opened.levels.base_level.instances.values():
+            assert all(file._frame_positions is None for file in instance.image_data._files.values())
+    # The process-wide wsidicom setting is left untouched.
+    assert wsidicom_settings.parse_pixel_data_on_load
+
+    reference = WsiDicom.open(slide_path)
+    assert wsi.levels.levels == reference.levels.levels
+    assert sorted(map(str, wsi.files)) == sorted(map(str, reference.files))
+    assert len(wsi.annotations) == len(reference.annotations)
+    assert np.array_equal(
+        np.asarray(wsi.read_thumbnail((300, 200))), np.asarray(reference.read_thumbnail((300, 200)))
+    )
+    for opened in (slide, wsi, reference):
+        opened.close()
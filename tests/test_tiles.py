@@ -0,0 +1,207 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import shapely
+from PIL import Image
+from wsidicom.geometry import Size
+
+from pims_plugin_format_dicom.cache import TileCache
+from pims_plugin_format_dicom.config import get_settings
+from pims_plugin_format_dicom.tiles import (
+    decode_frame, geometry_tiles, nearest_focal_plane, read_associated, read_planes, read_region, read_tiles,
+    reduction_factor, tile_range
+)
+
+TILE_SIZE = 256
+
+
+class FakeImageData:
+    """Image data serving PNG (or `codec`) encoded frames cut from an in-memory image."""
+    def __init__(self, pixels, codec='PNG'):
+        self.pixels = pixels
+        self.codec = codec
+        self.tile_size = Size(TILE_SIZE, TILE_SIZE)
+        self.samples_per_pixel = pixels.shape[2] if pixels.ndim == 3 else 1
+
+        self.n_reads = 0
+
+    def get_encoded_tile(self, tile, z, path, crop=True):
+        self.n_reads += 1
+        frame = np.zeros((TILE_SIZE, TILE_SIZE) + self.pixels.shape[2:], dtype=self.pixels.dtype)
+        top, left = tile.y * TILE_SIZE, tile.x * TILE_SIZE
+        stored = self.pixels[top:top + TILE_SIZE, left:left + TILE_SIZE]
+        frame[:stored.shape[0], :stored.shape[1]] = stored
+        buf = io.BytesIO()
+        Image.fromarray(frame).save(buf, format=self.codec)
+        return buf.getvalue()
+
+
+@pytest.fixture
+def image_data():
+    rng = np.random.default_rng(0)
+    return FakeImageData(rng.integers(0, 256, (700, 900, 3), dtype=np.uint8))
+
+
+def test_tile_range():
+    assert tile_range(0, 0, 256, 256, (256, 256)) == [(0, 0)]
+    assert tile_range(255, 0, 2, 1, (256, 256)) == [(0, 0), (1, 0)]
+    assert len(tile_range(100, 50, 700, 600, (256, 256))) == 4 * 3
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_read_region(image_data, workers):
+    executor = ThreadPoolExecutor(workers) if workers else None
+    out = read_region(image_data, 100, 50, 700, 600, 0, '0', executor)
+    assert out.shape == (600, 700, 3)
+    assert np.array_equal(out, image_data.pixels[50:650, 100:800])
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_read_region_16_bits(workers):
+    executor = ThreadPoolExecutor(workers) if workers else None
+    pixels = np.random.default_rng(0).integers(0, 2 ** 16, (700, 900), dtype=np.uint16)
+    # Lossless JPEG 2000, as stored in 16-bit slides.
+    image_data = FakeImageData(pixels, 'JPEG2000')
+    out = read_region(image_data, 100, 50, 700, 600, 0, '0', executor)
+    assert out.dtype == np.uint16
+    assert np.array_equal(out, pixels[50:650, 100:800])
+
+    image_data.image_size = Size(900, 700)
+    tile, = read_tiles([(image_data, 0, '0'), (image_data, 0, '0')], [(3, 2)])
+    assert tile.dtype == np.uint16
+    assert np.array_equal(tile[:, :, 1], pixels[512:, 768:])
+
+
+def test_read_region_cached(image_data):
+    cache = TileCache(max_bytes=2 ** 24)
+    first = read_region(image_data, 0, 0, 512, 512, 0, '0', cache=cache, cache_key=('slide', 0))
+    assert image_data.n_reads == 4
+
+    second = read_region(image_data, 256, 0, 512, 256, 0, '0', cache=cache, cache_key=('slide', 0))
+    assert image_data.n_reads == 5
+    assert np.array_equal(first[:256, 256:], second[:, :256])
+
+
+class FakeGroup:
+    """Single-frame JPEG associated image."""
+    def __init__(self, width, height):
+        buf = io.BytesIO()
+        Image.new('RGB', (width, height), (200, 100, 50)).save(buf, format='JPEG')
+        frame = buf.getvalue()
+
+        image_data = type('ImageData', (), {})()
+        image_data.tiled_size = Size(1, 1)
+        image_data.tile_size = image_data.image_size = Size(width, height)
+        image_data.default_z, image_data.default_path = 0, '0'
+        image_data.get_encoded_tile = lambda *args, **kwargs: frame
+        self.default_instance = type('Instance', (), {'image_data': image_data})()
+
+
+@pytest.mark.parametrize("out_size, expected", [
+    ((256, 128), (500, 250)),
+    ((2000, 1000), (2000, 1000)),
+    ((100, 10), (250, 125)),
+])
+def test_read_associated_draft(out_size, expected):
+    image = read_associated(FakeGroup(2000, 1000), *out_size)
+    assert image.size == expected
+
+
+def test_read_planes():
+    rng = np.random.default_rng(1)
+    planes = [
+        (FakeImageData(rng.integers(0, 256, (300, 400), dtype=np.uint8)), 0, str(path))
+        for path in range(3)
+    ]
+
+    out = read_planes(planes, 10, 20, 300, 250, ThreadPoolExecutor(2))
+    assert out.shape == (250, 300, 3)
+    for i, (image_data, _, _) in enumerate(planes):
+        assert np.array_equal(out[:, :, i], image_data.pixels[20:270, 10:310])
+
+
+def test_reduction_factor():
+    assert reduction_factor(1024, 1024, 1024, 1024, (256, 256)) == 1
+    assert reduction_factor(1024, 1024, 300, 300, (256, 256)) == 2
+    assert reduction_factor(1024, 1024, 10, 10, (256, 256)) == 8
+    assert reduction_factor(1024, 1024, 10, 10, (240, 240)) == 8
+    assert reduction_factor(1024, 1024, 10, 10, (100, 100)) == 4
+
+
+@pytest.mark.parametrize("codec", ['JPEG', 'JPEG2000', 'PNG'])
+def test_decode_frame_reduced(codec):
+    buf = io.BytesIO()
+    Image.new('RGB', (256, 256), (200, 100, 50)).save(buf, format=codec)
+    pixels = decode_frame(buf.getvalue(), 4)
+    assert pixels.shape == (64, 64, 3)
+    assert np.allclose(pixels[32, 32], (200, 100, 50), atol=4)
+
+
+def test_read_region_reduced(image_data):
+    out = read_region(image_data, 100, 50, 700, 600, 0, '0', factor=2)
+    assert out.shape == (300, 350, 3)
+    reduced = np.asarray(Image.fromarray(image_data.pixels).reduce(2))
+    assert np.abs(out.astype(int) - reduced[25:325, 50:400]).max() <= 1
+
+
+def test_read_single_tile_without_copy(image_data, monkeypatch):
+    monkeypatch.setattr(get_settings(), 'numpy_output', True)
+    cache = TileCache(max_bytes=2 ** 24)
+    first = read_region(image_data, 256, 0, 256, 100, 0, '0', cache=cache, cache_key=('slide', 0))
+    second = read_region(image_data, 256, 0, 256, 100, 0, '0', cache=cache, cache_key=('slide', 0))
+    assert np.array_equal(first, image_data.pixels[:100, 256:512])
+    assert np.shares_memory(first, second)
+    assert first.flags.c_contiguous
+
+    cropped = read_region(image_data, 300, 10, 20, 20, 0, '0', cache=cache, cache_key=('slide', 0))
+    assert np.array_equal(cropped, image_data.pixels[10:30, 300:320])
+    assert cropped.flags.c_contiguous
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_read_tiles(image_data, workers):
+    executor = ThreadPoolExecutor(workers) if workers else None
+    image_data.image_size = Size(900, 700)
+    tiles = [(3, 2), (0, 0), (1, 2)]
+    out = list(read_tiles([(image_data, 0, '0')], tiles, executor, batch_size=2))
+    assert [tile.shape for tile in out] == [(188, 132, 3), (256, 256, 3), (188, 256, 3)]
+    assert np.array_equal(out[0], image_data.pixels[512:, 768:])
+    assert np.array_equal(out[2], image_data.pixels[512:, 256:512])
+    assert image_data.n_reads == 3
+
+
+def test_read_tiles_planes(image_data):
+    image_data.image_size = Size(900, 700)
+    out, = read_tiles([(image_data, 0, '0'), (image_data, 1, '0')], [(1, 1)])
+    assert out.shape == (256, 256, 6)
+    assert np.array_equal(out[:, :, 3:], image_data.pixels[256:512, 256:512])
+
+
+def test_nearest_focal_plane():
+    assert nearest_focal_plane([0.0, 1.5, 4.0], 1.5) == 1.5
+    assert nearest_focal_plane([4.0, 0.0], 1.5) == 0.0
+    assert nearest_focal_plane([4.0, 0.0], 2.0) == 0.0
+    assert nearest_focal_plane([0.0], -3.0) == 0.0
+
+
+def test_geometry_tiles():
+    tiles = tile_range(0, 0, 1024, 1024, (256, 256))
+    diagonal = shapely.LineString([(10, 10), (1000, 1000)])
+    assert geometry_tiles(diagonal, tiles, (256, 256)) == [(i, i) for i in range(4)]
+    # Tiles of a level downsampled by 4.
+    assert geometry_tiles(diagonal, tiles, (256, 256), (4, 4)) == [(0, 0)]
+    thin = shapely.box(300, 10, 310, 700)
+    assert geometry_tiles(thin, tiles, (256, 256)) == [(1, 0), (1, 1), (1, 2)]
+    assert geometry_tiles(thin, [], (256, 256)) == []
+    # Edges belong to the tiles on their right and below.
+    assert geometry_tiles(shapely.LineString([(256, 0), (256, 300)]), tiles, (256, 256)) == [(1, 0), (1, 1)]
+
+
+def test_read_planes_only_tiles(image_data):
+    out = read_planes([(image_data, 0, '0')], 100, 50, 700, 600, tiles=[(1, 1)], background=255)
+    assert image_data.n_reads == 1
+    assert np.array_equal(out[206:462, 156:412], image_data.pixels[256:512, 256:512])
+    assert (out[:206] == 255).all() and (out[462:] == 255).all()
+    assert (out[:, :156] == 255).all() and (out[:, 412:] == 255).all()